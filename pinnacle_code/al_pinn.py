@@ -1,9 +1,21 @@
 import os
-os.environ["OMP_NUM_THREADS"] = "8" 
-os.environ["OPENBLAS_NUM_THREADS"] = "8" 
-os.environ["MKL_NUM_THREADS"] = "8"
-os.environ["VECLIB_MAXIMUM_THREADS"] = "8" 
-os.environ["NUMEXPR_NUM_THREADS"] = "8" 
+import argparse
+
+# the thread and device settings have to be in the environment before numpy / jax are imported, so these two
+# arguments are read ahead of the full parser below
+_pre_parser = argparse.ArgumentParser(add_help=False)
+_pre_parser.add_argument('--blas_threads', type=int, default=8)
+_pre_parser.add_argument('--ntk_devices', type=int, default=None)
+_pre_args, _ = _pre_parser.parse_known_args()
+
+os.environ["OMP_NUM_THREADS"] = str(_pre_args.blas_threads)
+os.environ["OPENBLAS_NUM_THREADS"] = str(_pre_args.blas_threads)
+os.environ["MKL_NUM_THREADS"] = str(_pre_args.blas_threads)
+os.environ["VECLIB_MAXIMUM_THREADS"] = str(_pre_args.blas_threads)
+os.environ["NUMEXPR_NUM_THREADS"] = str(_pre_args.blas_threads)
+if (_pre_args.ntk_devices is not None) and (_pre_args.ntk_devices > 1):
+    # expose the cores as several XLA host devices, across which the NTK rows are sharded
+    os.environ["XLA_FLAGS"] = os.environ.get("XLA_FLAGS", "") + f" --xla_force_host_platform_device_count={_pre_args.ntk_devices}"
 # os.environ['JAX_TRACEBACK_FILTERING'] = 'off'
 
 
@@ -11,7 +23,6 @@ import sys
 import pickle as pkl
 from functools import partial
 import random
-import argparse
 from datetime import datetime
 import traceback
 
@@ -40,6 +51,7 @@ from deepxde_al_patch import deepxde as dde
 from deepxde_al_patch.model_loader import construct_model
 from deepxde_al_patch.utils import get_pde_residue
 from deepxde_al_patch.modified_train_loop import ModifiedTrainLoop
+from deepxde_al_patch.compile_cache import enable_persistent_cache
 from deepxde_al_patch.plotters import plot_residue_loss, plot_error, plot_prediction, plot_eigvals, plot_eigenbasis
 
 
@@ -95,6 +107,20 @@ parser.add_argument('--sample_each_round', action=argparse.BooleanOptionalAction
 
 parser.add_argument('--scaling', type=float, default=1.)
 
+parser.add_argument('--ntk_chunk_size', type=int, default=None)  # points per jacobian chunk in NTK computations
+parser.add_argument('--ntk_mem_budget_mb', type=float, default=None)  # alternatively, MB of jacobian rows per chunk
+parser.add_argument('--ntk_devices', type=int, default=None)  # host devices to shard the NTK rows over (see top of file)
+parser.add_argument('--blas_threads', type=int, default=8)  # BLAS / OpenMP threads (per process, see top of file)
+parser.add_argument('--ntk_jac_mode', type=str, default='rev')  # 'rev', 'fwd', 'jvp' or 'auto' for jacobians w.r.t. params
+parser.add_argument('--ntk_weights_every', type=int, default=10)  # steps between autoscale / lra loss weight updates
+parser.add_argument('--ntk_trace_probes', type=int, default=None)  # Hutchinson probes for the autoscale traces, None for exact
+parser.add_argument('--al_async_staleness', type=int, default=None)  # run AL rounds in the background, started this many steps early
+parser.add_argument('--fused_steps', type=int, default=None)  # run up to this many training steps in one jitted scan
+parser.add_argument('--jax_cache_dir', type=str, default=None)  # persistent compilation cache, shared by the runs of a sweep
+parser.add_argument('--jax_cache_min_secs', type=float, default=0.)  # only cache programs that took this long to compile
+parser.add_argument('--clear_caches', type=str, default='memory')  # 'always', 'never' or 'memory' (under memory pressure)
+parser.add_argument('--warmup', action=argparse.BooleanOptionalAction, default=False)  # compile the step programs before training
+
 
 parser.add_argument('--auto_al', action=argparse.BooleanOptionalAction, default=False)
 parser.add_argument('--anchor_budget', type=int, default=0)
@@ -114,6 +140,18 @@ parser.add_argument('--eig_memory', action=argparse.BooleanOptionalAction, defau
 parser.add_argument('--eig_fixed_budget', action=argparse.BooleanOptionalAction, default=False)
 parser.add_argument('--eig_sampling', type=str, default='pseudo')
 parser.add_argument('--eig_scale', type=str, default='none')
+parser.add_argument('--eig_solver', type=str, default='eigh')  # eigh, lanczos, lobpcg, randomized
+parser.add_argument('--eig_k', type=int, default=100)  # leading eigenpairs for the iterative eig solvers
+parser.add_argument('--ntk_sketch_size', type=int, default=None)  # sketch the jacobians to s columns, None for exact NTKs
+parser.add_argument('--ntk_sketch_type', type=str, default='gaussian')  # gaussian, srht
+parser.add_argument('--eig_nystrom', action=argparse.BooleanOptionalAction, default=False)  # Nystrom NTK through a fixed landmark set
+parser.add_argument('--eig_landmarks', type=int, default=1000)  # number of Nystrom landmark points
+parser.add_argument('--eig_jac_store_dir', type=str, default=None)  # memory-map the candidate jacobians in this directory
+parser.add_argument('--eig_compiled', action=argparse.BooleanOptionalAction, default=False)  # greedy rounds as one jitted kernel
+parser.add_argument('--eig_kmeans_iters', type=int, default=0)  # mini-batch Lloyd iterations after the k-means++ seeding (0 ranks the seeds)
+parser.add_argument('--eig_score_methods', type=str, nargs='*', default=[])  # further weight methods scored and logged each round
+parser.add_argument('--eig_log_level', type=str, default='full')  # AL intermediates kept: minimal, spectrum or full
+parser.add_argument('--eig_log_spill_dir', type=str, default=None)  # write large logged arrays to .npz files in this directory
 
 parser.add_argument('--gd_indicator', type=str, default='K')
 parser.add_argument('--gd_compare_mode', action=argparse.BooleanOptionalAction, default=False)
@@ -154,6 +192,19 @@ autoscale_first = args.autoscale_first
 save_grads = args.save_grads
 sample_each_round = args.sample_each_round
 lra_loss_w_bcs = args.lra_loss_w_bcs
+ntk_chunk_size = args.ntk_chunk_size
+ntk_mem_budget = None if args.ntk_mem_budget_mb is None else int(args.ntk_mem_budget_mb * 2**20)
+ntk_weights_every = args.ntk_weights_every
+ntk_jac_mode = args.ntk_jac_mode
+ntk_devices = args.ntk_devices
+ntk_trace_probes = args.ntk_trace_probes
+al_async_staleness = args.al_async_staleness
+fused_steps = args.fused_steps
+clear_caches_policy = args.clear_caches
+warmup = args.warmup
+
+if args.jax_cache_dir is not None:
+    enable_persistent_cache(args.jax_cache_dir, min_compile_secs=args.jax_cache_min_secs)
 
 auto_al = args.auto_al
 
@@ -171,6 +222,18 @@ eig_memory = args.eig_memory
 eig_sampling = args.eig_sampling
 eig_scale = args.eig_scale
 eig_fixed_budget = args.eig_fixed_budget
+eig_solver = args.eig_solver
+eig_k = args.eig_k
+ntk_sketch_size = args.ntk_sketch_size
+ntk_sketch_type = args.ntk_sketch_type
+eig_nystrom = args.eig_nystrom
+eig_landmarks = args.eig_landmarks
+eig_jac_store_dir = args.eig_jac_store_dir
+eig_compiled = args.eig_compiled
+eig_kmeans_iters = args.eig_kmeans_iters
+eig_score_methods = args.eig_score_methods
+eig_log_level = args.eig_log_level
+eig_log_spill_dir = args.eig_log_spill_dir
 
 gd_indicator = args.gd_indicator
 gd_compare_mode = args.gd_compare_mode
@@ -216,6 +279,11 @@ autoscale_loss_w_bcs = {autoscale_loss_w_bcs}
 
 
 auto_al = {auto_al}
+al_async_staleness = {al_async_staleness}
+fused_steps = {fused_steps}
+jax_cache_dir = {args.jax_cache_dir}
+clear_caches_policy = {clear_caches_policy}
+warmup = {warmup}
 
 method = {method}
 num_points = {num_points}""")
@@ -232,14 +300,26 @@ elif method == 'residue':
 res_res_prop = {res_res_prop}
 res_all_types = {res_all_types}""")
 
-elif method in {'greedy', 'kmeans', 'sampling'}:
+elif method in {'greedy', 'kmeans', 'sampling', 'dpp'}:
     method_str = f'{method}_{eig_weight_method}_scale-{eig_scale}' + ('_mem' if eig_memory else '') + ('_fb' if eig_fixed_budget else '')
     print(f"""
 eig_weight_method = {eig_weight_method}
 eig_memory = {eig_memory}
 eig_fixed_budget = {eig_fixed_budget}
 eig_sampling = {eig_sampling}
-eig_scale = {eig_scale}""")
+eig_scale = {eig_scale}
+eig_solver = {eig_solver}
+eig_k = {eig_k}
+ntk_sketch_size = {ntk_sketch_size}
+ntk_sketch_type = {ntk_sketch_type}
+eig_nystrom = {eig_nystrom}
+eig_landmarks = {eig_landmarks}
+eig_jac_store_dir = {eig_jac_store_dir}
+eig_compiled = {eig_compiled}
+eig_kmeans_iters = {eig_kmeans_iters}
+eig_score_methods = {eig_score_methods}
+eig_log_level = {eig_log_level}
+eig_log_spill_dir = {eig_log_spill_dir}""")
     
 elif method == 'gd':
     method_str = f'gd_{gd_indicator}_{gd_crit}' + ('_fulldiff' if gd_compare_mode else '')
@@ -319,7 +399,7 @@ elif method == 'residue':
         c=0.,
     )
     
-elif method in {'greedy', 'kmeans', 'sampling'}:
+elif method in {'greedy', 'kmeans', 'sampling', 'dpp'}:
     
     if ('conv' in eqn) or ('darcy' in eqn):
         factor_res = 2000
@@ -348,6 +428,18 @@ elif method in {'greedy', 'kmeans', 'sampling'}:
         sampling=eig_sampling,
         memory=eig_memory,
         scale=eig_scale,
+        eig_solver=eig_solver,
+        eig_k=eig_k,
+        ntk_sketch_size=ntk_sketch_size,
+        ntk_sketch_type=ntk_sketch_type,
+        nystrom=eig_nystrom,
+        points_pool_size=eig_landmarks,
+        jac_store_dir=eig_jac_store_dir,
+        compiled=eig_compiled,
+        kmeans_iters=eig_kmeans_iters,
+        score_methods=eig_score_methods,
+        log_level=eig_log_level,
+        log_spill_dir=eig_log_spill_dir,
         min_num_points_bcs=min_num_points_bcs,
         min_num_points_res=min_num_points_res,
         use_init_train_pts=False,
@@ -462,6 +554,16 @@ train_loop = ModifiedTrainLoop(
     ntk_ratio_threshold=(0.5 if auto_al else None),
     tensorboard_plots=(eqn in {'conv-1d', 'burgers-1d', 'poisson-2d'}),
     log_dir=tensorboard_dir,
+    ntk_chunk_size=ntk_chunk_size,
+    ntk_mem_budget=ntk_mem_budget,
+    ntk_weights_every=ntk_weights_every,
+    ntk_jac_mode=ntk_jac_mode,
+    ntk_devices=ntk_devices,
+    ntk_trace_probes=ntk_trace_probes,
+    al_async_staleness=al_async_staleness,
+    fused_steps=fused_steps,
+    clear_caches_policy=clear_caches_policy,
+    warmup=warmup,
     **optim_dict
 )
 
@@ -500,12 +602,14 @@ try:
                     # don't keep jacobians to save memory
                     d_int = reduced_snapshot[k]['al_intermediate']
                     if d_int is not None:
-                        d_int.pop('jac_train', None)
-                        d_int.pop('jac_candidates', None)
+                        # (dict.pop, so that entries spilled to disk are dropped without being loaded)
+                        dict.pop(d_int, 'jac_train', None)
+                        dict.pop(d_int, 'jac_candidates', None)
+                        dict.pop(d_int, 'sketch', None)
                         # if eqn not in {'conv-1d', 'burgers-1d'}:
-                        d_int.pop('eigvects', None)
-                        d_int.pop('K_train_test', None)
-                        d_int.pop('NTK', None)
+                        dict.pop(d_int, 'eigvects', None)
+                        dict.pop(d_int, 'K_train_test', None)
+                        dict.pop(d_int, 'NTK', None)
 
         with open(f'{folder_name}/snapshot_data_s{ub_step}.pkl', 'wb+') as f:
             pkl.dump(reduced_snapshot, f)
@@ -13,6 +13,7 @@ AL_CONSTRUCTOR = {
     'eig_greedy': partial(EigenvaluePointSelector, selection_method='greedy'),
     'eig_sampling': partial(EigenvaluePointSelector, selection_method='sampling'),
     'eig_kmeans': partial(EigenvaluePointSelector, selection_method='kmeans'),
+    'eig_dpp': partial(EigenvaluePointSelector, selection_method='dpp'),
     'random': RandomPointSelector,
     'residue': ResidueSelector,
 }
@@ -2,7 +2,6 @@ import os
 import pickle as pkl
 from collections.abc import MutableMapping
 from functools import partial
-import random
 
 import flax
 import jax
@@ -13,17 +12,190 @@ import optax
 import tqdm
 from flax import linen as nn
 # import cvxpy as cp
-from sklearn.cluster._kmeans import kmeans_plusplus
 
 from .. import deepxde as dde
 
 from ..icbc_patch import (constrain_bc, constrain_domain, constrain_ic,
                           generate_residue)
-from ..ntk import NTKHelper
-from ..utils import dict_pts_size, flatten_pts_dict, to_cpu
+from ..ntk import NTKHelper, NTKPlan, JacobianBlock, segment_weights, _jac_params_helper, _jac_params_flatten
+from ..jac_store import JacobianStore
+from ..kmeans import kmeans_ranking
+from ..point_set import PointSet
+from ..spectral import eigh_top_k
+from ..utils import dict_pts_size, flatten_pts_dict, gumbel_top_k, sampling_key
+from ..al_logging import ALLog
 from .ntk_based_al import NTKBasedAL
 
 
+# weight methods (and greedy selection) supported by the compiled selection kernel
+COMPILED_WEIGHT_METHODS = ['nystrom', 'eigvals', 'labels', 'alignment', 'alignment_norm']
+
+
+def _pad_segment(x, size, dim):
+    # pad a set of points to a static size, repeating the last point so that the padded residues stay finite
+    n = x.shape[0]
+    if n == 0:
+        x = jnp.zeros((1, dim), dtype=jnp.float32)
+    x = jnp.concatenate([x, jnp.repeat(x[-1:], size - n, axis=0)], axis=0) if size > n else x
+    return x, jnp.arange(size) < n
+
+
+@partial(jax.jit, static_argnames=['train_fns', 'cand_fns', 'err_fns', 'train_modes', 'cand_modes', 'weight_method',
+                                   'num_points', 'min_counts', 'eps_ntk'])
+def _eig_select_kernel(params, xs_train, masks_train, ws_train, xs_cand, masks_cand, ws_cand,
+                       train_fns, cand_fns, err_fns, train_modes, cand_modes, weight_method, num_points, min_counts, eps_ntk):
+    # one XLA program for a greedy selection round: jacobians, NTKs, eigendecomposition, scores and top-k.
+    # every segment (res, bcs_i and, for training, anc) is padded to a static size, and the padded rows are zeroed
+    # through the masks
+    def stacked_jac(fns, modes, xs, masks, ws):
+        rows = [_jac_params_flatten(_jac_params_helper(params, x, fn, mode=mode)) * (w * m)[:, None]
+                for fn, mode, x, m, w in zip(fns, modes, xs, masks, ws)]
+        return jnp.concatenate(rows, axis=0)
+
+    J = stacked_jac(train_fns, train_modes, xs_train, masks_train, ws_train)
+    K_train = J @ J.T
+    eigvals, eigvects = jnp.linalg.eigh(K_train + eps_ntk * jnp.eye(K_train.shape[0]))
+    # padded rows only give eigenpairs supported on the padding, which are dropped like the small eigenvalues
+    valid_train = jnp.concatenate(masks_train)
+    keep = (eigvals > eps_ntk) & (jnp.sum((eigvects * valid_train[:, None]) ** 2, axis=0) > 0.5)
+
+    Jc = stacked_jac(cand_fns, cand_modes, xs_cand, masks_cand, ws_cand)
+    valid_cand = jnp.concatenate(masks_cand)
+    residual = jnp.concatenate([fn(params, x).reshape(-1) * m for fn, x, m in zip(err_fns, xs_cand, masks_cand)])
+    proj = jnp.where(keep[:, None], eigvects.T @ (J @ Jc.T), 0.)
+    safe_eigvals = jnp.where(keep, eigvals, 1.)
+    if weight_method == 'nystrom':
+        P = proj
+    elif weight_method == 'eigvals':
+        P = eigvals[:, None] * proj
+    elif weight_method == 'labels':
+        P = eigvals[:, None] * proj * residual[None, :]
+    elif weight_method == 'alignment':
+        P = proj * residual[None, :] / jnp.sqrt(safe_eigvals)[:, None]
+    else:
+        P_full = proj * residual[None, :] / jnp.sqrt(safe_eigvals)[:, None]
+        P = P_full * jnp.mean(residual[None, :] * proj, axis=1)[:, None]
+    score = jnp.where(valid_cand, jnp.linalg.norm(P, axis=0), -jnp.inf)
+
+    # the minimum number of points per segment first, then the best of the rest, as in top_k_points. the padded
+    # rows score -inf, so a segment with fewer real candidates than its minimum gives all of them and padding
+    # (dropped through ok), and the rest is filled up to num_points picked real points
+    valid = valid_cand > 0
+    idx, start = [], 0
+    for x, k in zip(xs_cand, min_counts):
+        if k > 0:
+            idx.append(jax.lax.top_k(score[start:start + x.shape[0]], min(k, x.shape[0]))[1] + start)
+        start += x.shape[0]
+    idx = jnp.concatenate(idx) if len(idx) > 0 else jnp.zeros((0,), dtype=jnp.int32)
+    ok = valid[idx]
+    score_rest = score.at[idx].set(-jnp.inf)
+    n_rest = min(num_points, score.shape[0])
+    remaining = jax.lax.top_k(score_rest, n_rest)[1]
+    ok_rest = valid[remaining] & (score_rest[remaining] > -jnp.inf) & (jnp.arange(n_rest) < num_points - jnp.sum(ok))
+    return jnp.concatenate([idx, remaining]), jnp.concatenate([ok, ok_rest]), score, J, eigvals, eigvects, keep
+
+
+# weight methods whose column norms the streaming scorer computes
+STREAMING_WEIGHT_METHODS = ['nystrom', 'eigvals', 'labels', 'alignment', 'alignment_norm', 'nystrom_wo_N', 'nystrom_norm',
+                            'labels_train', 'residue', 'inverted_residue']
+
+
+@partial(jax.jit, static_argnames=['methods'])
+def _score_block(K_block, res_block, eigvects, eigvals, keep, m, n, a, methods):
+    # column norms of P for a block of candidates, for all methods at once. the eigenvalue weights are applied as
+    # broadcasts on the (r, b) projection, P itself is never formed
+    proj = jnp.where(keep[:, None], eigvects.T @ K_block, 0.)
+    safe_eigvals = jnp.where(keep, eigvals, 1.)
+    abs_res = jnp.abs(res_block)
+    norm = lambda w: jnp.sqrt(jnp.sum((w[:, None] * proj) ** 2, axis=0))
+    ones = jnp.ones_like(eigvals)
+    out = dict()
+    for method in methods:
+        if method == 'nystrom':
+            out[method] = norm(ones)
+        elif method == 'eigvals':
+            out[method] = norm(eigvals)
+        elif method == 'labels':
+            out[method] = norm(eigvals) * abs_res
+        elif method == 'alignment':
+            out[method] = norm(1. / jnp.sqrt(safe_eigvals)) * abs_res
+        elif method == 'alignment_norm':
+            out[method] = norm(m / jnp.sqrt(safe_eigvals)) * abs_res
+        elif method == 'nystrom_wo_N':
+            out[method] = norm(ones) * abs_res
+        elif method == 'nystrom_norm':
+            out[method] = norm(m * n) * abs_res
+        elif method == 'labels_train':
+            out[method] = norm(a * eigvals)
+        else:
+            out[method] = abs_res
+    return out
+
+
+def stream_scores(eigvects, eigvals, K_train_test, residual, methods, eps_ntk, residual_train=None, block_size=4096):
+    """column norms of the scoring function P for several weight methods, in one pass over blocks of candidate
+    columns of K_train_test
+
+    Returns a dict with an (N,) array per method, the same as ``jnp.linalg.norm(scoring_function(...), axis=0)``.
+    The reductions over all candidates needed by the '_norm' methods are a single matrix-vector product computed
+    upfront, and 'labels_train' needs the residuals of the training points.
+    """
+    methods = tuple(methods)
+    n = K_train_test.shape[1]
+    keep = eigvals > eps_ntk
+    # mean over the candidates of residual * (eigvects.T @ K_train_test), 'nystrom_norm' uses the sum
+    m = jnp.where(keep, eigvects.T @ (K_train_test @ residual), 0.) / n
+    a = eigvects.T @ residual_train if residual_train is not None else jnp.zeros_like(eigvals)
+    block_size = min(block_size, n)
+    scores = {method: [] for method in methods}
+    for i in range(0, n, block_size):
+        # the last block is padded to the same size, so that the block kernel is compiled once
+        K_block, res_block = K_train_test[:, i:i + block_size], residual[i:i + block_size]
+        b = K_block.shape[1]
+        if b < block_size:
+            K_block = jnp.pad(K_block, ((0, 0), (0, block_size - b)))
+            res_block = jnp.pad(res_block, (0, block_size - b))
+        out = _score_block(K_block, res_block, eigvects, eigvals, keep, m, n, a, methods)
+        for method in methods:
+            scores[method].append(out[method][:b])
+    return {method: jnp.concatenate(s) for method, s in scores.items()}
+
+
+@partial(jax.jit, static_argnames=['k'])
+def _dpp_greedy(F, k, seg_ids, allowed_main, allowed_last, n_main, min_counts, eps=1e-9):
+    """greedy MAP of a DPP with kernel L = F.T @ F over the columns of the (r, N) feature matrix F
+
+    Uses the incremental Cholesky update of Chen et al. (2018): c[t] holds row t of the Cholesky factor of L
+    restricted to the selected points (for all N columns), and d2 the squared distance of every point to the
+    span of the selected ones, so that step t costs O(N (r + t)) and the whole selection O(N k (r + k)).
+
+    The first n_main points are drawn from allowed_main, the segments with min_counts still unmet coming first,
+    the remaining k - n_main points from allowed_last (used for the anchors). Returns the indices in the order
+    they were selected.
+    """
+    n = F.shape[1]
+    diag = jnp.sum(F ** 2, axis=0)
+    # once the selected points span everything, d2 vanishes and the (tiny) diagonal term ranks the rest
+    tol = eps * jnp.max(diag)
+
+    def step(t, carry):
+        c, d2, chosen, idx, counts = carry
+        allowed = jnp.where(t < n_main, allowed_main, allowed_last) & (~chosen)
+        # restricted to the segments below their minimum, as long as they have points left
+        need = allowed & ((counts < min_counts)[seg_ids])
+        allowed = jnp.where((t < n_main) & jnp.any(need), need, allowed)
+        j = jnp.argmax(jnp.where(allowed, d2 + eps * diag, -jnp.inf)).astype(jnp.int32)
+        e = (F[:, j] @ F - c[:, j] @ c) / jnp.sqrt(jnp.maximum(d2[j], tol))
+        e = jnp.where(d2[j] > tol, e, 0.)
+        c = c.at[t].set(e)
+        d2 = jnp.maximum(d2 - e ** 2, 0.)
+        return c, d2, chosen.at[j].set(True), idx.at[t].set(j), counts.at[seg_ids[j]].add(1)
+
+    carry = (jnp.zeros((k, n), dtype=F.dtype), diag, jnp.zeros((n,), dtype=bool), jnp.zeros((k,), dtype=jnp.int32),
+             jnp.zeros_like(min_counts))
+    return jax.lax.fori_loop(0, k, step, carry)[3]
+
+
 class EigenvaluePointSelector(NTKBasedAL):
     # TODO add in parameters to select different BCs and residual points
     def __init__(self, model: dde.Model, 
@@ -63,13 +235,35 @@ class EigenvaluePointSelector(NTKBasedAL):
                  active_eig: int = None,
                  eig_min: float = 1e-4,
                  eps_ntk: float = 1e-8,
-                 target_fn_param=None):
+                 target_fn_param=None,
+                 jac_chunk_size: int = None, # number of points per jacobian chunk, None for no chunking
+                 jac_mem_budget: int = None, # alternatively, bytes of jacobian rows per chunk
+                 jac_mode: str = 'rev', # Options are 'rev', 'fwd', 'jvp', 'auto' (fastest, benchmarked once)
+                 jac_devices: int = None, # shard the jacobian rows over this many devices, None for one
+                 eig_solver: str = 'eigh', # Options are 'eigh' (full, dense), 'lanczos', 'lobpcg', 'randomized'
+                 eig_k: int = 100, # number of leading eigenpairs computed by the iterative solvers
+                 ntk_sketch_size: int = None, # approximate the NTKs with (P, s) sketched jacobians, None for exact
+                 ntk_sketch_type: str = 'gaussian', # Options are 'gaussian', 'srht'
+                 nystrom: bool = False, # approximate the NTKs through the landmarks in points_pool
+                 points_pool=None, # landmarks to reuse from a previous round, sampled if None
+                 jac_store_dir: str = None, # write the candidate jacobians to memory-mapped files in this directory
+                 keep_jac_store: bool = False, # keep the store files (referenced in the logs) instead of deleting them
+                 compiled: bool = False, # run greedy selection rounds as one jitted kernel on padded point sets
+                 kmeans_iters: int = 0, # mini-batch Lloyd iterations after the k-means++ seeding (kmeans selection), 0 ranks the seeds
+                 kmeans_batch_size: int = 1024, # points per mini-batch
+                 score_methods: list = None, # further weight methods scored (and logged) in the same pass as weight_method
+                 score_block_size: int = 4096, # candidate columns of K_train_test per block of the streaming scorer
+                 log_level: str = 'full', # intermediates kept in the round's log, 'minimal', 'spectrum' or 'full'
+                 log_spill_dir: str = None, # write logged arrays of at least log_spill_min_bytes to .npz files here
+                 log_spill_min_bytes: int = 2**20,
+                 ntk_helper: NTKHelper = None): # shared NTKHelper (with its jacobian cache), a new one is created if None
         super().__init__(
             model=model, points_pool_size=points_pool_size, eig_min=eig_min, active_eig=active_eig,
             inverse_problem=inverse_problem, current_samples=current_samples, 
             anchor_budget=anchor_budget, anc_point_filter=anc_point_filter, anc_idx=anc_idx,
             mem_pts_total_budget=mem_pts_total_budget, min_num_points_bcs=min_num_points_bcs, min_num_points_res=min_num_points_res, 
             loss_w_anc=loss_w_anc, loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde, optim_lr=optim_lr, enforce_budget=enforce_budget,
+            jac_chunk_size=jac_chunk_size, jac_mem_budget=jac_mem_budget, jac_mode=jac_mode, jac_devices=jac_devices, points_pool=points_pool, ntk_helper=ntk_helper,
         )
         self.selection_method = selection_method
         self.weight_method = weight_method # possible options are 'none', 'labels', 'eigvals'
@@ -92,42 +286,106 @@ class EigenvaluePointSelector(NTKBasedAL):
         self.eps_ntk = eps_ntk
         self.use_anc_in_train = use_anc_in_train
         self.target_fn_param = target_fn_param
+        self.eig_solver = eig_solver
+        self.eig_k = eig_k
+        self.ntk_sketch_size = ntk_sketch_size
+        self.ntk_sketch_type = ntk_sketch_type
+        self.nystrom = nystrom
+        self.jac_store_dir = jac_store_dir
+        self.keep_jac_store = keep_jac_store
+        self.compiled = compiled
+        self.kmeans_iters = kmeans_iters
+        self.kmeans_batch_size = kmeans_batch_size
+        self.score_methods = [] if score_methods is None else list(score_methods)
+        self.score_block_size = score_block_size
+        self.log_level = log_level
+        self.log_spill_dir = log_spill_dir
+        self.log_spill_min_bytes = log_spill_min_bytes
+        if log_spill_dir is not None:
+            os.makedirs(log_spill_dir, exist_ok=True)
+        assert all(m in STREAMING_WEIGHT_METHODS for m in self.score_methods), \
+            f'score_methods must be in {STREAMING_WEIGHT_METHODS}'
+        if jac_store_dir is not None:
+            os.makedirs(jac_store_dir, exist_ok=True)
+        assert not (nystrom and (ntk_sketch_size is not None)), 'Use either the Nystrom or the sketched NTK'
 
     # Helper function to filter dictionary of datapoints corresponding to indices of flattened dictionary
-    # Need at least Python 3.7 for this to work, as it assumes that the order of keys in a dictionary is preserved
-    def filter_dict(self,dict,idx):
-        counter = 0
-        new_dict = {}
-        for key, value in dict.items():
-            if isinstance(value,(jnp.ndarray)) or isinstance(value,(np.ndarray)):
-                new_array_list = []
-                for i in range(value.shape[0]):
-                    if counter in idx:
-                        new_array_list.append(value[i])
-                    counter += 1
-                new_array = jnp.array(new_array_list)
-                new_dict[key] = new_array
-                new_array = []
-                
-            if isinstance(value,list):
-                new_list = []
-                for i in range(len(value)):
-                    if isinstance(value[i],(jnp.ndarray)) or isinstance(value[i],(np.ndarray)):
-                        new_array_list = []
-                        for j in range(value[i].shape[0]):
-                            if counter in idx:
-                                new_array_list.append(value[i][j])
-                            counter += 1
-                        new_array = jnp.array(new_array_list)
-                    if len(new_array) != 0:
-                        new_list.append(new_array)  
-                new_dict[key] = new_list
-        return new_dict
+    def filter_dict(self, d, idx):
+        return PointSet.from_dict(d).gather(idx).to_dict()
     
+    def _can_compile(self, d, sketch):
+        # the compiled kernel covers the plain greedy round, everything else goes through the step-by-step path
+        return self.compiled and (self.selection_method == 'greedy') and (self.weight_method in COMPILED_WEIGHT_METHODS) \
+            and (self.eig_solver == 'eigh') and (sketch is None) and (self.jac_store_dir is None) and (self.scale == 'none') \
+            and (not self.select_anchor) and (not self.inverse_problem)
+
+    def _select_compiled(self, d, dict_test_pts, num_points):
+        # greedy selection through _eig_select_kernel. the point sets are padded to powers of two (at least 8), so
+        # the kernel is compiled once per configuration and only again when a set outgrows its bucket
+        params = self.model.net.params
+        has_anc = 'anc' in d.keys()
+        cand_codes = [-1] + list(range(len(d['bcs'])))
+        train_codes = cand_codes + ([-2] if has_anc else [])
+        dim = d['res'].shape[1]
+        bucket = lambda n: max(8, 1 << max(n - 1, 0).bit_length())
+        train_pts = [d['res']] + list(d['bcs']) + ([d['anc']] if has_anc else [])
+        cand_pts = [dict_test_pts['res']] + list(dict_test_pts['bcs'])
+        train = [_pad_segment(x, bucket(x.shape[0]), dim) for x in train_pts]
+        cand = [_pad_segment(x, bucket(x.shape[0]), dim) for x in cand_pts]
+
+        loss_w_bcs = self.loss_w_bcs if hasattr(self.loss_w_bcs, "__len__") else [self.loss_w_bcs for _ in d['bcs']]
+        ws_cand = tuple(jnp.asarray(w, dtype=jnp.float32) for w in [self.loss_w_pde] + list(loss_w_bcs))
+        ws_train = ws_cand + ((jnp.asarray(self.loss_w_anc, dtype=jnp.float32),) if has_anc else ())
+        train_fns = tuple(self.ntk_fn._get_res_fn(c) for c in train_codes)
+        cand_fns = train_fns[:len(cand_codes)]
+        err_fns = tuple(self.ntk_fn.get_error_fn(c) for c in cand_codes)
+        train_modes = tuple(self.ntk_fn._get_jac_mode(params, x, fn) for fn, (x, _) in zip(train_fns, train))
+        min_counts = (self.min_num_points_res,) + (self.min_num_points_bcs,) * len(d['bcs'])
+
+        idx, ok, score, J, eigvals, eigvects, keep = _eig_select_kernel(
+            params, tuple(x for x, _ in train), tuple(m for _, m in train), ws_train,
+            tuple(x for x, _ in cand), tuple(m for _, m in cand), ws_cand,
+            train_fns=train_fns, cand_fns=cand_fns, err_fns=err_fns, train_modes=train_modes,
+            cand_modes=train_modes[:len(cand_codes)], weight_method=self.weight_method,
+            num_points=int(num_points), min_counts=min_counts, eps_ntk=self.eps_ntk,
+        )
+
+        # back from the padded layout to indices of the flattened candidate dictionary
+        pad_off = np.cumsum([0] + [x.shape[0] for x, _ in cand])
+        real_off = np.cumsum([0] + [x.shape[0] for x in cand_pts])
+        idx = np.asarray(idx)[np.asarray(ok)]
+        seg = np.searchsorted(pad_off, idx, side='right') - 1
+        idx = jnp.array(np.sort(idx - pad_off[seg] + real_off[seg]))
+        valid_cand = np.concatenate([np.asarray(m) for _, m in cand])
+        score = np.asarray(score)[valid_cand]
+
+        # unpadded training jacobian and the eigenpairs supported on the real rows, for logging and the projections
+        valid_train = np.concatenate([np.asarray(m) for _, m in train])
+        support = np.sum(np.asarray(eigvects)[valid_train] ** 2, axis=0) > 0.5
+        real_off = np.cumsum([0] + [x.shape[0] for x in train_pts])
+        names = ['res'] + [f'bcs_{i}' for i in range(len(d['bcs']))] + (['anc'] if has_anc else [])
+        jacs = JacobianBlock(J[valid_train], segments=[(n, real_off[i], real_off[i + 1]) for i, n in enumerate(names)],
+                             layout=self.ntk_fn.param_layout(params))
+        eigvals = eigvals[support]
+        eigvects = eigvects[valid_train][:, support]
+        return idx, score, jacs, eigvals, eigvects
+
     def generate_samples(self):
         
         # Now directly computing required NTKs. TODO make use of superclass methods
 
+        cache_stats_start = dict(self.ntk_fn.cache_stats)
+
+        # One sketch per round, shared by all jacobians so that the sketched K_train and K_train_test are consistent
+        if self.ntk_sketch_size is not None:
+            sketch = self.ntk_fn.make_sketch(self.ntk_sketch_size, self.ntk_sketch_type, key=jax.random.PRNGKey(np.random.randint(2**31)))
+        elif self.nystrom:
+            # the Nystrom map acts as a (P, r) sketch, so candidate scores only need the landmark cross-kernels
+            self._precompute_pool(eig_min=self.eig_min)
+            sketch = self.nystrom_map
+        else:
+            sketch = None
+
         # Initial training data that is used as a base to compute kernel. 
         
         # if True:
@@ -160,28 +418,23 @@ class EigenvaluePointSelector(NTKBasedAL):
                 d['anc'] = self.anc_point_filter(jnp.array(self.data.train_x_all))
 
         # Compute jacobians and eigenvalues of separate components
-        def get_jacs_and_eigvals(self,d, get_eigvals=True, loss_w_bcs=None, loss_w_pde=None, loss_w_anc=None):
+        def get_jacs_and_eigvals(self,d, get_eigvals=True, loss_w_bcs=None, loss_w_pde=None, loss_w_anc=None, cache=True):
             loss_w_bcs = self.loss_w_bcs if loss_w_bcs is None else loss_w_bcs
             loss_w_pde = self.loss_w_pde if loss_w_pde is None else loss_w_pde
             loss_w_anc = self.loss_w_anc if loss_w_anc is None else loss_w_anc
             
-            # Compute separate jacs
-            jac_pde = self.ntk_fn.get_jac(d['res'], code=-1, loss_w_pde = loss_w_pde)
-            jac_bcs_list = [self.ntk_fn.get_jac(d['bcs'][i], code=i, loss_w_bcs=loss_w_bcs[i]) for i in range(len(d['bcs']))] # separate eigvals for each bc component
-            # jac_bcs = {k: jnp.concatenate([jc[k] for jc in jac_bcs_list], axis=0) for k in jac_pde.keys()} # for combined bc eigvals 
-            
-            jacs_sep = [jac_pde] + jac_bcs_list
-            
-            if 'anc' in d.keys():
-                jac_anc = self.ntk_fn.get_jac(d['anc'], code=-2, loss_w_anc=loss_w_anc)
-                jacs_sep += [jac_anc]
+            # Compute the stacked (flat) jacobian, the separate components are row segments of it
+            jacs = self.ntk_fn.get_jac_block(d, loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde, loss_w_anc=loss_w_anc, sketch=sketch, cache=cache)
 
             # Compute eigenvalues of separate jacs
             if get_eigvals == True:
-                eigvals_res = jnp.linalg.eigh(self.ntk_fn.get_ntk(jac1=jac_pde, jac2=jac_pde))[0] # second argument returns eigenvectors
-                eigvals_bcs = [jnp.linalg.eigh(self.ntk_fn.get_ntk(jac1=j_, jac2=j_))[0] for j_ in jac_bcs_list]
+                # only the largest eigenvalue of each component is used (max scaling, lr_cap), the traces come straight
+                # from the jacobian. kept as a length-1 array of eigenvalues
+                eig_seg = lambda name: self.ntk_fn.spectral_stats(jac=jacs.rows(name), power_iters=50)['lambda_max'].reshape(1)
+                eigvals_res = eig_seg('res')
+                eigvals_bcs = [eig_seg(f'bcs_{i}') for i in range(len(d['bcs']))] # separate eigvals for each bc component
                 if 'anc' in d.keys():
-                    eigvals_anc = jnp.linalg.eigh(self.ntk_fn.get_ntk(jac1=jac_anc, jac2=jac_anc))[0]
+                    eigvals_anc = eig_seg('anc')
                 else:
                     eigvals_anc = None
             else:
@@ -189,14 +442,13 @@ class EigenvaluePointSelector(NTKBasedAL):
                 eigvals_bcs = None
                 eigvals_anc = None
 
-            # Compute combined jacs
-            jacs = {k: jnp.concatenate([jc[k] for jc in jacs_sep], axis=0) for k in jac_pde.keys()}
-
             return jacs, eigvals_res, eigvals_bcs, eigvals_anc
 
-        def get_jac_clean_scaled(self,d, normalise_N = self.normalise_N, lr_cap = self.lr_cap, inplace = True):
+        def get_jac_clean_scaled(self, plan, normalise_N = self.normalise_N, lr_cap = self.lr_cap, inplace = True):
         # normalise_N: normalise eigenvalues by number of points
         # lr_cap: cap learning rate at 1/lambda_max
+        # plan: NTKPlan of the points, the weighted jacobian and statistics are rescaled from its unweighted ones
+            d = plan.d
             loss_w_pde = self.loss_w_pde
             loss_w_bcs = self.loss_w_bcs
             loss_w_anc = self.loss_w_anc
@@ -208,7 +460,14 @@ class EigenvaluePointSelector(NTKBasedAL):
             loss_w_bcs = [1.0 for i in range(len(d['bcs']))]
             loss_w_anc = 1.0
 
-            _, eigvals_res, eigvals_bcs, eigvals_anc = get_jacs_and_eigvals(self,d,loss_w_pde = loss_w_pde, loss_w_bcs = loss_w_bcs, loss_w_anc=loss_w_anc, get_eigvals=True)
+            # only the largest eigenvalue of each component is used (max scaling, lr_cap), kept as a length-1 array.
+            # NTK traces are the squared norms of the jacobian rows, so they stay exact with the top-k eig solvers
+            st = plan.stats()
+            eigvals_res = st['res']['lambda_max'].reshape(1)
+            eigvals_bcs = [st[f'bcs_{i}']['lambda_max'].reshape(1) for i in range(len(d['bcs']))]
+            eigvals_anc = st['anc']['lambda_max'].reshape(1) if has_anc else None
+            tr = {name: st[name]['trace'] for name in st}
+            trace_bcs = [tr[f'bcs_{i}'] for i in range(len(d['bcs']))]
 
             # Compute number of residual and boundary points for normalising
             num_res = float(d['res'].shape[0])
@@ -217,11 +476,11 @@ class EigenvaluePointSelector(NTKBasedAL):
 
             # Scaling by using the max eigenvalue of the NTK matrix
             if self.scale == 'trace':
-                print(f'trace_res = {jnp.sum(eigvals_res)}, trace_bcs = {[float(jnp.sum(b)) for b in eigvals_bcs]}, trace_anc = {jnp.sum(eigvals_anc) if has_anc else None}')
+                print(f'trace_res = {tr["res"]}, trace_bcs = {[float(b) for b in trace_bcs]}, trace_anc = {tr["anc"] if has_anc else None}')
                 print(f"Warning: full scaling including lr dependency not implemented yet.")
-                loss_w_bcs = [float((jnp.sum(eigvals_res)/jnp.sum(b))**0.5) for b in eigvals_bcs]
+                loss_w_bcs = [float((tr['res']/b)**0.5) for b in trace_bcs]
                 if has_anc:
-                    loss_w_anc = float((jnp.sum(eigvals_res)/jnp.sum(eigvals_anc))**0.5)
+                    loss_w_anc = float((tr['res']/tr['anc'])**0.5)
                 else:
                     loss_w_anc = self.loss_w_anc
                     
@@ -277,32 +536,44 @@ class EigenvaluePointSelector(NTKBasedAL):
                 self.loss_w_bcs = loss_w_bcs
                 self.loss_w_pde = loss_w_pde
                 self.loss_w_anc = loss_w_anc
-            # Now computing the combined jacobian as per usual
-                jacs, eigvals_res, eigvals_bcs, eigvals_anc = get_jacs_and_eigvals(self, d)
-                print('After scaling:')
-                print(f'trace_res = {jnp.sum(eigvals_res)}, trace_bcs = {[float(jnp.sum(b)) for b in eigvals_bcs]}, trace_anc = {jnp.sum(eigvals_anc) if has_anc else None}')
-                print(f'max_res = {jnp.max(eigvals_res)}, max_bcs = {[float(jnp.max(b)) for b in eigvals_bcs]}, max_anc = {jnp.max(eigvals_anc) if has_anc else None}')                
-                return jacs
+            # the combined jacobian and the statistics after scaling follow from the unweighted ones
+            weights = plan.weights(loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde, loss_w_anc=loss_w_anc)
+            st = plan.stats(weights)
+            print('After scaling:')
+            print(f'trace_res = {st["res"]["trace"]}, trace_bcs = {[float(st[f"bcs_{i}"]["trace"]) for i in range(len(d["bcs"]))]}, trace_anc = {st["anc"]["trace"] if has_anc else None}')
+            print(f'max_res = {st["res"]["lambda_max"]}, max_bcs = {[float(st[f"bcs_{i}"]["lambda_max"]) for i in range(len(d["bcs"]))]}, max_anc = {st["anc"]["lambda_max"] if has_anc else None}')
+            if inplace:
+                return plan.get_jac(weights)
             else:
-                jacs, eigvals_res, eigvals_bcs, eigvals_anc = get_jacs_and_eigvals(self,d, loss_w_pde=loss_w_pde, loss_w_bcs=loss_w_bcs, loss_w_anc=loss_w_anc)
-                print('After scaling:')
-                print(f'trace_res = {jnp.sum(eigvals_res)}, trace_bcs = {[float(jnp.sum(b)) for b in eigvals_bcs]}, trace_anc = {jnp.sum(eigvals_anc) if has_anc else None}')
-                print(f'max_res = {jnp.max(eigvals_res)}, max_bcs = {[float(jnp.max(b)) for b in eigvals_bcs]}, max_anc = {jnp.max(eigvals_anc) if has_anc else None}')                
-                return jacs, loss_w_bcs, loss_w_pde
+                return plan.get_jac(weights), loss_w_bcs, loss_w_pde
 
         # Choosing the relevant jacobian computation based on whether scaling is turned on
 
         # TODO to optimize
         # jacs = jax.lax.cond(self.scale, get_jac_clean_scaled, get_jac_clean, (self,d)) 
-        if self.scale != 'none':
-            jacs = get_jac_clean_scaled(self, d, inplace=True)
+        use_kernel = self._can_compile(d, sketch)
+        if self.compiled and not use_kernel:
+            print('Warning: configuration not supported by the compiled selection kernel, using the default path')
+        if use_kernel:
+            # jacobians, NTK and eigenpairs are all computed inside the kernel at the selection step below
+            jacs = K_train = eigvals = eigvects = None
         else:
-            jacs = get_jacs_and_eigvals(self, d, get_eigvals=False)[0]
-
-        # Compute NTK and get eigenvalues and eigenvectors
-        # TODO to make use of only top eigenvalues
-        K_train = self.ntk_fn.get_ntk(jac1=jacs, jac2=jacs)
-        eigvals, eigvects = jnp.linalg.eigh(K_train + self.eps_ntk * jnp.eye(K_train.shape[0]))
+            # one jacobian pass over the base points, the loss weights (and rescaling) are applied to it analytically
+            plan = NTKPlan(self.ntk_fn, d, sketch=sketch)
+            if self.scale != 'none':
+                get_jac_clean_scaled(self, plan, inplace=True)
+            train_weights = plan.weights(loss_w_bcs=self.loss_w_bcs, loss_w_pde=self.loss_w_pde, loss_w_anc=self.loss_w_anc)
+            jacs = plan.get_jac(train_weights)
+
+            # Compute NTK and get eigenvalues and eigenvectors
+            if self.eig_solver == 'eigh':
+                K_train = plan.get_ntk(train_weights)
+                eigvals, eigvects = jnp.linalg.eigh(K_train + self.eps_ntk * jnp.eye(K_train.shape[0]))
+            else:
+                # only the leading eigenpairs, with K applied through the flat jacobian instead of being formed
+                K_train = self.ntk_fn.gram_operator(jacs)
+                eigvals, eigvects = eigh_top_k(K_train, k=self.eig_k, method=self.eig_solver)
+                eigvals = eigvals + self.eps_ntk
         
 
         # ============================ Sampling for candidate points ===========================================
@@ -387,9 +658,32 @@ class EigenvaluePointSelector(NTKBasedAL):
         # ===================== Computing the eigenvalues of the candidate K =====================
 
         # Computing the Jacobian of the test points
-        jacs_t = get_jacs_and_eigvals(self,dict_test_pts, get_eigvals=False)[0]
-
-        K_train_test = self.ntk_fn.get_ntk(jac1=jacs, jac2=jacs_t)
+        if use_kernel:
+            jacs_t = None
+            K_train_test = None
+        elif self.jac_store_dir is not None:
+            # out of core: the candidate jacobian lives on disk and K_train_test is accumulated block by block
+            jacs_t = self.ntk_fn.get_jac_store(
+                dict_test_pts, path=self.jac_store_dir, sketch=sketch,
+                loss_w_bcs=self.loss_w_bcs, loss_w_pde=self.loss_w_pde, loss_w_anc=self.loss_w_anc
+            )
+            K_train_test = self.ntk_fn.get_ntk_store(jac1=jacs, store=jacs_t)
+            print(f'Candidate jacobians stored in {jacs_t.path}, shape {jacs_t.shape}')
+            if not self.keep_jac_store:
+                jacs_t.delete()
+                jacs_t = None
+        elif (self.ntk_fn.chunk_size is None) or (sketch is not None):
+            # sketched jacobians only have s columns, so the candidates can be held at once
+            # (the candidate rows are not cached)
+            jacs_t = get_jacs_and_eigvals(self,dict_test_pts, get_eigvals=False, cache=False)[0]
+            K_train_test = self.ntk_fn.get_ntk(jac1=jacs, jac2=jacs_t)
+        else:
+            # accumulate K_train_test chunk by chunk, without ever holding all candidate jacobians
+            jacs_t = None
+            K_train_test = self.ntk_fn.get_ntk_chunked(
+                jac1=jacs, xs2=dict_test_pts,
+                loss_w_bcs=self.loss_w_bcs, loss_w_pde=self.loss_w_pde, loss_w_anc=self.loss_w_anc
+            )
 
         # TODO to eventually refactor. ------------------------------
         # Note: xs cannot be a dictionary
@@ -432,6 +726,11 @@ class EigenvaluePointSelector(NTKBasedAL):
             return residual
 
 
+        def seg_weight_vector(d):
+            # current loss weights indexed by PointSet segment id (res, bcs_i, anc)
+            w = segment_weights(d, loss_w_bcs=self.loss_w_bcs, loss_w_pde=self.loss_w_pde, loss_w_anc=self.loss_w_anc)
+            return jnp.array(list(w.values()) + ([] if 'anc' in d.keys() else [1.]), dtype=jnp.float32)
+
         residual_train = compute_residual(d)
         residual = compute_residual(dict_test_pts)
 
@@ -458,23 +757,24 @@ class EigenvaluePointSelector(NTKBasedAL):
                 
             elif P_method == 'eigvals':
                 # Now trying again with weighting by eigenvalues
-                P = jnp.diag(eigvals_chopped) @ eigvects_chopped.T @ K_train_test
+                P = eigvals_chopped[:, None] * (eigvects_chopped.T @ K_train_test)
                 
             elif P_method == 'labels':
                 # print(f"Residual shape: {residual.shape}")
                 # print(f"train test shape: {K_train_test.shape}")
-                P = jnp.diag(eigvals_chopped) @ eigvects_chopped.T @ K_train_test @ jnp.diag(residual)
+                P = eigvals_chopped[:, None] * (eigvects_chopped.T @ K_train_test) * residual[None, :]
                 
             elif P_method == 'alignment':
                 # print(f"Residual shape: {residual.shape}")
                 # print(f"train test shape: {K_train_test.shape}")
-                P = jnp.diag(1. / (eigvals_chopped ** 0.5)) @ eigvects_chopped.T @ K_train_test @ jnp.diag(residual)
+                P = (eigvects_chopped.T @ K_train_test) * residual[None, :] / (eigvals_chopped ** 0.5)[:, None]
 
             elif P_method == 'alignment_norm':
                 # print(f"Residual shape: {residual.shape}")
                 # print(f"train test shape: {K_train_test.shape}")
-                P_full = jnp.diag(1. / (eigvals_chopped ** 0.5)) @ eigvects_chopped.T @ K_train_test @ jnp.diag(residual)
-                P = P_full * jnp.mean(residual * (eigvects_chopped.T @ K_train_test), axis=1)[:, None]
+                proj = eigvects_chopped.T @ K_train_test
+                P_full = proj * residual[None, :] / (eigvals_chopped ** 0.5)[:, None]
+                P = P_full * jnp.mean(residual * proj, axis=1)[:, None]
 
             elif P_method == 'nystrom_wo_N':
                 # P = eigvects_chopped.T @ K_train_test @ jnp.diag(residual)
@@ -490,7 +790,7 @@ class EigenvaluePointSelector(NTKBasedAL):
 
             elif P_method == 'labels_train':
                 print(eigvects_chopped.shape, eigvals_chopped.shape, compute_residual(d).shape, K_train_test.shape)
-                P = jnp.diag(eigvects_chopped.T @ compute_residual(d)) @ jnp.diag(eigvals_chopped) @ eigvects_chopped.T @ K_train_test
+                P = ((eigvects_chopped.T @ compute_residual(d)) * eigvals_chopped)[:, None] * (eigvects_chopped.T @ K_train_test)
                 # P = jnp.diag(eigvects_chopped.T @ compute_residual(d)) @ jnp.diag((1 - jnp.exp(-1. * eigvals_chopped)) / eigvals_chopped) @ eigvects.T @ K_train_test
 
             elif P_method == 'residue' or P_method == 'inverted_residue':
@@ -504,26 +804,10 @@ class EigenvaluePointSelector(NTKBasedAL):
 
 
         def consruct_training_set_from_idx(d, idx):
-            max_idx_res = d['res'].shape[0]
-            # Reconstruct the flattened dic
-            # test_pts_new = self.filter_dict(d,idx)
-            test_pts_new = dict()
-            res_idx = idx[idx < max_idx_res]
-            test_pts_new['res'] = d['res'][res_idx]
-            # print('res_idx =', res_idx)
-            test_pts_new['bcs'] = []
-            idx_start = max_idx_res
-            for i, bc in enumerate(d['bcs']):
-                j =  bc.shape[0]
-                bc_idx = idx[(idx_start <= idx) & (idx < (idx_start + j))] - idx_start
-                # print(f'bc_idx_{i} = {bc_idx}')
-                bc_pts = bc[bc_idx]
-                test_pts_new['bcs'].append(bc_pts) #TODO: this could be an issue
-                idx_start += j
-            if self.select_anchor and ('anc' in d.keys()):
-                anc_idx = idx[idx_start <= idx] - idx_start
-                # print(f'anc_idx = {anc_idx}')
-                test_pts_new['anc'] = d['anc'][anc_idx]
+            # Reconstruct the flattened dict. anchors are only kept if they are being selected
+            test_pts_new = PointSet.from_dict(d).gather(idx).to_dict()
+            if not (self.select_anchor and ('anc' in d.keys())):
+                test_pts_new.pop('anc', None)
             
             # Print number of test points selected with breakdown by type res or bcs
             print(f"Number of test points selected in round: res: {test_pts_new['res'].shape[0]}, "
@@ -538,8 +822,9 @@ class EigenvaluePointSelector(NTKBasedAL):
             max_idx_res = d['res'].shape[0]
             print(f"min_num_points_res is {min_num_points_res}")
             # print(f'Have {max_idx_res} res points, picking top {min_num_points_res} now.')
-            _ ,idx_res = jax.lax.top_k(P_rowsum[:max_idx_res], min_num_points_res)
-            remaining_budget = num_points - min_num_points_res
+            # (the minimums are capped by the number of candidates, the rest of the budget goes to the best points)
+            _ ,idx_res = jax.lax.top_k(P_rowsum[:max_idx_res], min(min_num_points_res, max_idx_res))
+            remaining_budget = num_points - idx_res.shape[0]
             idx_bcs_list = []
             idx_start = max_idx_res
             for i, bc in enumerate(d['bcs']):
@@ -547,10 +832,10 @@ class EigenvaluePointSelector(NTKBasedAL):
                 # print(f'Have {j} bcs type {i+1} points at index {idx_start} to {idx_start + j}, picking top {self.min_num_points_bcs} now.')
                 idx_bcs_list.append(jax.lax.top_k(
                     P_rowsum[idx_start:idx_start+j], 
-                    min_num_points_bcs
+                    min(min_num_points_bcs, j)
                 )[1] + idx_start)
                 idx_start += j
-                remaining_budget -= min_num_points_bcs
+                remaining_budget -= idx_bcs_list[-1].shape[0]
                 
             
             num_anc = d['anc'].shape[0] if (self.select_anchor and ('anc' in d.keys())) else 0
@@ -579,32 +864,28 @@ class EigenvaluePointSelector(NTKBasedAL):
         
         
         def do_kmeans(P, d, min_num_points_res, min_num_points_bcs, num_points):
-            P_arr = np.array(P.T)
-            n = P_arr.shape[0]
+            # k-means++ seeds (optionally refined with mini-batch Lloyd) on the device, ranked in the order they were picked
+            n = P.shape[1]
             clusters = min(n, 5 * num_points)
-            _, idx_ranking = kmeans_plusplus(P_arr, n_clusters=clusters)
-            point_score = np.zeros(shape=(n,))
+            idx_ranking = kmeans_ranking(sampling_key(), jnp.asarray(P).T, clusters, n_iters=self.kmeans_iters,
+                                         batch_size=self.kmeans_batch_size)
+            point_score = jnp.zeros((n,)).at[idx_ranking].set(n - jnp.arange(idx_ranking.shape[0], dtype=jnp.float32))
             print(f'Ranked all points with k-means, top 10 points are {idx_ranking[:10]}')
-            for i, p in enumerate(idx_ranking):
-                point_score[p] = float(n - i)
             return top_k_points(
-                jnp.array(point_score), d,
+                point_score, d,
                 min_num_points_res=min_num_points_res, 
                 min_num_points_bcs=min_num_points_bcs, 
                 num_points=num_points,
             )
             
         def do_sampling(P, d, min_num_points_res, min_num_points_bcs, num_points):
-            probs = np.array(jnp.linalg.norm(P, axis=0)**2) + 1e-9
+            probs = jnp.linalg.norm(P, axis=0)**2 + 1e-9
             n = probs.shape[0]
             clusters = min(n, 5 * num_points)
+            # the first clusters points of a weighted draw without replacement, ranked in the order they are drawn
+            idx_order = np.asarray(gumbel_top_k(sampling_key(), probs, clusters))
             point_score = np.zeros(shape=(n,))
-            idx_order = []
-            for i in range(clusters):
-                p = random.choices(population=list(range(n)), weights=probs)[0]
-                point_score[p] = float(n - i)
-                probs[p] = 0.
-                idx_order.append(p)
+            point_score[idx_order] = n - np.arange(clusters, dtype=float)
             print(f'Ranked all points with sampling, top 10 points are {idx_order[:10]}')
             return top_k_points(
                 jnp.array(point_score), d,
@@ -612,10 +893,41 @@ class EigenvaluePointSelector(NTKBasedAL):
                 min_num_points_bcs=min_num_points_bcs, 
                 num_points=num_points,
             )
-            
 
-        P = scoring_function(eigvects,eigvals,K_train_test,residual,self.weight_method)
-        print(f"Computed the scoring function P, shape = {P.shape}")
+        def do_dpp(P, d, min_num_points_res, min_num_points_bcs, num_points):
+            # diverse batch: greedy MAP of the DPP with kernel P.T @ P, i.e. the candidates' score vectors
+            pts = PointSet.from_dict(d)
+            seg_ids = pts.seg_ids
+            use_anc = self.select_anchor and pts.has_anc
+            allowed_main = seg_ids != pts.anc_id
+            n_main = min(num_points, int(allowed_main.sum()))
+            n_anc = min(self.anchor_budget, int(pts.counts()[pts.anc_id])) if use_anc else 0
+            min_counts = np.array([min_num_points_res] + [min_num_points_bcs] * pts.n_bcs + [0], dtype=np.int32)
+            idx = _dpp_greedy(
+                jnp.asarray(P), n_main + n_anc, jnp.asarray(seg_ids),
+                jnp.asarray(allowed_main), jnp.asarray(seg_ids == pts.anc_id), n_main, jnp.asarray(min_counts),
+            )
+            print(f'Selected {n_main} points (and {n_anc} anchors) with DPP, first 10 points are {idx[:10]}')
+            idx = jnp.sort(idx)
+            return idx, consruct_training_set_from_idx(d, idx)
+
+
+        # greedy selection only needs the column norms of P, which the streaming scorer computes for the weight
+        # method and any further score_methods in one pass. the other selection methods need P itself
+        stream = (not use_kernel) and (self.selection_method == 'greedy') and (self.weight_method in STREAMING_WEIGHT_METHODS)
+        score_methods = [m for m in self.score_methods if m != self.weight_method]
+        if stream:
+            score_methods = [self.weight_method] + score_methods
+        scores = None
+        if (not use_kernel) and (len(score_methods) > 0):
+            scores = stream_scores(eigvects, eigvals, K_train_test, residual, score_methods, self.eps_ntk,
+                                   residual_train=residual_train, block_size=self.score_block_size)
+            print(f"Computed the column norms of P for {score_methods}")
+        if stream:
+            P = None
+        elif not use_kernel:
+            P = scoring_function(eigvects,eigvals,K_train_test,residual,self.weight_method)
+            print(f"Computed the scoring function P, shape = {P.shape}")
         
         if (not self.memory) and (self.current_samples is not None) and ('anc' in self.current_samples.keys()) and (self.current_samples['anc'] is not None) and (self.current_samples['anc'].shape[0] > 0):
             num_anc = self.current_samples['anc'].shape[0]
@@ -623,8 +935,14 @@ class EigenvaluePointSelector(NTKBasedAL):
         else:
             num_points = self.num_points_round
 
-        if self.selection_method == 'greedy':
-            P_rowsum = jnp.linalg.norm(P, axis=0)
+        if use_kernel:
+            print("Selecting the top k points greedily (compiled kernel)")
+            idx, P, jacs, eigvals, eigvects = self._select_compiled(d, dict_test_pts, num_points)
+            test_pts_new = consruct_training_set_from_idx(dict_test_pts, idx)
+            K_train = None
+
+        elif self.selection_method == 'greedy':
+            P_rowsum = scores[self.weight_method] if stream else jnp.linalg.norm(P, axis=0)
             print("Selecting the top k points greedily")
             idx, test_pts_new = top_k_points(
                 P_rowsum, dict_test_pts,
@@ -653,22 +971,22 @@ class EigenvaluePointSelector(NTKBasedAL):
                 # num_points=self.num_points_round,
                 num_points=num_points,
             )
-        
+
+        elif self.selection_method == 'dpp':
+            print("Selecting the top k points using greedy DPP MAP")
+            idx, test_pts_new = do_dpp(
+                P, dict_test_pts,
+                min_num_points_res=self.min_num_points_res,
+                min_num_points_bcs=self.min_num_points_bcs,
+                num_points=num_points,
+            )
+
         else:
             raise ValueError(f'Invalid selection_method {self.selection_method}')
 
         # to update training samples with new points. Works if init_pts is not empty
         def update_pts(init_pts, new_pts):
-            returned_pts = init_pts.copy()
-            returned_pts['res'] = jnp.concatenate([init_pts['res'], new_pts['res']], axis=0)
-            for i in range(len(new_pts['bcs'])):
-                if new_pts['bcs'][i].size != 0:
-                    returned_pts['bcs'][i] = jnp.concatenate([init_pts['bcs'][i], new_pts['bcs'][i]], axis=0)
-            if 'anc' in init_pts.keys() and (init_pts['anc'].shape[0] > 0) and 'anc' in new_pts.keys() and (new_pts['anc'].shape[0] > 0):
-                returned_pts['anc'] = jnp.concatenate([init_pts['anc'], new_pts['anc']], axis=0)
-            elif 'anc' in new_pts.keys() and (new_pts['anc'].shape[0] > 0):
-                returned_pts['anc'] = new_pts['anc']
-            return returned_pts
+            return PointSet.concat([PointSet.from_dict(init_pts), PointSet.from_dict(new_pts)]).to_dict()
 
 
         # 'random' method to use np.random.choice to choose subset of points
@@ -693,17 +1011,10 @@ class EigenvaluePointSelector(NTKBasedAL):
                 print("Using all points as memory points")
                 matrix = d
             elif self.mem_refine_selection_method == 'random':
-                matrix = {
-                    'res': None,
-                    'bcs': []
-                }
                 print("Using random to choose memory points")
-                idx = np.random.choice(d['res'].shape[0], int(np.floor(d['res'].shape[0]*mem_pts_ratio)), replace=False)
-                matrix['res'] = d['res'][idx]
-                for i in range(len(d['bcs'])):
-                    if d['bcs'][i].size != 0:
-                        idx = np.random.choice(d['bcs'][i].shape[0], int(np.floor(d['bcs'][i].shape[0]*mem_pts_ratio)), replace=False)
-                        matrix['bcs'].append(d['bcs'][i][idx])
+                segments = ['res'] + [f'bcs_{i}' for i in range(len(d['bcs']))]
+                matrix = PointSet.from_dict(d).random_subset(mem_pts_ratio, segments=segments).to_dict()
+                matrix.pop('anc', None)
             # else:
             #     print(f"Using {self.mem_refine_weight_method} scoring and {self.mem_refine_selection_method} to choose memory points")
             #     # repeat K_train computation here
@@ -778,19 +1089,26 @@ class EigenvaluePointSelector(NTKBasedAL):
               f"BCS: {[returned_pts['bcs'][i].shape[0] for i in range(len(returned_pts['bcs']))]}, "
               f"Anchors: {returned_pts['anc'].shape[0] if 'anc' in returned_pts.keys() else 0}")
 
+        # loss weights (by segment id) the candidate jacobians were computed with
+        cand_weights = seg_weight_vector(dict_test_pts)
+        plan_returned = None
         if self.scale!='none':
             print('---------------------\nScaling for training:')
-            _  = get_jac_clean_scaled(self,returned_pts, inplace=True) # self.loss_w_bcs and self.loss_w_pde are updated in place
+            plan_returned = NTKPlan(self.ntk_fn, returned_pts, sketch=sketch)
+            _  = get_jac_clean_scaled(self, plan_returned, inplace=True) # self.loss_w_bcs and self.loss_w_pde are updated in place
 
         # Compute projection of labels and eigvectors
-        def compute_projection(new_pts):
-            jacs_new_pts = get_jacs_and_eigvals(self, new_pts, get_eigvals=False)[0]
+        def compute_projection(new_pts, plan=None):
+            if plan is not None:
+                jacs_new_pts = plan.get_jac(plan.weights(loss_w_bcs=self.loss_w_bcs, loss_w_pde=self.loss_w_pde, loss_w_anc=self.loss_w_anc))
+            else:
+                jacs_new_pts = get_jacs_and_eigvals(self, new_pts, get_eigvals=False)[0]
             K_train_new_pts = self.ntk_fn.get_ntk(jac1=jacs, jac2=jacs_new_pts)
             # print(f"K_train_new_pts shape is {K_train_new_pts.shape}")
             # print(f"compute_residual(new_pts) shape is {compute_residual(new_pts).shape}")
             # print(f"eigvects.T shape is {eigvects.T.shape}")
             a = (eigvects.T @ K_train_new_pts)@ compute_residual(new_pts)
-            a_top, a_idx = jax.lax.top_k(a,15)
+            a_top, a_idx = jax.lax.top_k(a, min(15, a.shape[0]))
             label_info_new_pts = {
                 'a':a,
                 'a_top':a_top,
@@ -800,10 +1118,21 @@ class EigenvaluePointSelector(NTKBasedAL):
             return label_info_new_pts
 
         # Calculating this for new points and returned points
-        label_info_new_pts = compute_projection(test_pts_new)
+        if K_train_test is not None:
+            # the new points are columns of K_train_test, rescaled from the candidate to the current loss weights
+            seg_ids = PointSet.from_dict(dict_test_pts).seg_ids
+            idx_new = np.asarray(idx)
+            if not (self.select_anchor and ('anc' in dict_test_pts.keys())):
+                idx_new = idx_new[seg_ids[idx_new] != len(dict_test_pts['bcs']) + 1]
+            ratio = (seg_weight_vector(dict_test_pts) / cand_weights)[seg_ids[idx_new]]
+            a = eigvects.T @ (K_train_test[:, idx_new] @ (ratio * residual[idx_new]))
+            a_top, a_idx = jax.lax.top_k(a, min(15, a.shape[0]))
+            label_info_new_pts = {'a': a, 'a_top': a_top, 'a_idx': a_idx, 'a_norm': jnp.linalg.norm(a)}
+        else:
+            label_info_new_pts = compute_projection(test_pts_new)
         # print(f"len of a_idx is {len(label_info_new_pts['a_idx'])}, and len of a_top is {len(label_info_new_pts['a_top'])}")
         # print(f"Top 15 coeff and corresponding eigvectors index for new points: {label_info_new_pts['a_idx']} out of {len(label_info_new_pts['a'])}, values are: {label_info_new_pts['a_top']}")
-        label_info_returned_pts = compute_projection(returned_pts)
+        label_info_returned_pts = compute_projection(returned_pts, plan=plan_returned)
         # print(f"Top 15 coeff and corresponding eigvectors index for returned points: {label_info_returned_pts['a_idx']} out of {len(label_info_returned_pts['a'])}, values are: {label_info_returned_pts['a_top']}")
 
         # Return dictionary of all relevant data for logging
@@ -812,8 +1141,10 @@ class EigenvaluePointSelector(NTKBasedAL):
             'eigvals': eigvals,
             'eigvects': eigvects,
             'P': P,
+            'scores': scores,
             'jac_train': jacs,
             'jac_candidates': jacs_t,
+            'sketch': sketch,
             'K_train_test': K_train_test,
             'NTK': K_train,
             'candidate_pts': dict_test_pts,
@@ -829,8 +1160,17 @@ class EigenvaluePointSelector(NTKBasedAL):
             'label_info_returned_pts': label_info_returned_pts,
         }
         
-        for k in logging_dict:
-            logging_dict[k] = to_cpu(logging_dict[k])
+        # only the intermediates of the log level are kept, large arrays spilled to disk if a spill directory is set.
+        # stores stay on disk (and pickle as a reference to their file)
+        logging_dict = ALLog.from_dict(logging_dict, level=self.log_level, spill_dir=self.log_spill_dir,
+                                       spill_min_bytes=self.log_spill_min_bytes)
+        if isinstance(jacs_t, JacobianStore) and ('jac_candidates' not in logging_dict):
+            jacs_t.delete()
+
+        print(f"Jacobian cache: {self.ntk_fn.cache_stats['hits'] - cache_stats_start['hits']} rows reused, "
+              f"{self.ntk_fn.cache_stats['misses'] - cache_stats_start['misses']} rows computed")
+        # the helper may be shared with the loop, whose next use is at new parameters: do not hold on to the rows
+        self.ntk_fn.clear_cache()
 
         return returned_pts, logging_dict
 
@@ -15,7 +15,7 @@ import optax
 
 from .. import deepxde as dde
 
-from ..ntk import NTKHelper
+from ..ntk import NTKHelper, JacobianBlock
 from ..icbc_patch import constrain_domain, constrain_ic, constrain_bc
 from .al_pinn import PointSelector
 
@@ -26,7 +26,9 @@ class NTKBasedAL(PointSelector):
                  inverse_problem: bool = False, current_samples: dict = None, 
                  anchor_budget: int = 0, anc_point_filter=None, anc_idx=None,
                  mem_pts_total_budget: int  = None, min_num_points_bcs: int = 0, min_num_points_res: int = 0,
-                 loss_w_bcs: float = 1., loss_w_pde: float = 1., loss_w_anc: float = 1., optim_lr: float = 1e-3, enforce_budget: bool =True):
+                 loss_w_bcs: float = 1., loss_w_pde: float = 1., loss_w_anc: float = 1., optim_lr: float = 1e-3, enforce_budget: bool =True,
+                 jac_chunk_size: int = None, jac_mem_budget: int = None, jac_mode: str = 'rev', jac_devices: int = None, points_pool=None,
+                 ntk_helper: NTKHelper = None):
         super().__init__(model=model, inverse_problem=inverse_problem, current_samples=current_samples, 
                          anchor_budget=anchor_budget, anc_point_filter=anc_point_filter, anc_idx=anc_idx,
                          mem_pts_total_budget=mem_pts_total_budget, min_num_points_bcs=min_num_points_bcs, min_num_points_res=min_num_points_res, 
@@ -37,23 +39,35 @@ class NTKBasedAL(PointSelector):
         self.eig_min = eig_min
         self.points_pool_size = points_pool_size
         
-        self.points_pool = jnp.array(self.data.geom.random_points(points_pool_size, random='pseudo'))
-        self.ntk_fn = NTKHelper(model=model, inverse_problem=inverse_problem)
+        # points_pool doubles as the Nystrom landmark set. it can be passed in so that the same landmarks are reused
+        # across AL rounds (the selectors are rebuilt every round)
+        if points_pool is None:
+            points_pool = self.data.geom.random_points(points_pool_size, random='pseudo')
+        self.points_pool = jnp.array(points_pool)
+        # a shared helper keeps its jacobian cache across selectors, as long as the network parameters do not change
+        if ntk_helper is not None:
+            self.ntk_fn = ntk_helper
+        else:
+            self.ntk_fn = NTKHelper(model=model, inverse_problem=inverse_problem, chunk_size=jac_chunk_size, mem_budget=jac_mem_budget,
+                                   jac_mode=jac_mode, devices=jac_devices)
         # self.jac_all, self.K_fullrank, self.K_reducedrank = self._precompute_pool(eig_min=eig_min) # Not used anymore
         # self.active_eig = active_eig if active_eig else int(jnp.sum(self._use_eig))
+        self.active_eig = active_eig
+        self.nystrom_map = None
         
         self.get_K_subset = None
         self.constrain = None
         self._prepare_functions()
         
     def _precompute_pool(self, eig_min):
-        jac_pde = self.ntk_fn.get_jac(jnp.array(self.points_pool), code=-1)
+        # Nystrom factorisation on the landmarks, i.e. the PDE residue and output rows at points_pool. needs to be
+        # redone whenever the network parameters change, so once per AL round
+        jac_pde = self.ntk_fn.get_jac(jnp.array(self.points_pool), code=-1, flat=True)
         # jac_bcs = [self.ntk_fn.get_jac(jnp.array(self.points_pool), code=i)
         #            for i in range(len(self.bcs))]
         # jacs = [jac_pde] + jac_bcs
-        jac_u = self.ntk_fn.get_jac(jnp.array(self.points_pool), code=-2)
-        jacs = [jac_pde, jac_u]
-        jac_all = {k: jnp.concatenate([jc[k] for jc in jacs], axis=0) for k in jac_pde.keys()}
+        jac_u = self.ntk_fn.get_jac(jnp.array(self.points_pool), code=-2, flat=True)
+        jac_all = JacobianBlock.concatenate([jac_pde, jac_u], names=['res', 'anc'])
 
         K_fullrank = self.ntk_fn.get_ntk(jac1=jac_all, jac2=jac_all)
         Lambda, Q = jnp.linalg.eigh(K_fullrank)
@@ -65,29 +79,29 @@ class NTKBasedAL(PointSelector):
         self._fullrank_Q = Q
         self._use_eig = use_eig
         
+        # (P, r) map with K(X, L) K(L, L)^+ K(L, Y) = (J_X B) (J_Y B)^T, so that J_X B are the Nystrom features of X.
+        # it is used like a sketch, so the features come from JVPs and J_X itself is never formed
+        self.nystrom_map = jac_all.jac.T @ (Q_sub / jnp.sqrt(L_sub))
+        print(f'Nystrom landmarks: {jac_all.shape[0]} rows, rank {int(jnp.sum(use_eig))}')
+        
         return jac_all, K_fullrank, K_reducedrank
     
     def _prepare_functions(self):
                     
         def _get_K_subset(d):
+            # Nystrom approximation of the NTK of d through the landmarks, with its leading eigenpairs
 
-            jac_pde = self.ntk_fn.get_jac(d['res'], code=-1)
-            jac_bcs = [self.ntk_fn.get_jac(d['bcs'][i], code=i) for i in range(len(d['bcs']))]
-            
-            jacs_sep = [jac_pde] + jac_bcs
-            jacs = {k: jnp.concatenate([jc[k] for jc in jacs_sep], axis=0) for k in jac_pde.keys()}
+            if self.nystrom_map is None:
+                self._precompute_pool(eig_min=self.eig_min)
+            feats = self.ntk_fn.get_jac_clean(d, sketch=self.nystrom_map)
                         
-            T_t = self.ntk_fn.get_ntk(jac1=jacs, jac2=jacs)
-            eigvals, eigvects = jnp.linalg.eigh(T_t)
-            eigvals_sub = eigvals[-self.active_eig:]
-            eigvects_sub = eigvects[:,-self.active_eig:]
-            T_t_inv = eigvects_sub @ jnp.diag(1. / eigvals_sub) @ eigvects_sub.T
-            # T_t_inv = jnp.linalg.inv(T_t + eps * jnp.eye(T_t.shape[0]))
-            
-            T_nt = self.ntk_fn.get_ntk(jac1=self.jac_all, jac2=jacs)
-            K_subset = T_nt @ T_t_inv @ T_nt.T
+            K_subset = self.ntk_fn.get_ntk(jac1=feats, jac2=feats)
+            eigvals, eigvects = jnp.linalg.eigh(K_subset)
+            num_eig = eigvals.shape[0] if self.active_eig is None else self.active_eig
+            eigvals_sub = eigvals[-num_eig:]
+            eigvects_sub = eigvects[:,-num_eig:]
             
-            return K_subset, eigvals_sub, eigvects_sub, jacs
+            return K_subset, eigvals_sub, eigvects_sub, feats
             
         self.get_K_subset = _get_K_subset
             
@@ -19,6 +19,7 @@ from ..ntk import NTKHelper
 from ..icbc_patch import constrain_domain, constrain_ic, constrain_bc
 from .al_pinn import PointSelector
 from ..utils import pairwise_dist
+from ..point_set import PointSet
 
 
 class RandomPointSelector(PointSelector):
@@ -73,12 +74,11 @@ class RandomPointSelector(PointSelector):
             dist = pairwise_dist(anc_pts, anc_candidate)
             closest_pts = jnp.argmin(dist, axis=1)
             assert anc_pts.shape[0] == closest_pts.shape[0], closest_pts
-            returned_pts['anc'] = jnp.array([anc_candidate[i] for i in closest_pts])
+            returned_pts['anc'] = anc_candidate[closest_pts]
         
         if self.current_samples is not None and ('anc' in self.current_samples):
-            if self.anchor_budget > 0:
-                returned_pts['anc'] = jnp.concatenate([self.current_samples['anc'], returned_pts['anc']], axis=0)
-            else:
-                returned_pts['anc'] = self.current_samples['anc']
+            # the anchors chosen so far are kept, ahead of the new ones
+            old_anc = PointSet.from_dict(self.current_samples).select(['anc'])
+            returned_pts = PointSet.concat([old_anc, PointSet.from_dict(returned_pts)]).to_dict()
         
         return returned_pts, {'chosen_pts': returned_pts}
\ No newline at end of file
@@ -2,7 +2,6 @@ from functools import partial
 import os
 import pickle as pkl
 from collections.abc import MutableMapping
-import random
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -20,7 +19,8 @@ from ..ntk import NTKHelper
 from ..icbc_patch import (constrain_bc, constrain_domain, constrain_ic,
                           generate_residue)
 from .al_pinn import PointSelector
-from ..utils import pairwise_dist
+from ..utils import pairwise_dist, gumbel_top_k, sampling_key
+from ..point_set import PointSet
 
 
 class ResidueSelector(PointSelector):
@@ -84,15 +84,9 @@ class ResidueSelector(PointSelector):
         aux_dict['res_pool'] = res_pool
         aux_dict['residual'] = residual
         
-        probs = np.array(residual ** self.k) + self.c + 1e-9
-        n = probs.shape[0]
-        point_score = np.empty(shape=(n,))
-        points = []
-        for i in range(n_res):
-            p = random.choices(population=list(range(n)), weights=probs)[0]
-            probs[p] = 0.
-            points.append(res_pool[p])
-        returned_pts['res'] = jnp.array(points)
+        probs = residual ** self.k + self.c + 1e-9
+        idx = gumbel_top_k(sampling_key(), probs, min(n_res, probs.shape[0]))
+        returned_pts['res'] = res_pool[idx]
         
         if self.select_icbc_with_residue:
             
@@ -111,16 +105,9 @@ class ResidueSelector(PointSelector):
                     error = jnp.sum(error, axis=1)
                 icbc_details.append((xs_pool, error))
                 
-                probs = np.array(error ** self.k) + self.c + 1e-9
-                n = probs.shape[0]
-                point_score = np.empty(shape=(n,))
-                points = []
-                for i in range(n_per_bc):
-                    p = random.choices(population=list(range(n)), weights=probs)[0]
-                    probs[p] = 0.
-                    points.append(xs_pool[p])
-                    
-                returned_pts['bcs'].append(jnp.array(points))
+                probs = error ** self.k + self.c + 1e-9
+                idx = gumbel_top_k(sampling_key(), probs, min(n_per_bc, probs.shape[0]))
+                returned_pts['bcs'].append(jnp.asarray(xs_pool)[idx])
         
         else:
             
@@ -149,17 +136,10 @@ class ResidueSelector(PointSelector):
                 aux_dict['anc_pool'] = anc_pool
                 aux_dict['anc_residual'] = anc_residual
             
-                probs = np.array(anc_residual ** self.k) + self.c + 1e-9
+                probs = anc_residual ** self.k + self.c + 1e-9
                 probs = probs[:,0]
-                n = probs.shape[0]
-                point_score = np.empty(shape=(n,))
-                anc_points = []
-                for i in range(self.anchor_budget):
-                    p = random.choices(population=list(range(n)), weights=probs)[0]
-                    probs[p] = 0.
-                    anc_points.append(anc_pool[p])
-                
-                returned_pts['anc'] = jnp.array(anc_points)
+                idx = gumbel_top_k(sampling_key(), probs, min(self.anchor_budget, probs.shape[0]))
+                returned_pts['anc'] = anc_pool[idx]
                 # returned_pts['anc'] = jnp.array(self.data.geom.random_points(self.anchor_budget, random=self.method))
                 
             else:
@@ -168,19 +148,14 @@ class ResidueSelector(PointSelector):
                 dist = pairwise_dist(anc_pts, anc_candidate)
                 closest_pts = jnp.argmin(dist, axis=1)
                 assert anc_pts.shape[0] == closest_pts.shape[0], closest_pts
-                returned_pts['anc'] = jnp.array([anc_candidate[i] for i in closest_pts])
+                returned_pts['anc'] = anc_candidate[closest_pts]
         
-        if self.current_samples is not None and ('anc' in self.current_samples):
-            if self.anchor_budget > 0:
-                returned_pts['anc'] = jnp.concatenate([self.current_samples['anc'], returned_pts['anc']], axis=0)
-            else:
-                returned_pts['anc'] = self.current_samples['anc']
-                
-        # in case we can just grow collocation points however
-        if self.unlimited_colloc_pts and (self.current_samples is not None):
-            returned_pts['res'] = jnp.concatenate([self.current_samples['res'], returned_pts['res']], axis=0)
-            for i in range(len(returned_pts['bcs'])):
-                returned_pts['bcs'][i] = jnp.concatenate([self.current_samples['bcs'][i], returned_pts['bcs'][i]], axis=0)
+        if self.current_samples is not None:
+            # the anchors chosen so far are kept, ahead of the new ones.
+            # in case we can just grow collocation points however, the other points are kept too
+            keep = ['anc'] + ((['res'] + [f'bcs_{i}' for i in range(len(self.bcs))]) if self.unlimited_colloc_pts else [])
+            old_pts = PointSet.from_dict(self.current_samples).select(keep)
+            returned_pts = PointSet.concat([old_pts, PointSet.from_dict(returned_pts)]).to_dict()
                 
         aux_dict['chosen_pts'] = returned_pts
         return returned_pts, aux_dict
\ No newline at end of file
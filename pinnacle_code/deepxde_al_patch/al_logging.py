@@ -0,0 +1,111 @@
+import os
+import tempfile
+
+import numpy as np
+import jax
+
+
+# intermediates of an AL round kept at each logging level, every level includes the previous one
+LOG_LEVELS = {
+    'minimal': ['chosen_pts', 'candidate_pts', 'selected_pts_idx', 'old_points', 'new_points', 'residual_old',
+                'residual_candidates', 'new_loss_w_bcs', 'new_loss_w_pde', 'new_loss_w_anc', 'label_info_new_pts',
+                'label_info_returned_pts', 'scores'],
+    'spectrum': ['eigvals', 'eigvects', 'P'],
+    'full': ['jac_train', 'jac_candidates', 'sketch', 'K_train_test', 'NTK'],
+}
+
+
+def log_keys(level):
+    assert level in LOG_LEVELS, f'Invalid log level {level}, options are {list(LOG_LEVELS.keys())}'
+    keys = []
+    for name, k in LOG_LEVELS.items():
+        keys += k
+        if name == level:
+            return keys
+
+
+class SpilledArray:
+    """array written to a compressed .npz file, loaded when accessed. pickles as the path to its file"""
+
+    def __init__(self, path, shape=None, dtype=None):
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+
+    @staticmethod
+    def spill(x, spill_dir):
+        fd, path = tempfile.mkstemp(suffix='.npz', dir=spill_dir)
+        os.close(fd)
+        x = np.asarray(x)
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, x=x)
+        return SpilledArray(path, shape=x.shape, dtype=x.dtype)
+
+    def get(self):
+        with np.load(self.path) as f:
+            return f['x']
+
+    def __repr__(self):
+        return f'SpilledArray({self.path}, shape={self.shape}, dtype={self.dtype})'
+
+
+class ALLog(dict):
+    """dictionary of AL intermediates in which large arrays may be spilled to disk, loaded again on access
+
+    Every access path (indexing, get, pop, values, items, iteration into dict(log) or {**log}) returns the
+    loaded arrays, so the log reads like a plain dict. Use dict.pop(log, key) to drop an entry without loading it.
+    """
+
+    @staticmethod
+    def _resolve(v):
+        return v.get() if isinstance(v, SpilledArray) else v
+
+    def __getitem__(self, key):
+        return self._resolve(dict.__getitem__(self, key))
+
+    def __iter__(self):
+        # (overriding __iter__ makes dict(log) and {**log} go through keys and __getitem__)
+        return iter(list(dict.keys(self)))
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        return self._resolve(dict.pop(self, key, *default))
+
+    def popitem(self):
+        k, v = dict.popitem(self)
+        return k, self._resolve(v)
+
+    def setdefault(self, key, default=None):
+        return self._resolve(dict.setdefault(self, key, default))
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def copy(self):
+        return ALLog(dict.items(self))
+
+    def __reduce__(self):
+        # pickle the handles (spilled arrays as their path), not the loaded arrays
+        return (ALLog, (dict(dict.items(self)),))
+
+    @staticmethod
+    def from_dict(d, level='full', spill_dir=None, spill_min_bytes=2**20):
+        """log of the entries of d kept at level. arrays of at least spill_min_bytes are written to spill_dir
+        (if given), everything else is kept as is. keys not listed in any level are always kept
+        """
+        keep = log_keys(level)
+        listed = sum(LOG_LEVELS.values(), [])
+        log = ALLog()
+        for k, v in d.items():
+            if (k in listed) and (k not in keep):
+                continue
+            if (spill_dir is not None) and isinstance(v, (jax.Array, np.ndarray)) and (v.nbytes >= spill_min_bytes):
+                log[k] = SpilledArray.spill(v, spill_dir)
+            else:
+                log[k] = v
+        return log
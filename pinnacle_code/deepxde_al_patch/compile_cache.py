@@ -0,0 +1,78 @@
+import os
+import threading
+
+import jax
+from jax import monitoring
+
+
+# time spent tracing, lowering and compiling XLA programs in this process, per thread, from jax's monitoring
+# events (which fire in the thread doing the compile). compiles served from the persistent cache only count their
+# tracing and lowering
+_COMPILE_EVENTS = (
+    '/jax/core/compile/jaxpr_trace_duration',
+    '/jax/core/compile/jaxpr_to_mlir_module_duration',
+    '/jax/core/compile/backend_compile_duration',
+)
+_compile_secs = {}
+_compile_lock = threading.Lock()
+_listening = [False]
+
+
+def _listener(event, duration_secs, **kwargs):
+    if event in _COMPILE_EVENTS:
+        thread = threading.get_ident()
+        with _compile_lock:
+            _compile_secs[thread] = _compile_secs.get(thread, 0.) + duration_secs
+
+
+def track_compile_time():
+    if not _listening[0]:
+        monitoring.register_event_duration_secs_listener(_listener)
+        _listening[0] = True
+
+
+def compile_time(thread=None):
+    """seconds spent compiling since track_compile_time was first called, by the thread with identifier thread
+    (as from threading.get_ident) or by all threads if None"""
+    with _compile_lock:
+        if thread is None:
+            return sum(_compile_secs.values())
+        return _compile_secs.get(thread, 0.)
+
+
+def enable_persistent_cache(cache_dir, min_compile_secs=0.):
+    """keep compiled programs in cache_dir, so that later processes (e.g. the other runs of a sweep) load them
+    instead of compiling again. only programs that took at least min_compile_secs to compile are written. most
+    programs here are small and many, so the default caches everything
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    jax.config.update('jax_compilation_cache_dir', cache_dir)
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', min_compile_secs)
+    print(f'Persistent compilation cache in {cache_dir}')
+
+
+def memory_in_use():
+    """largest fraction of device memory in use over the local devices, None if the backend does not report it"""
+    fracs = []
+    for dev in jax.local_devices():
+        stats = dev.memory_stats()
+        if stats and stats.get('bytes_limit'):
+            fracs.append(stats['bytes_in_use'] / stats['bytes_limit'])
+    return max(fracs) if fracs else None
+
+
+def clear_caches(policy='memory', max_memory=0.8):
+    """drop jax's compiled programs (and the arrays they hold on to) according to policy
+
+    'always' clears every time, 'never' keeps everything, and 'memory' only clears when more than max_memory of
+    the device memory is in use (never on backends without memory stats, such as cpu). Returns whether it cleared.
+    """
+    assert policy in ('always', 'never', 'memory'), f'Invalid clear caches policy {policy}'
+    if policy == 'never':
+        return False
+    if policy == 'memory':
+        used = memory_in_use()
+        if (used is None) or (used <= max_memory):
+            return False
+    jax.clear_caches()
+    return True
@@ -2,6 +2,7 @@ import numpy as np
 
 from . import deepxde as dde
 from .deepxde import config
+from .point_set import PointSet
 
 
 # class DataSetterCallback(dde.callbacks.Callback):
@@ -35,6 +36,8 @@ class DataSetter:
         self.pde_data = model.data
     
     def replace_points(self, train_pts):
+        # train_pts is a PointSet or a points dictionary
+        pts = train_pts if isinstance(train_pts, PointSet) else PointSet.from_dict(train_pts)
         pd = self.pde_data
         
         pd.train_x_all = None
@@ -62,12 +65,12 @@ class DataSetter:
         #     X = np.array(list(filter(is_not_excluded, X)))
         
         # pd.train_x_all = np.vstack([np.array(x) for x in train_pts['bcs']] + [np.array(train_pts['res'])])
-        pd.train_x_all = np.array(train_pts['res'])
+        pd.train_x_all = np.array(pts.segment('res'))
         
         # pd.bc_points()  # Generate self.num_bcs and self.train_x_bc
-        bcs_pts = [np.array(x) for x in train_pts['bcs']]
-        pd.num_bcs = list(map(len, bcs_pts))
-        pd.train_x_bc = np.vstack(bcs_pts)
+        # the bc points are contiguous in the point set, in the order of the bcs
+        pd.num_bcs = pts.counts()[1:pts.n_bcs + 1].tolist()
+        pd.train_x_bc = np.array(pts.select([f'bcs_{i}' for i in range(pts.n_bcs)]).coords)
         
         # pd.train_x_all = np.array(train_pts['res'])
         if pd.pde is not None:
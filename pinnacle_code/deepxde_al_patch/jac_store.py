@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import jax.numpy as jnp
+
+
+_MAGIC = 'JACSTORE'
+_HEADER_SIZE = 4096  # bytes, the rows start at this offset so that they stay aligned
+
+
+class JacobianStore:
+    """flat (N, P) jacobian (or (N, s) sketched jacobian) kept on disk and memory mapped
+
+    The file is a fixed-size JSON header followed by the rows in row-major order with a fixed dtype. The header
+    holds the shape, the dtype and the row offsets of the segments ('res', 'bcs_0', ..., 'anc'), in the same
+    order as JacobianBlock. Rows are read back block by block, so the store can be larger than the memory.
+
+    Pickling a store only keeps the path to its file, so that snapshots hold a reference rather than the rows.
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = json.loads(f.read(_HEADER_SIZE).rstrip(b'\0').decode())
+        assert header['magic'] == _MAGIC, f'{path} is not a jacobian store'
+        self.header = header
+        self.segments = {name: tuple(s) for name, s in header['segments'].items()}
+        self._mm = np.memmap(path, dtype=np.dtype(header['dtype']), mode=mode, offset=_HEADER_SIZE,
+                             shape=tuple(header['shape']))
+
+    @staticmethod
+    def create(path, n_cols, segments, dtype=np.float32):
+        """empty store with the given (name, number of rows) segments, opened for writing
+
+        path can be a directory, in which case a new file is created in it
+        """
+        if os.path.isdir(path):
+            fd, path = tempfile.mkstemp(suffix='.jac', dir=path)
+            os.close(fd)
+        offsets, start = dict(), 0
+        for name, n in segments:
+            offsets[name] = (start, start + n)
+            start += n
+        header = {'magic': _MAGIC, 'dtype': np.dtype(dtype).str, 'shape': [start, n_cols], 'segments': offsets}
+        header = json.dumps(header).encode()
+        assert len(header) < _HEADER_SIZE, 'too many segments for the jacobian store header'
+        with open(path, 'wb') as f:
+            f.write(header.ljust(_HEADER_SIZE, b'\0'))
+            f.truncate(_HEADER_SIZE + start * n_cols * np.dtype(dtype).itemsize)
+        return JacobianStore(path, mode='r+')
+
+    @property
+    def shape(self):
+        return self._mm.shape
+
+    @property
+    def dtype(self):
+        return self._mm.dtype
+
+    def names(self):
+        return list(self.segments.keys())
+
+    def write(self, name, start, rows):
+        # rows of segment name, starting at row start within the segment
+        lo, hi = self.segments[name]
+        rows = np.asarray(rows, dtype=self.dtype)
+        assert lo + start + rows.shape[0] <= hi, f'too many rows for segment {name}'
+        self._mm[lo + start:lo + start + rows.shape[0]] = rows
+
+    def flush(self):
+        self._mm.flush()
+
+    def rows(self, name=None, as_jax=True):
+        # all rows (of one segment). these are loaded into memory, use blocks for large stores
+        lo, hi = (0, self.shape[0]) if name is None else self.segments[name]
+        rows = self._mm[lo:hi]
+        return jnp.asarray(rows) if as_jax else rows
+
+    def blocks(self, block_rows):
+        """generator over (row offset, jax Array) for consecutive blocks of at most block_rows rows"""
+        for i in range(0, self.shape[0], block_rows):
+            yield i, jnp.asarray(self._mm[i:i + block_rows])
+
+    def delete(self):
+        self._mm = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        # the file may have been deleted since, in which case only the path is kept
+        self.path = state['path']
+        self.header, self.segments, self._mm = None, dict(), None
+        if os.path.exists(self.path):
+            self.__init__(self.path)
+
+    def __repr__(self):
+        return f'JacobianStore({self.path}, shape={None if self._mm is None else self.shape})'
@@ -0,0 +1,111 @@
+from functools import partial
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+
+# k-means on the device, for the candidate score vectors (the columns of P) of the eig_kmeans selector.
+# distances are computed in blocks of points, so that the (n, k) distance matrix is never materialised
+
+
+def _sq_dists(X, X_sq, C):
+    # squared euclidean distances between the rows of X (with precomputed squared norms) and of C
+    return jnp.maximum(X_sq[:, None] + jnp.sum(C ** 2, axis=1)[None, :] - 2. * X @ C.T, 0.)
+
+
+def _pad_chunks(X, chunk_size):
+    # (n_chunks, chunk_size, d) blocks of rows, the last one padded with zeros
+    n = X.shape[0]
+    chunk_size = min(chunk_size, n)
+    pad = (-n) % chunk_size
+    X = jnp.concatenate([X, jnp.zeros((pad, *X.shape[1:]), dtype=X.dtype)], axis=0) if pad > 0 else X
+    return X.reshape(-1, chunk_size, *X.shape[1:])
+
+
+def nearest_center(X, C, chunk_size=4096):
+    """index of and squared distance to the closest row of C for every row of X"""
+    n = X.shape[0]
+
+    def f(x):
+        d2 = _sq_dists(x, jnp.sum(x ** 2, axis=1), C)
+        return jnp.argmin(d2, axis=1), jnp.min(d2, axis=1)
+
+    labels, d2 = jax.lax.map(f, _pad_chunks(X, chunk_size))
+    return labels.reshape(-1)[:n], d2.reshape(-1)[:n]
+
+
+@partial(jax.jit, static_argnames=['k', 'n_local_trials', 'chunk_size'])
+def kmeans_plusplus(key, X, k, n_local_trials=None, chunk_size=16384):
+    """k-means++ seeding, returns the indices of the k seeds (rows of X) in the order they were picked
+
+    As in sklearn, every step draws n_local_trials candidates with probability proportional to the squared
+    distance to the closest seed so far and keeps the one that reduces the potential the most. The closest
+    squared distances are cached, so that each step only computes the distances to the new candidates, in blocks
+    of chunk_size points.
+    """
+    n = X.shape[0]
+    n_local_trials = 2 + int(np.log(k)) if n_local_trials is None else n_local_trials
+    X_sq = jnp.sum(X ** 2, axis=1)
+    # blocks of points for the potentials of the trials, of (nearly) equal size so that little is padded. the
+    # padded rows have zero distance and never count
+    chunk_size = -(-n // -(-n // chunk_size))
+    X_chunks, X_sq_chunks = _pad_chunks(X, chunk_size), _pad_chunks(X_sq, chunk_size)
+    n_pad = X_chunks.shape[0] * X_chunks.shape[1]
+
+    key, sub = jax.random.split(key)
+    first = jax.random.randint(sub, (), 0, n, dtype=jnp.int32)
+    min_d2 = _sq_dists(X, X_sq, X[first][None, :])[:, 0]
+    min_d2 = jnp.concatenate([min_d2, jnp.zeros((n_pad - n,), dtype=min_d2.dtype)])
+
+    def step(i, carry):
+        key, min_d2, idx = carry
+        key, sub = jax.random.split(key)
+        # inverse cdf sampling as in sklearn, seeds already picked have zero distance and are never drawn again
+        cdf = jnp.cumsum(min_d2)
+        u = jax.random.uniform(sub, (n_local_trials,)) * cdf[-1]
+        trials = jnp.minimum(jnp.searchsorted(cdf, u, side='right'), n - 1).astype(jnp.int32)
+        C = X[trials]
+        potential = lambda a: jnp.sum(jnp.minimum(a[2][:, None], _sq_dists(a[0], a[1], C)), axis=0)
+        potentials = jnp.sum(jax.lax.map(potential, (X_chunks, X_sq_chunks, min_d2.reshape(X_chunks.shape[:2]))), axis=0)
+        best = trials[jnp.argmin(potentials)]
+        d2 = jnp.concatenate([_sq_dists(X, X_sq, X[best][None, :])[:, 0], jnp.zeros((n_pad - n,), dtype=min_d2.dtype)])
+        return key, jnp.minimum(min_d2, d2), idx.at[i].set(best)
+
+    idx = jnp.zeros((k,), dtype=jnp.int32).at[0].set(first)
+    return jax.lax.fori_loop(1, k, step, (key, min_d2, idx))[2]
+
+
+@partial(jax.jit, static_argnames=['n_iters', 'batch_size'])
+def minibatch_kmeans(key, X, C, n_iters=10, batch_size=1024):
+    """mini-batch Lloyd refinement (Sculley, 2010) of the centers C, with per-center learning rates 1 / count"""
+    n, k = X.shape[0], C.shape[0]
+    batch_size = min(batch_size, n)
+
+    def step(i, carry):
+        C, counts = carry
+        x = X[jax.random.choice(jax.random.fold_in(key, i), n, (batch_size,), replace=False)]
+        labels = jnp.argmin(_sq_dists(x, jnp.sum(x ** 2, axis=1), C), axis=1)
+        sums = jax.ops.segment_sum(x, labels, num_segments=k)
+        n_b = jax.ops.segment_sum(jnp.ones((batch_size,), dtype=X.dtype), labels, num_segments=k)
+        counts = counts + n_b
+        C = C + (sums - n_b[:, None] * C) / jnp.maximum(counts, 1.)[:, None]
+        return C, counts
+
+    return jax.lax.fori_loop(0, n_iters, step, (C, jnp.zeros((k,), dtype=X.dtype)))[0]
+
+
+def kmeans_ranking(key, X, k, n_iters=0, batch_size=1024, chunk_size=16384):
+    """points (rows of X) ranked by k-means: the k++ seeds in the order they were picked. With n_iters > 0, each
+    seed is moved to the point closest to its mini-batch Lloyd refined center, and a point reached from several
+    centers keeps its first rank, so that fewer than k indices may be returned
+    """
+    key_seed, key_lloyd = jax.random.split(key)
+    idx = kmeans_plusplus(key_seed, X, k, chunk_size=chunk_size)
+    if n_iters == 0:
+        return idx
+    C = minibatch_kmeans(key_lloyd, X, X[idx], n_iters=n_iters, batch_size=batch_size)
+    # the point closest to each center, distances computed in blocks of centers
+    idx = np.asarray(nearest_center(C, X, chunk_size=chunk_size)[0])
+    _, first = np.unique(idx, return_index=True)
+    return jnp.asarray(idx[np.sort(first)])
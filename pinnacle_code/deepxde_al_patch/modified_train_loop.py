@@ -1,5 +1,7 @@
 from functools import partial
+import copy
 import os
+import threading
 import pickle as pkl
 from collections.abc import MutableMapping
 from typing import Dict, Any, Callable
@@ -24,9 +26,10 @@ from .ntk import NTKHelper
 from .al import PointSelector, AL_CONSTRUCTOR
 from .icbc_patch import generate_residue, get_corresponding_y
 from .utils import to_cpu
+from .compile_cache import track_compile_time, compile_time, clear_caches
 
 from .multiadam_jax import multiadam
-from .multiadam_jax_alt import multiadam_optimizer as alt_multiadam
+from .multiadam_jax_alt import multiadam_optimizer as alt_multiadam, flat_multiadam_optimizer as flat_multiadam, multiadam_step
 import gc
 
 
@@ -45,7 +48,11 @@ class ModifiedTrainLoop:
                  loss_w_bcs: float = 1.0, loss_w_pde: float = 1.0, loss_w_anc: float = 1.0, autoscale_loss_w_bcs: bool = False, autoscale_first: bool = False,
                  save_grads: bool = True, al_loss_weights: bool = False,
                  random_points_for_weights: bool = False, ntk_ratio_threshold: float = None, check_budget: int = 200, tensorboard_plots = False,
-                 sample_each_round: bool = False, lra_loss_w_bcs: bool = False
+                 sample_each_round: bool = False, lra_loss_w_bcs: bool = False,
+                 ntk_chunk_size: int = None, ntk_mem_budget: int = None,
+                 ntk_weights_every: int = 10, ntk_trace_probes: int = None, ntk_jac_mode: str = 'rev',
+                 ntk_devices: int = None, al_async_staleness: int = None, fused_steps: int = None,
+                 clear_caches_policy: str = 'memory', warmup: bool = False
                  ):
         #for recording gradient weight distribution
         # self.pde_grads = None  # Changed to dict
@@ -92,16 +99,45 @@ class ModifiedTrainLoop:
 
         self.autoscale_loss_w_bcs = autoscale_loss_w_bcs
         self.ntk_ratio_threshold = ntk_ratio_threshold
+        self.ntk_chunk_size = ntk_chunk_size
+        self.ntk_mem_budget = ntk_mem_budget
+        self.ntk_jac_mode = ntk_jac_mode  # 'rev', 'fwd', 'jvp' or 'auto' (benchmarked once per net and residue)
+        self.ntk_devices = ntk_devices  # devices the NTK rows are sharded over, None for a single device
+        self.ntk_weights_every = ntk_weights_every  # steps between loss weight updates (autoscale / lra)
+        self.ntk_trace_probes = ntk_trace_probes  # Hutchinson probes for the NTK traces, None for exact traces
 
         self.train_steps = train_steps
         self.al_every = al_every
         self.snapshot_every = snapshot_every
         self.select_anchors_every = select_anchors_every
         self._last_al_step = 0
+        # run the AL rounds in a background thread, started al_async_staleness steps before the round on a snapshot
+        # of the parameters, while training continues on the current points. None for synchronous rounds
+        self.al_async_staleness = al_async_staleness
+        assert (al_async_staleness is None) or (0 < al_async_staleness <= al_every), 'need 0 < al_async_staleness <= al_every'
+        assert not ((al_async_staleness is not None) and sample_each_round), 'al_async_staleness does not work with sample_each_round'
+        # run up to fused_steps optimiser steps in one jitted lax.scan, going back to python only at the steps
+        # where the loop has something else to do (snapshots, AL, loss weight updates). None for one step at a time
+        self.fused_steps = fused_steps
+        assert (fused_steps is None) or (fused_steps > 0), 'need fused_steps > 0'
+        self._fused = None
+        self._solver = None
+        self._multiadam_step = None
+        # when to drop jax's compiled programs at snapshots (see compile_cache.clear_caches)
+        self.clear_caches_policy = clear_caches_policy
+        # compile the training step and record programs before the first timed step of train
+        self.warmup = warmup
+        self._warmed_up = False
+        self.timings = []  # wall and compile time of every call to train
                 
         self.pde_residue_fn = self._generate_pde_res()
         self.icbc_error_fns = self._generate_icbc_err()
         self.soln_error_fn = self._generate_function_error()
+        # losses as jitted functions of (params, batch), with the points, masks and loss weights in padded buffers.
+        # every segment (res, then each bc) has its own capacity, a power of two sized from its own number of points,
+        # so the losses only recompile when a segment outgrows its buffer rather than after every AL round
+        self._batch_capacity = None
+        self._batch_loss_fns = self._generate_batch_losses()
         
         check_budget = 200
         d = {
@@ -130,7 +166,10 @@ class ModifiedTrainLoop:
         )
         d['anc'] = self.x_test[jnp.array(pts_subset_idx)]
         self._ntk_check_pts = d
-        self._ntk_fn = NTKHelper(self.model, inverse_problem=self.inverse_problem)
+        self._ntk_fn = NTKHelper(self.model, inverse_problem=self.inverse_problem, chunk_size=ntk_chunk_size, mem_budget=ntk_mem_budget,
+                                 jac_mode=ntk_jac_mode, devices=ntk_devices)
+        self._al_points_pool = None  # landmark set of the NTK-based selectors, kept across AL rounds
+        self._al_ntk_fn = None  # NTKHelper of the background AL rounds, created by the first one and kept after
 
         # for debugging
         self.opt_state = None
@@ -145,10 +184,15 @@ class ModifiedTrainLoop:
         self.current_params = None
         self.al = None
         self.current_samples = None
+        self._al_pending = None
+        self._batch = None
         self.loss_fn = None
         self.loss_fn_grad = None
+        self.pde_loss_fn = None
+        self.bc_loss_fn = None
 
         self.loss_steps = []
+        self.step_losses = []  # (device) buffers of the training loss at every step of the fused blocks
         self.loss_train = []
         self.loss_pde = []
         self.loss_bc = []
@@ -269,7 +313,89 @@ class ModifiedTrainLoop:
         #     del d, ntk_pde, eigvals_pde, tr_pde, ntk_bcs_list, eigvals_bcs, tr_bcs, ntk_anc, eigvals_anc, tr_anc, total
         
         self._last_al_step = self.current_train_step
-        
+        al, samples, intermediates = self._run_active_learning(do_anchor=do_anchor, model=self.model)
+        self._apply_active_learning(al, samples, intermediates)
+
+    def _snapshot_model(self, params):
+        # shallow copy of the model whose net holds params, so that training can go on updating the original
+        net = copy.copy(self.model.net)
+        net.params = params[0]
+        model = copy.copy(self.model)
+        model.net = net
+        model.params = params
+        return model
+
+    def _al_state(self):
+        # the parts of the loop an AL round reads, besides the parameters. the main thread reassigns them (loss
+        # weights under autoscale/LRA, the optimiser state and loss functions every step), so a background round
+        # is given them as they were when it started
+        return {
+            'loss_w_bcs': list(self.al_loss_w_bcs if self.al_loss_weights else self.loss_w_bcs),
+            'loss_w_pde': self.al_loss_w_pde if self.al_loss_weights else self.loss_w_pde,
+            'loss_w_anc': self.al_loss_w_anc if self.al_loss_weights else self.loss_w_anc,
+            'opt_state': self.opt_state,
+            'loss_fn': self.loss_fn,
+            'loss_fn_grad': self.loss_fn_grad,
+            'pde_loss_fn': self.pde_loss_fn,
+            'bc_loss_fn': self.bc_loss_fn,
+        }
+
+    def _start_active_learning(self, al_step):
+        # select the points for the AL round at al_step in a background thread, from the current parameters
+        do_anchor = self.select_anchors and (al_step % self.select_anchors_every == 0)
+        print(f'======= Step {self.current_train_step} - starting active learning for step {al_step} in the background =======')
+        model = self._snapshot_model(self.current_params)
+        state = self._al_state()
+        pending = {'step': al_step, 'started': self.current_train_step, 'result': None, 'error': None}
+        # the background rounds get their own NTKHelper (the loop's jacobian cache is keyed on the training
+        # parameters), one for all of them so that its jitted jacobians are only compiled by the first round
+        if self._al_ntk_fn is None:
+            self._al_ntk_fn = NTKHelper(self.model, inverse_problem=self.inverse_problem, chunk_size=self.ntk_chunk_size,
+                                        mem_budget=self.ntk_mem_budget, jac_mode=self.ntk_jac_mode, devices=self.ntk_devices)
+        ntk_helper = self._al_ntk_fn
+
+        def run():
+            try:
+                pending['result'] = self._run_active_learning(do_anchor=do_anchor, model=model, state=state,
+                                                              ntk_helper=ntk_helper)
+            except BaseException as e:
+                pending['error'] = e
+
+        pending['thread'] = threading.Thread(target=run, daemon=True)
+        pending['thread'].start()
+        self._al_pending = pending
+
+    def _maybe_start_active_learning(self, final_step):
+        # in async mode, start the round at the current step + al_async_staleness if there is one. as in the
+        # synchronous loop, the rounds are only those at the end of a round that is also a snapshot step
+        if self.al_async_staleness is None:
+            return
+        al_step = self.current_train_step + self.al_async_staleness
+        if (self._al_pending is None) and (al_step % self.al_every == 0) and (al_step % self.snapshot_every == 0) and \
+                (al_step <= final_step):
+            self._start_active_learning(al_step)
+
+    def _finish_active_learning(self):
+        # wait for the background round (if it is still running) and swap its points in, at the step it was for
+        pending, self._al_pending = self._al_pending, None
+        assert pending['step'] == self.current_train_step, \
+            f'background AL round for step {pending["step"]} finished at step {self.current_train_step}'
+        start = time.time()
+        pending['thread'].join()
+        if pending['error'] is not None:
+            raise pending['error']
+        print(f'======= Step {self.current_train_step} - swapping in points selected at step {pending["started"]} '
+              f'(waited {time.time() - start:.3f}s) =======')
+        self._last_al_step = self.current_train_step
+        self._apply_active_learning(*pending['result'])
+
+    def _run_active_learning(self, do_anchor: bool = False, model: dde.Model = None, state: dict = None,
+                             ntk_helper: NTKHelper = None):
+        # build the point selector for model (whose params may be a snapshot of the training ones) and select the
+        # points. nothing on the loop is changed here, so that this can run in a background thread (see
+        # _start_active_learning, which passes the loop state from _al_state and an NTKHelper of its own)
+        state = self._al_state() if state is None else state
+        ntk_helper = self._ntk_fn if ntk_helper is None else ntk_helper
         if self.point_selector_method is None:
             self.point_selector_method = 'random'
             
@@ -284,14 +410,14 @@ class ModifiedTrainLoop:
             print(f'Training for {steps} steps to get pseudo-values for anchor')
             
             #MIGHT NEED CHANGING
-            if self.loss_fn is None:
+            loss_fn_grad = state['loss_fn_grad']
+            if state['loss_fn'] is None:
                 def _loss(params):
                     loss = jnp.mean(self.pde_residue_fn(params, self._ntk_check_pts['res']) ** 2)
                     for i in range(len(self._ntk_check_pts['bcs'])):
                         loss += jnp.mean(self.icbc_error_fns[i](params[0], self._ntk_check_pts['bcs'][i]) ** 2)
                     return loss
-                self.loss_fn = _loss
-                self.loss_fn_grad = jax.value_and_grad(_loss) 
+                loss_fn_grad = jax.value_and_grad(_loss)
                 if self.optim_method == 'multiadam':
                     raise NotImplementedError('Did not implement this case yet for the new multiadam')
                 print('Pseudo-training using new function')
@@ -300,22 +426,19 @@ class ModifiedTrainLoop:
                 print('Pseudo-training using existing train function')
             
             # do GD a few more steps to get pseudo data
-            if self.optim_method == 'multiadam':
-                solver = self._generate_solver(value_and_grad=self.loss_fn_grad)
-            else:
-                solver = self._generate_solver(value_and_grad=self.loss_fn_grad)
+            solver = self._generate_solver(value_and_grad=loss_fn_grad)
 
-            target_fn_param = self.model.params
-            if self.opt_state is None:
+            target_fn_param = model.params
+            if state['opt_state'] is None:
                 if self.optim_method == 'multiadam':
                     opt_state = solver.init(target_fn_param)
                 else:
                     opt_state = solver.init_state(target_fn_param)
             else:
-                opt_state = self.opt_state
+                opt_state = state['opt_state']
             for r_inside in range(steps):
                 if self.optim_method == 'multiadam':
-                    grads = [jax.grad(self.pde_loss_fn)(target_fn_param), jax.grad(self.bc_loss_fn)(params)]
+                    grads = [jax.grad(state['pde_loss_fn'])(target_fn_param), jax.grad(state['bc_loss_fn'])(params)]
                     updates, opt_state = solver.update(grads, opt_state, params)
                     target_fn_param = optax.apply_updates(target_fn_param, updates)
                 else:
@@ -325,12 +448,30 @@ class ModifiedTrainLoop:
             
             print('Pseudo-training done.')
             
-            self.loss_fn = None
-            self.loss_fn_grad = None
-            
         else:
             point_sel_args_d = self.point_selector_args
             
+        if self.point_selector_method.startswith('eig') and ((self.ntk_chunk_size is not None) or (self.ntk_mem_budget is not None)):
+            point_sel_args_d = dict(point_sel_args_d)
+            point_sel_args_d.setdefault('jac_chunk_size', self.ntk_chunk_size)
+            point_sel_args_d.setdefault('jac_mem_budget', self.ntk_mem_budget)
+        if self.point_selector_method.startswith('eig') and ((self.ntk_jac_mode != 'rev') or (self.ntk_devices is not None)):
+            point_sel_args_d = dict(point_sel_args_d)
+            point_sel_args_d.setdefault('jac_mode', self.ntk_jac_mode)
+            point_sel_args_d.setdefault('jac_devices', self.ntk_devices)
+        
+        if self.point_selector_method.startswith('eig'):
+            # share ntk_helper, so that jacobians computed at the current parameters are reused and the jitted
+            # jacobians are not compiled again (unless the selector was given its own chunking settings)
+            point_sel_args_d = dict(point_sel_args_d)
+            if (point_sel_args_d.get('jac_chunk_size', self.ntk_chunk_size) == self.ntk_chunk_size) and \
+                    (point_sel_args_d.get('jac_mem_budget', self.ntk_mem_budget) == self.ntk_mem_budget) and \
+                    (point_sel_args_d.get('jac_mode', self.ntk_jac_mode) == self.ntk_jac_mode) and \
+                    (point_sel_args_d.get('jac_devices', self.ntk_devices) == self.ntk_devices):
+                point_sel_args_d.setdefault('ntk_helper', ntk_helper)
+            if self._al_points_pool is not None:
+                point_sel_args_d.setdefault('points_pool', self._al_points_pool)
+            
         if self.anc_measurable_idx is None:
             anc_idx = 0
         elif isinstance(self.anc_measurable_idx, int):
@@ -339,12 +480,12 @@ class ModifiedTrainLoop:
             anc_idx = self.anc_measurable_idx[0]
 
 
-        self.al = AL_CONSTRUCTOR[self.point_selector_method](
-            model=self.model,
+        al = AL_CONSTRUCTOR[self.point_selector_method](
+            model=model,
             inverse_problem=self.inverse_problem,
-            loss_w_bcs=self.al_loss_w_bcs if self.al_loss_weights else self.loss_w_bcs,
-            loss_w_pde=self.al_loss_w_pde if self.al_loss_weights else self.loss_w_pde,
-            loss_w_anc=self.loss_w_anc if self.al_loss_weights else self.loss_w_anc,
+            loss_w_bcs=state['loss_w_bcs'],
+            loss_w_pde=state['loss_w_pde'],
+            loss_w_anc=state['loss_w_anc'],
             optim_lr=self.optim_lr,
             current_samples=self.current_samples,
             mem_pts_total_budget=self.mem_pts_total_budget,
@@ -353,7 +494,15 @@ class ModifiedTrainLoop:
             anc_idx=anc_idx,
             **point_sel_args_d
         )
-        self.current_samples, self._sample_intermediates = self.al.generate_samples()
+        samples, intermediates = al.generate_samples()
+        return al, samples, intermediates
+
+    def _apply_active_learning(self, al, samples, intermediates):
+        # swap the selected points in and rebuild the loss functions
+        self.al = al
+        if hasattr(self.al, 'points_pool'):
+            self._al_points_pool = self.al.points_pool
+        self.current_samples, self._sample_intermediates = samples, intermediates
         # if self.autoscale_loss_w_bcs and ('new_loss_w_bcs' in self._sample_intermediates.keys()):
         #     old_lwbcs = self.loss_w_bcs
         #     self.loss_w_bcs = self._sample_intermediates['new_loss_w_bcs']
@@ -443,41 +592,87 @@ class ModifiedTrainLoop:
         #     self.loss_fn_grad = jax.value_and_grad(self.loss_fn) 
         self.update_functions()
 
-    def update_functions(self):
-        def new_pde_loss(params, xs=None):
-            # Calculate losses separately
-            pde_loss = self.loss_w_pde * jnp.mean(self.pde_residue_fn(params, self.current_samples['res']) ** 2)
-            # Adjusting to use the new loss_w_bcs array
-            return pde_loss
-        def new_bc_loss(params, xs=None):
-            bc_loss = 0
-            for i in range(len(self.current_samples['bcs'])):
-                bc_loss += self.loss_w_bcs[i] * jnp.mean(self.icbc_error_fns[i](params[0], self.current_samples['bcs'][i]) ** 2)
-            if 'anc' in self.current_samples.keys():
+    def _generate_batch_losses(self):
+        # losses of the padded batch from _make_batch, each point weighted by its mask (0 on the padding)
+        pde_residue_fn, icbc_error_fns = self.pde_residue_fn, self.icbc_error_fns
+
+        def masked_mean(err, mask):
+            # mean of err ** 2 over the unmasked rows (err may be (n,) or (n, k))
+            err = err.reshape(mask.shape[0], -1)
+            return jnp.sum(mask[:, None] * err ** 2) / (jnp.maximum(jnp.sum(mask), 1.) * err.shape[1])
+
+        def pde_loss(params, batch):
+            return batch['w_pde'] * masked_mean(pde_residue_fn(params, batch['res']), batch['res_mask'])
+
+        def unweighted_bc_losses(params, batch):
+            if 'anc' in batch.keys():
                 raise NotImplementedError("Multiadam optimization with anchor points not implemented") 
-            return bc_loss
-        def unweighted_bc_loss(params, xs=None):
+            return [masked_mean(icbc_error_fns[i](params[0], batch['bcs'][i]), batch['bcs_mask'][i])
+                    for i in range(len(batch['bcs']))]
+
+        def bc_loss(params, batch):
             bc_loss = 0
-            for i in range(len(self.current_samples['bcs'])):
-                bc_loss += jnp.mean(self.icbc_error_fns[i](params[0], self.current_samples['bcs'][i]) ** 2)
-            if 'anc' in self.current_samples.keys():
-                raise NotImplementedError("Multiadam optimization with anchor points not implemented") 
+            for i, l in enumerate(unweighted_bc_losses(params, batch)):
+                bc_loss += batch['w_bcs'][i] * l
             return bc_loss
-        def new_loss(params):
-            # Calculate losses separately
-            pde_loss = new_pde_loss(params)
-            bc_loss = new_bc_loss(params)
-            loss = pde_loss + bc_loss
-            return loss #, {'pde_loss': pde_loss, 'bc_loss': bc_loss}
-        
-        self.loss_fn = jax.jit(new_loss)
-        self.loss_fn_grad = jax.value_and_grad(self.loss_fn) 
-        self.pde_loss_fn = jax.jit(new_pde_loss)
-        self.pde_loss_fn_grad = jax.value_and_grad(self.pde_loss_fn) 
-        self.bc_loss_fn = jax.jit(new_bc_loss)
-        self.bc_loss_fn_grad = jax.value_and_grad(self.bc_loss_fn) 
-        self.unw_bc_loss_fn = jax.jit(unweighted_bc_loss)
-        self.unw_bc_loss_fn_grad = jax.value_and_grad(self.unw_bc_loss_fn) 
+
+        def unweighted_bc_loss(params, batch):
+            return sum(unweighted_bc_losses(params, batch))
+
+        def loss(params, batch):
+            return pde_loss(params, batch) + bc_loss(params, batch)
+
+        fns = {'loss': loss, 'pde': pde_loss, 'bc': bc_loss, 'unw_bc': unweighted_bc_loss}
+        fns = {k: jax.jit(f) for k, f in fns.items()}
+        fns.update({f'{k}_grad': jax.jit(jax.value_and_grad(f)) for k, f in fns.items()})
+        return fns
+
+    def _make_batch(self, samples):
+        # current samples and loss weights as padded buffers, segment i holding self._batch_capacity[i] points. a
+        # capacity starts at the next power of two (at least 8) above the segment's size and only changes, and the
+        # losses recompile, when the segment outgrows it
+        counts = [samples['res'].shape[0]] + [x.shape[0] for x in samples['bcs']]
+        if self._batch_capacity is None:
+            self._batch_capacity = [max(8, 1 << max(n - 1, 0).bit_length()) for n in counts]
+        for i, n in enumerate(counts):
+            if n > self._batch_capacity[i]:
+                while n > self._batch_capacity[i]:
+                    self._batch_capacity[i] *= 2
+                print(f'Loss buffer of segment {i} grown to {self._batch_capacity[i]} points')
+        fill = samples['res'][:1]
+
+        def pad(x, cap):
+            # padded with copies of a training point, so that the padding has finite residues
+            x = jnp.asarray(x).reshape(-1, fill.shape[-1])
+            f = x[:1] if x.shape[0] > 0 else fill
+            mask = jnp.concatenate([jnp.ones((x.shape[0],), dtype=x.dtype), jnp.zeros((cap - x.shape[0],), dtype=x.dtype)])
+            return jnp.concatenate([x, jnp.repeat(f, cap - x.shape[0], axis=0)], axis=0), mask
+
+        res, res_mask = pad(samples['res'], self._batch_capacity[0])
+        bcs = [pad(x, cap) for x, cap in zip(samples['bcs'], self._batch_capacity[1:])]
+        batch = {
+            'res': res, 'res_mask': res_mask,
+            'bcs': [b[0] for b in bcs], 'bcs_mask': [b[1] for b in bcs],
+            'w_pde': jnp.asarray(self.loss_w_pde, dtype=res.dtype),
+            'w_bcs': jnp.asarray([self.loss_w_bcs[i] for i in range(len(bcs))], dtype=res.dtype).reshape(-1),
+        }
+        if 'anc' in samples.keys():
+            batch['anc'] = samples['anc']
+        return batch
+
+    def update_functions(self):
+        # new batch from the current samples and loss weights, the compiled losses are reused
+        fns = self._batch_loss_fns
+        batch = self._batch = self._make_batch(self.current_samples)
+
+        self.loss_fn = lambda params: fns['loss'](params, batch)
+        self.loss_fn_grad = lambda params: fns['loss_grad'](params, batch)
+        self.pde_loss_fn = lambda params: fns['pde'](params, batch)
+        self.pde_loss_fn_grad = lambda params: fns['pde_grad'](params, batch)
+        self.bc_loss_fn = lambda params: fns['bc'](params, batch)
+        self.bc_loss_fn_grad = lambda params: fns['bc_grad'](params, batch)
+        self.unw_bc_loss_fn = lambda params: fns['unw_bc'](params, batch)
+        self.unw_bc_loss_fn_grad = lambda params: fns['unw_bc_grad'](params, batch)
         
     def _generate_solver(self, value_and_grad):
         # # TODO to add in other optimizers like L-BFGS
@@ -494,7 +689,8 @@ class ModifiedTrainLoop:
             #     **self.optim_args
             # )
             # solver = jaxopt.OptaxSolver(opt=opt, fun=value_and_grad, value_and_grad=True)
-            solver = alt_multiadam(
+            # flat (groups, params) moment buffers, the same updates as alt_multiadam
+            solver = flat_multiadam(
                 lr=self.optim_lr,
                 group_weights=[0.5, 0.5],  # Weight PDE vs boundary
                 **self.optim_args
@@ -511,6 +707,94 @@ class ModifiedTrainLoop:
             raise ValueError(f'Invalid optim_method: {self.optim_method}')
         
         return solver
+
+    def _fused_update(self, solver):
+        # jitted run of n optimiser steps on batch as one lax.scan, returns the new params and state and the (n,)
+        # losses. compiled once per solver and n
+        if (self._fused is not None) and (self._fused[0] is solver):
+            return self._fused[1]
+
+        if self.optim_method == 'multiadam':
+            update = self._multiadam_update(solver)
+
+            def step(carry, batch):
+                params, opt_state, losses = update(*carry, batch)
+                return (params, opt_state), jnp.sum(losses)
+        else:
+            def step(carry, batch):
+                params, opt_state = carry
+                params, opt_state = solver.update(params, opt_state, batch)
+                # loss at the parameters before the step
+                return (params, opt_state), opt_state.value
+
+        @partial(jax.jit, static_argnames=['n'])
+        def run(params, opt_state, batch, n):
+            (params, opt_state), losses = jax.lax.scan(lambda c, _: step(c, batch), (params, opt_state), None, length=n)
+            return params, opt_state, losses
+
+        self._fused = (solver, run)
+        return run
+
+    def _multiadam_update(self, solver):
+        # jitted multiadam step on a batch, with the gradients of the pde and bc loss groups from one compiled call
+        if (self._multiadam_step is None) or (self._multiadam_step[0] is not solver):
+            fns = self._batch_loss_fns
+            self._multiadam_step = (solver, multiadam_step(solver, [fns['pde'], fns['bc']]))
+        return self._multiadam_step[1]
+
+    def _fused_block_end(self, first_step, round_end):
+        # last step of the fused block starting at first_step: the loss weights may only be updated before its
+        # first step, and snapshots, AL rounds and async starts only happen after its last step
+        def next_step(t, every, offset=0):
+            # first step >= t with step % every == offset % every
+            return t + (offset - t) % every
+
+        last = min(round_end, first_step + self.fused_steps - 1, next_step(first_step, self.snapshot_every))
+        if self.autoscale_loss_w_bcs or self.lra_loss_w_bcs:
+            last = min(last, next_step(first_step + 1, self.ntk_weights_every) - 1)
+        if self.al_async_staleness is not None:
+            last = min(last, next_step(first_step, self.al_every, -self.al_async_staleness))
+        return last
+
+    def _warmup(self, solver, params, opt_state, final_step):
+        # run the training step (for every fused block length train will use) and the record computations once on
+        # the current state, dropping the results, so that they are compiled before the timed loop. the AL
+        # programs are compiled by the round at step 0. returns the time taken
+        start, compile_start = time.time(), compile_time(threading.get_ident())
+        if opt_state is None:
+            opt_state = solver.init(params) if self.optim_method == 'multiadam' else solver.init_state(params, self._batch)
+
+        lengths = {1}
+        if (self.fused_steps is not None) and not self.sample_each_round:
+            lengths = set()
+            for round_start in range(self.current_train_step, final_step, self.al_every):
+                t = round_start
+                while t < round_start + self.al_every:
+                    last = self._fused_block_end(t + 1, round_start + self.al_every)
+                    lengths.add(last - t)
+                    t = last
+
+        out = []
+        for n in sorted(lengths):
+            if n > 1:
+                out.append(self._fused_update(solver)(params, opt_state, self._batch, n))
+            elif self.optim_method == 'multiadam':
+                out.append(self._multiadam_update(solver)(params, opt_state, self._batch))
+            else:
+                out.append(solver.update(params, opt_state, self._batch))
+
+        # as in _record
+        out += [self.loss_fn(params), self.pde_loss_fn(params), self.unw_bc_loss_fn(params),
+                self.net.apply(params[0], self.x_test, training=False),
+                jax.vmap(lambda x_: self.pde_residue_fn(params, x_.reshape(1, -1))[0])(self.x_test),
+                self.soln_error_fn(params[0], self.x_test, self.y_test)]
+        jax.block_until_ready(out)
+        del out
+
+        self._warmed_up = True
+        secs = time.time() - start
+        print(f'Warm-up took {secs:.2f}s ({compile_time(threading.get_ident()) - compile_start:.2f}s compiling), fused block lengths {sorted(lengths)}')
+        return secs
         
     def _record(self, writer: SummaryWriter = None, al_step = False):
 
@@ -555,12 +839,11 @@ class ModifiedTrainLoop:
             }   
         else:
             d = self._ntk_check_pts
-            jac_pde = self._ntk_fn.get_jac(d['res'], code=-1)
-            jac_bcs_list = [self._ntk_fn.get_jac(d['bcs'][i], code=i) for i in range(len(d['bcs']))] # separate eigvals for each bc component
-            jac_anc = self._ntk_fn.get_jac(d['anc'], code=-2)
-            jacs_sep = [jac_pde] + jac_bcs_list + [jac_anc]
-            jacs = {k: jnp.concatenate([jc[k] for jc in jacs_sep], axis=0) for k in jac_pde.keys()}
-            K_check_pts = self._ntk_fn.get_ntk(jac1=jacs, jac2=jacs)
+            if self._ntk_fn.chunk_size is None:
+                jacs = self._ntk_fn.get_jac_block(d)
+                K_check_pts = self._ntk_fn.get_ntk(jac1=jacs, jac2=jacs)
+            else:
+                K_check_pts = self._ntk_fn.get_ntk_chunked(xs1=d)
                 
             self.snapshot_data[self.current_train_step] = {
                 'al_intermediate': self._sample_intermediates if al_step else None,
@@ -594,7 +877,7 @@ class ModifiedTrainLoop:
         if not skip:
             def func_kernel_pred(train_loop,x_test,step_idx,idx=-1,code = -2, use_const_res=True):
                 
-                jacs_x_test = self._ntk_fn.get_jac(x_test, code=code)
+                jacs_x_test = self._ntk_fn.get_jac(x_test, code=code, flat=True, sketch=train_loop._sample_intermediates.get('sketch'))
                 # jacs_train = self._ntk_fn.get_jac(train_loop._sample_intermediates['old_points'])
                 jacs_train = train_loop._sample_intermediates['jac_train']
                 K_train_x_test = self._ntk_fn.get_ntk(jac1=jacs_train, jac2=jacs_x_test)
@@ -960,26 +1243,29 @@ class ModifiedTrainLoop:
             writer.add_figure('weight_samples', plot, global_step=self.current_train_step)
             print(f"Sample sizes are: N_res={len(d['res'])}, N_b={[len(d['bcs'][i]) for i in range(len(d['bcs']))]}")
             
-        ntk_pde = self._ntk_fn.get_ntk(jac1=self._ntk_fn.get_jac(xs=d['res'], code=-1))
-        eigvals_pde = jnp.linalg.eigvalsh(ntk_pde)
-        tr_pde = jnp.sum(eigvals_pde)
-        if self.current_train_step % 50 == 0:
-            print(f'PDE Cl top eigvals = {eigvals_pde[-min(5, eigvals_pde.shape[0]):]}')
+        # only traces are needed for the weights, these come straight from the jacobian (or a Hutchinson estimate
+        # if ntk_trace_probes is set). lambda_max is only computed for the printouts
+        verbose = (self.current_train_step % 50 == 0)
+        stats_kw = dict(matrix_free=(self.ntk_trace_probes is not None), num_probes=self.ntk_trace_probes,
+                        power_iters=(20 if verbose else 0), key=jax.random.PRNGKey(self.current_train_step))
+        stats_pde = self._ntk_fn.spectral_stats(d['res'], code=-1, **stats_kw)
+        tr_pde = stats_pde['trace']
+        if verbose:
+            print(f"PDE Cl max eigval = {stats_pde['lambda_max']}")
             print(f'PDE Cl trace = {tr_pde}')
         
-        ntk_bcs_list = [self._ntk_fn.get_ntk(jac1=self._ntk_fn.get_jac(xs=d['bcs'][i], code=i)) for i in range(len(d['bcs']))]
-        eigvals_bcs = [jnp.linalg.eigvalsh(ntkbc) for ntkbc in ntk_bcs_list]
-        tr_bcs = [jnp.sum(eigbc) for eigbc in eigvals_bcs]
-        if self.current_train_step % 50 == 0:
-            for i, bc in enumerate(eigvals_bcs):
-                print(f'BC {i} Cl top eigvals = {bc[-min(5, bc.shape[0]):]}')
+        stats_bcs = [self._ntk_fn.spectral_stats(d['bcs'][i], code=i, **stats_kw) for i in range(len(d['bcs']))]
+        tr_bcs = [st['trace'] for st in stats_bcs]
+        if verbose:
+            for i, st in enumerate(stats_bcs):
+                print(f"BC {i} Cl max eigval = {st['lambda_max']}")
                 print(f'BC {i} Cl trace = {tr_bcs[i]}')
         
         if 'anc' in d.keys():
-            ntk_anc = self._ntk_fn.get_ntk(jac1=self._ntk_fn.get_jac(xs=d['anc'], code=-2))
-            eigvals_anc = jnp.linalg.eigvalsh(ntk_anc)
-            print(f'Exp top eigvals = {eigvals_pde[-min(5, eigvals_anc.shape[0]):]}')
-            tr_anc = jnp.sum(eigvals_anc)
+            stats_anc = self._ntk_fn.spectral_stats(d['anc'], code=-2, **stats_kw)
+            if verbose:
+                print(f"Exp max eigval = {stats_anc['lambda_max']}")
+            tr_anc = stats_anc['trace']
             print(f'Exp trace = {tr_anc}')
         else:
             tr_anc = 0.
@@ -1003,7 +1289,7 @@ class ModifiedTrainLoop:
             print('loss_w_bcs =', self.loss_w_bcs)
             #print('loss_w_anc =', self.loss_w_anc)
 
-        del d, ntk_pde, eigvals_pde, tr_pde, ntk_bcs_list, eigvals_bcs, tr_bcs, tr_anc, total
+        del d, stats_pde, tr_pde, stats_bcs, tr_bcs, tr_anc, total
 
     def train(self, train_steps=None):
         
@@ -1019,8 +1305,19 @@ class ModifiedTrainLoop:
         else:
             writer = None
 
+        track_compile_time()
+        # compiles in this thread hold up the loop, those of the background AL rounds (al_async_staleness) overlap with it
+        # and are reported separately
+        thread = threading.get_ident()
+        train_start, compile_start, compile_all_start = time.time(), compile_time(thread), compile_time()
+        warmup_secs = 0.
+
         params = self.model.params
         opt_state = self.opt_state
+        if self._al_pending is not None:
+            # left by an interrupted call, its step has passed, so its points are dropped rather than swapped in late
+            print(f'Dropping the background AL round for step {self._al_pending["step"]}')
+            self._al_pending = None
                 
         self.current_params = params
         
@@ -1034,7 +1331,15 @@ class ModifiedTrainLoop:
         # if self.optim_method == 'multiadam':
         #     solver = self._generate_solver(value_and_grad=self.loss_fn_grad)
         # else:
-        solver = self._generate_solver(value_and_grad=self.loss_fn_grad)
+        # the batch (points and loss weights) is passed at every step, so one solver (and its compiled steps)
+        # serves the whole run
+        if self._solver is None:
+            self._solver = self._generate_solver(value_and_grad=self._batch_loss_fns['loss_grad'])
+        solver = self._solver
+        final_step = self.current_train_step + al_rounds * self.al_every
+        if self.warmup and not self._warmed_up:
+            warmup_secs = self._warmup(solver, params, opt_state, final_step)
+        self._maybe_start_active_learning(final_step)
 
         for r in range(al_rounds):
             
@@ -1044,24 +1349,29 @@ class ModifiedTrainLoop:
                 if self.optim_method == 'multiadam':
                     opt_state = solver.init(params)
                 else:
-                    opt_state = solver.init_state(params)
+                    opt_state = solver.init_state(params, self._batch)
                                                 
-            for r_inside in range(self.al_every):
+            round_end = self.current_train_step + self.al_every
+            r_inside = -1
+            while r_inside < self.al_every - 1:
                 
                 self.current_train_step += 1
                 # print(f'now on iteration {self.current_train_step}')
 
+                # number of steps taken in this iteration, more than one only in fused mode
+                n_steps = 1
+                if (self.fused_steps is not None) and not self.sample_each_round:
+                    n_steps = self._fused_block_end(self.current_train_step, round_end) - self.current_train_step + 1
+
                 if self.sample_each_round:
                     self.current_samples, _ =  self.al.generate_samples(verbose=False)
 
-                if self.autoscale_loss_w_bcs and self.current_train_step % 10 == 0:
+                if self.autoscale_loss_w_bcs and self.current_train_step % self.ntk_weights_every == 0:
                     self.ntk_update_weights(writer=writer)
                     self.update_functions()
-                    solver = self._generate_solver(value_and_grad=self.loss_fn_grad) #check if this is necessary
-                elif self.lra_loss_w_bcs and self.current_train_step % 10 == 0:
+                elif self.lra_loss_w_bcs and self.current_train_step % self.ntk_weights_every == 0:
                     self.lra_update_weights(writer=writer)
                     self.update_functions()
-                    solver = self._generate_solver(value_and_grad=self.loss_fn_grad) #check if this is necessary
 
 
                 # if self.current_train_step  % 50 == 0:
@@ -1070,12 +1380,15 @@ class ModifiedTrainLoop:
                 # l_, grad = self.loss_fn_grad(params)
                 # updates, opt_state = opt.update(grad, opt_state)
                 # params = optax.apply_updates(params, updates)
-                if self.optim_method == 'multiadam':
-                    grads = [jax.grad(self.pde_loss_fn)(params), jax.grad(self.bc_loss_fn)(params)]
-                    updates, opt_state = solver.update(grads, opt_state, params)
-                    params = optax.apply_updates(params, updates)
+                if n_steps > 1:
+                    params, opt_state, losses = self._fused_update(solver)(params, opt_state, self._batch, n_steps)
+                    self.step_losses.append(losses)
+                    self.current_train_step += n_steps - 1
+                elif self.optim_method == 'multiadam':
+                    params, opt_state, _ = self._multiadam_update(solver)(params, opt_state, self._batch)
                 else:
-                    params, opt_state = solver.update(params, opt_state)
+                    params, opt_state = solver.update(params, opt_state, self._batch)
+                r_inside += n_steps
                 
                 self.net.params = params[0] 
                 self.model.params = params
@@ -1117,25 +1430,40 @@ class ModifiedTrainLoop:
 
                      # Clean up after each round
                     gc.collect()
-                    jax.clear_caches()
+                    if self._al_pending is None:
+                        # (not while a background round may be compiling)
+                        clear_caches(self.clear_caches_policy)
                     
+                    if (self._al_pending is not None) and (self._al_pending['step'] == self.current_train_step):
+                        # points selected in the background, al_async_staleness steps ago
+                        self._finish_active_learning()
                     # either last iteration of round (have to do AL), or trigger to redo AL from NTK value
-                    if not self.sample_each_round and ((r_inside == self.al_every - 1) or self.need_to_redo_active_learning(writer=writer)):
+                    elif not self.sample_each_round and (self._al_pending is None) and ((r_inside == self.al_every - 1) or self.need_to_redo_active_learning(writer=writer)):
                         do_anchor = self.select_anchors and (self.current_train_step % self.select_anchors_every == 0)
                         print(f'======= Step {self.current_train_step} - performing active learning =======')
                         self._do_active_learning(do_anchor=do_anchor)
                         print(f'======= Done active learning =======')
-                        # if self.reset_sampler_at_al:
-                        solver = self._generate_solver(value_and_grad=self.loss_fn_grad) #TODO: not sure what this does
                     elif (r_inside == self.al_every - 1):
                         self.al_data_round[self.current_train_step] = self.current_samples 
 
+                self._maybe_start_active_learning(final_step)
+
 
                 # self.net.params = params[0]
                 # self.model.params = params
 
+        # (rounds are only started for steps up to final_step, at which they are swapped in)
+        assert self._al_pending is None
+
         end = time.time()
         print(f"Time required for last {self.al_every} steps = {end - start:.6f} seconds")
+        total, compiling = end - train_start, compile_time(thread) - compile_start
+        compiling_async = compile_time() - compile_all_start - compiling
+        print(f'Training took {total:.2f}s, of which {compiling:.2f}s compiling (warm-up {warmup_secs:.2f}s) '
+              f'and {total - compiling:.2f}s running' + (f', with {compiling_async:.2f}s compiling in the background'
+                                                         if compiling_async > 0. else ''))
+        self.timings.append({'step': self.current_train_step, 'total': total, 'compile': compiling,
+                             'compile_async': compiling_async, 'warmup': warmup_secs})
                                             
         if writer is not None:
             writer.close()
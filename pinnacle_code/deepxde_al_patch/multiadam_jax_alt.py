@@ -2,6 +2,7 @@ import jax
 import jax.numpy as jnp
 import optax
 from jax.tree_util import tree_map
+from jax.flatten_util import ravel_pytree
 
 def init_multiadam_state(params, n_groups):
     exp_avg = [tree_map(jnp.zeros_like, params) for _ in range(n_groups)]
@@ -79,4 +80,91 @@ def multiadam_optimizer(amsgrad=False, beta1=0.99, beta2=0.99, lr=1e-3, weight_d
     def update_fn(grads, state, params):
         return multiadam_update(grads, state, params, amsgrad, beta1, beta2, lr, weight_decay, eps, maximize, group_weights, agg_momentum, agg_beta1, agg_beta2)
 
-    return optax.GradientTransformation(init_state, update_fn)
\ No newline at end of file
+    return optax.GradientTransformation(init_state, update_fn)
+
+def flat_multiadam_optimizer(amsgrad=False, beta1=0.99, beta2=0.99, lr=1e-3, weight_decay=0, eps=1e-8, maximize=False, group_weights=None, agg_momentum=False, agg_beta1=0.0, agg_beta2=0.0):
+    """multiadam_optimizer with the moments of all groups as (G, P) arrays over the flattened parameters
+
+    Same updates as multiadam_optimizer, but every moment is updated for all groups in one expression, and
+    max_exp_avg_sq (amsgrad) and the aggregate moments (agg_momentum) are only kept when they are used. The grads
+    given to update are either a list of the G group gradients or one pytree whose leaves are stacked along a
+    leading group axis. The updates have the structure of params, as with any optax GradientTransformation.
+    """
+    n_groups = len(group_weights) if group_weights is not None else 1
+    weights = jnp.ones((n_groups,)) if group_weights is None else jnp.asarray(group_weights)
+
+    def init_state(params):
+        flat, _ = ravel_pytree(params)
+        zeros = jnp.zeros((n_groups, flat.shape[0]), dtype=flat.dtype)
+        state = {'step': jnp.zeros([], jnp.int32), 'exp_avg': zeros, 'exp_avg_sq': zeros}
+        if amsgrad:
+            state['max_exp_avg_sq'] = zeros
+        if agg_momentum:
+            state['agg_exp_avg'] = jnp.zeros_like(flat)
+            state['agg_exp_avg_sq'] = jnp.zeros_like(flat)
+        return state
+
+    def update_fn(grads, state, params):
+        p, unravel = ravel_pytree(params)
+        if isinstance(grads, (list, tuple)):
+            g = jnp.stack([ravel_pytree(g_)[0] for g_ in grads])
+        else:
+            g = jax.vmap(lambda g_: ravel_pytree(g_)[0])(grads)
+        step = state['step'] + 1
+        new_state = {'step': step}
+
+        g = g if maximize else -g
+        if weight_decay != 0:
+            g = g + weight_decay * p[None, :]
+        m = beta1 * state['exp_avg'] + (1 - beta1) * g
+        v = beta2 * state['exp_avg_sq'] + (1 - beta2) * g ** 2
+        new_state['exp_avg'], new_state['exp_avg_sq'] = m, v
+        if amsgrad:
+            v = new_state['max_exp_avg_sq'] = jnp.maximum(state['max_exp_avg_sq'], v)
+        bias_correction2 = 1 - beta2 ** step
+        u = jnp.sum(weights.astype(g.dtype)[:, None] * m / (jnp.sqrt(v / bias_correction2) + eps), axis=0)
+
+        if agg_momentum:
+            agg_m = new_state['agg_exp_avg'] = agg_beta1 * state['agg_exp_avg'] + (1 - agg_beta1) * u
+            agg_v = new_state['agg_exp_avg_sq'] = agg_beta2 * state['agg_exp_avg_sq'] + (1 - agg_beta2) * u ** 2
+            u = (agg_m / (1 - agg_beta1 ** step)) / (jnp.sqrt(agg_v / (1 - agg_beta2 ** step)) + eps)
+
+        return unravel(lr * u), new_state
+
+    return optax.GradientTransformation(init_state, update_fn)
+
+
+def group_value_and_grads(group_loss_fns, shared_forward=False):
+    """(params, *args) -> ((G,) losses, list of the G gradients) for the losses group_loss_fns[g](params, *args)
+
+    By default every group gets its own value_and_grad, all in the one compiled function. With shared_forward,
+    the network is evaluated once for all groups and the gradients are a VJP vmapped over one-hot cotangents,
+    which only pays off when the groups share their points: otherwise the backward pass runs on every group's
+    points for every row.
+    """
+    n_groups = len(group_loss_fns)
+
+    def fn(params, *args):
+        if shared_forward:
+            losses, vjp = jax.vjp(lambda p: jnp.stack([f(p, *args) for f in group_loss_fns]), params)
+            grads = jax.vmap(vjp)(jnp.eye(n_groups, dtype=losses.dtype))[0]
+            return losses, [tree_map(lambda g: g[i], grads) for i in range(n_groups)]
+        out = [jax.value_and_grad(f)(params, *args) for f in group_loss_fns]
+        return jnp.stack([o[0] for o in out]), [o[1] for o in out]
+
+    return fn
+
+
+def multiadam_step(solver, group_loss_fns, shared_forward=False):
+    """one compiled training step, (params, state, *args) -> (params, state, (G,) losses): the gradients of all
+    loss groups (see group_value_and_grads) and the multiadam update of solver
+    """
+    value_and_grads = group_value_and_grads(group_loss_fns, shared_forward=shared_forward)
+
+    @jax.jit
+    def step(params, state, *args):
+        losses, grads = value_and_grads(params, *args)
+        updates, state = solver.update(grads, state, params)
+        return optax.apply_updates(params, updates), state, losses
+
+    return step
@@ -1,14 +1,20 @@
 from functools import partial
 import os
+import time
 from collections.abc import MutableMapping
 
+import numpy as np
 import jax
 import jax.numpy as jnp
+from jax.flatten_util import ravel_pytree
 import flax
 
 from . import deepxde as dde
 
 from .icbc_patch import generate_residue
+from .spectral import GramOperator, power_iteration
+from .jac_store import JacobianStore
+from .sharding import ROWS, P, shard_map, make_mesh, pad_rows, gather_rows, gram_sharded
 
 
 def _flatten_dict(d, parent_key='', sep='_'):
@@ -45,23 +51,374 @@ def _flatten_dict(d, parent_key='', sep='_'):
 #     dd = j_(params)
 #     return dd
 
-@partial(jax.jit, static_argnames=['fn'])
-def _jac_params_helper(params, x, fn):
+JAC_MODES = ['rev', 'fwd', 'jvp']
+
+# benchmarked jacobian mode per (net architecture, residue), shared by all NTKHelpers of the process
+_JAC_MODE_CACHE = dict()
+
+
+def _jac_params_jvp(params, x, fn, block=128):
+    # forward mode over the whole batch: one JVP of the stacked residues per parameter direction, with the
+    # directions (columns of the identity) processed in blocks to bound the memory
+    p0 = params['params']
+    flat, unravel = ravel_pytree(p0)
+    n_params = flat.shape[0]
+    fn2 = lambda p, x_: fn({**params, 'params': p}, x_.reshape(1, -1))[0]  # version for single dims
+    f = lambda p: jax.vmap(lambda x_: fn2(p, x_))(x).reshape(x.shape[0])
+    jvp_col = lambda t: jax.jvp(f, (p0,), (unravel(t),))[1]
+
+    def block_jac(b):
+        E = jax.nn.one_hot(b * block + jnp.arange(block), n_params, dtype=flat.dtype).T  # (P, block), zero past P
+        return jax.vmap(jvp_col, in_axes=1, out_axes=1)(E)
+
+    J = jax.lax.map(block_jac, jnp.arange(-(-n_params // block)))
+    J = J.transpose(1, 0, 2).reshape(x.shape[0], -1)[:, :n_params]
+    return {**params, 'params': jax.vmap(unravel)(J)}
+
+
+@partial(jax.jit, static_argnames=['fn', 'mode'])
+def _jac_params_helper(params, x, fn, mode='rev'):
+    # mode: 'rev' (jacrev per point), 'fwd' (jacfwd per point) or 'jvp' (batched JVPs over parameter directions)
+    if mode == 'jvp':
+        return _jac_params_jvp(params, x, fn)
     fn2 = lambda params, x_: fn(params, x_.reshape(1, -1))[0]  # version for single dims
     # print(fn2(params, x).shape)
-    f_ = lambda x_: jax.jacobian(fun=fn2, has_aux=False)(params, x_)
+    jac = jax.jacfwd if mode == 'fwd' else jax.jacobian
+    f_ = lambda x_: jac(fn2)(params, x_)
     dd = jax.vmap(f_)(x)
     # dd = jax.jit(jax.vmap(jax.grad(fn2), in_axes=(None, 0)))(params, x)
     return dd
 
 
-def _jac_params_cleanup(dd):
+@partial(jax.jit, static_argnames=['fn', 'mode'])
+def _jac_params_helper_chunked(params, x_chunks, fn, mode='rev'):
+    # x_chunks has shape (n_chunks, chunk_size, dim). lax.map runs the chunks sequentially, so only
+    # one chunk worth of jacobian intermediates is alive at any time
+    dd = jax.lax.map(lambda xc: _jac_params_helper(params, xc, fn, mode=mode), x_chunks)
+    return jax.tree_util.tree_map(lambda a: a.reshape(-1, *a.shape[2:]), dd)
+
+
+def _pad_chunks(x, chunk_size):
+    # pad to a whole number of fixed-size chunks, so that the chunked helper is only compiled once per
+    # chunk count. the padding repeats the last point so that the padded residues stay finite
+    n = x.shape[0]
+    n_chunks = -(-n // chunk_size)
+    pad = n_chunks * chunk_size - n
+    if pad > 0:
+        x = jnp.concatenate([x, jnp.repeat(x[-1:], pad, axis=0)], axis=0)
+    return x.reshape(n_chunks, chunk_size, *x.shape[1:])
+
+
+def _jac_params(params, x, fn, chunk_size=None, mode='rev'):
+    if (chunk_size is None) or (x.shape[0] <= chunk_size):
+        return _jac_params_helper(params=params, x=x, fn=fn, mode=mode)
+    dd = _jac_params_helper_chunked(params, _pad_chunks(x, chunk_size), fn=fn, mode=mode)
+    return jax.tree_util.tree_map(lambda a: a[:x.shape[0]], dd)
+
+
+@partial(jax.jit, static_argnames=['fn'])
+def _jac_params_sketched(params, x, S, fn):
+    # (N, s) product J @ S without forming J: one forward-mode pass per sketch column, i.e. the sketch is
+    # applied to the parameter dimension while the jacobian is being formed
+    p0 = params['params']
+    flat, unravel = ravel_pytree(p0)
+    S = S.astype(flat.dtype)
+    fn2 = lambda p, x_: fn({**params, 'params': p}, x_.reshape(1, -1))[0]  # version for single dims
+    f = lambda p: jax.vmap(lambda x_: fn2(p, x_))(x).reshape(x.shape[0])
+    jvp_col = lambda s_: jax.jvp(f, (p0,), (unravel(s_),))[1]
+    return jax.vmap(jvp_col, in_axes=1, out_axes=1)(S)
+
+
+def _jac_sketched(params, x, S, fn, chunk_size=None):
+    if (chunk_size is None) or (x.shape[0] <= chunk_size):
+        return _jac_params_sketched(params, x, S, fn=fn)
+    x_chunks = _pad_chunks(x, chunk_size)
+    js = jax.lax.map(lambda xc: _jac_params_sketched(params, xc, S, fn=fn), x_chunks)
+    return js.reshape(-1, S.shape[1])[:x.shape[0]]
+
+
+@partial(jax.jit, static_argnames=['fn', 'mesh', 'chunk_size', 'mode'])
+def _jac_params_sharded_helper(params, x, fn, mesh, chunk_size=None, mode='rev'):
+    # params are replicated and every device computes the jacobian rows of its own block of points
+    f = lambda p, x_: _jac_params(p, x_, fn, chunk_size=chunk_size, mode=mode)
+    return shard_map(f, mesh=mesh, in_specs=(P(), P(ROWS)), out_specs=P(ROWS), check_rep=False)(params, x)
+
+
+def _jac_params_sharded(params, x, fn, mesh, chunk_size=None, mode='rev'):
+    dd = _jac_params_sharded_helper(params, pad_rows(x, mesh, repeat=True), fn, mesh, chunk_size=chunk_size, mode=mode)
+    return gather_rows(dd, x.shape[0])
+
+
+@partial(jax.jit, static_argnames=['fn', 'mesh', 'chunk_size'])
+def _jac_sketched_sharded_helper(params, x, S, fn, mesh, chunk_size=None):
+    f = lambda p, x_, S_: _jac_sketched(p, x_, S_, fn, chunk_size=chunk_size)
+    return shard_map(f, mesh=mesh, in_specs=(P(), P(ROWS), P()), out_specs=P(ROWS), check_rep=False)(params, x, S)
+
+
+def _jac_sketched_sharded(params, x, S, fn, mesh, chunk_size=None):
+    js = _jac_sketched_sharded_helper(params, pad_rows(x, mesh, repeat=True), S, fn, mesh, chunk_size=chunk_size)
+    return gather_rows(js, x.shape[0])
+
+
+def _sketch_matrix(key, n_params, sketch_size, sketch_type='gaussian', dtype=jnp.float32):
+    # (P, s) random projection with E[S S^T] = I, so that (J S)(J S)^T is an unbiased estimate of J J^T
+    if sketch_type == 'gaussian':
+        return jax.random.normal(key, (n_params, sketch_size), dtype=dtype) / jnp.sqrt(sketch_size)
+    elif sketch_type == 'srht':
+        # subsampled randomised Hadamard transform sqrt(P'/s) D H R, with the sampled columns of the (normalised)
+        # Hadamard matrix of size P' = 2^ceil(log2 P) written out explicitly, H[i, r] = (-1)^popcount(i & r) / sqrt(P')
+        n_pad = 1 << int(n_params - 1).bit_length()
+        key_d, key_r = jax.random.split(key)
+        signs = jax.random.rademacher(key_d, (n_params,), dtype=dtype)
+        cols = jax.random.choice(key_r, n_pad, (sketch_size,), replace=(sketch_size > n_pad))
+        parity = jax.lax.population_count(jnp.arange(n_params, dtype=jnp.int32)[:, None] & cols[None, :].astype(jnp.int32)) % 2
+        return signs[:, None] * (1. - 2. * parity.astype(dtype)) / jnp.sqrt(sketch_size)
+    else:
+        raise ValueError(f'Invalid sketch type {sketch_type}')
+
+
+def _pad_pow2(x):
+    # pad the number of rows to the next power of two (repeating the last row), so that jacobians of arbitrary
+    # subsets of points only trigger a logarithmic number of compilations
+    n = x.shape[0]
+    n_pad = 1 << max(n - 1, 0).bit_length()
+    if n_pad == n:
+        return x
+    return jnp.concatenate([x, jnp.repeat(x[-1:], n_pad - n, axis=0)], axis=0)
+
+
+def _jac_params_cleanup(dd, w=1.0):
     dd = _flatten_dict(dd['params'])
     # currently only works for one-dimensional model outputs
-    return {k: dd[k].reshape(dd[k].shape[0], -1) for k in dd.keys()}
+    # loss weights enter the Jacobian as a scalar factor, so they are applied here rather than inside fn
+    if w == 1.0:
+        return {k: dd[k].reshape(dd[k].shape[0], -1) for k in dd.keys()}
+    return {k: w * dd[k].reshape(dd[k].shape[0], -1) for k in dd.keys()}
+
+
+def _jac_params_flatten(dd, w=1.0):
+    # contiguous (N, P) layout, columns in ravel_pytree order of params['params']. the NTK is then a single matmul
+    jac = jax.vmap(lambda t: ravel_pytree(t)[0])(dd['params'])
+    return jac if w == 1.0 else w * jac
+
+
+def _param_layout(params):
+    # (name, size) of each parameter in ravel_pytree order, with names as produced by _flatten_dict
+    leaves = jax.tree_util.tree_flatten_with_path(params['params'])[0]
+    return tuple(('_'.join(str(k.key) for k in path), int(l.size)) for path, l in leaves)
+
+
+@jax.tree_util.register_pytree_node_class
+class JacobianBlock:
+    """Jacobian rows in the contiguous (N, P) layout, together with the row range of each component.
+
+    ``segments`` is a tuple of ``(name, start, stop)``, e.g. ``('res', 0, 100), ('bcs_0', 100, 120), ('anc', 120, 130)``,
+    and ``layout`` the ``(name, size)`` of each parameter so that the per-layer view can be recovered.
+    """
+
+    def __init__(self, jac, segments=None, layout=None):
+        self.jac = jac
+        self.segments = tuple(segments) if segments is not None else (('all', 0, jac.shape[0]),)
+        self.layout = layout
+
+    @property
+    def shape(self):
+        return self.jac.shape
+
+    def names(self):
+        return [name for name, _, _ in self.segments]
+
+    def rows(self, name):
+        for n, start, stop in self.segments:
+            if n == name:
+                return self.jac[start:stop]
+        raise KeyError(name)
+
+    def per_layer(self):
+        # dict of per-layer (N, P_layer) jacobians as returned by _jac_params_cleanup, for diagnostics
+        assert self.layout is not None
+        out, offset = dict(), 0
+        for name, size in self.layout:
+            out[name] = self.jac[:, offset:offset + size]
+            offset += size
+        return out
+
+    @staticmethod
+    def concatenate(blocks, names=None):
+        # blocks are JacobianBlocks or (N, P) arrays, names are used for arrays or single-segment blocks
+        names = [None for _ in blocks] if names is None else names
+        segments, offset, layout = [], 0, None
+        for b, name in zip(blocks, names):
+            if isinstance(b, JacobianBlock):
+                layout = b.layout if layout is None else layout
+                segs = b.segments if (name is None) else ((name, 0, b.shape[0]),)
+            else:
+                segs = ((name, 0, b.shape[0]),)
+            segments += [(n, offset + start, offset + stop) for n, start, stop in segs]
+            offset += b.shape[0]
+        jac = jnp.concatenate([_jac_array(b) for b in blocks], axis=0)
+        return JacobianBlock(jac, segments=segments, layout=layout)
+
+    def row_weights(self, weights):
+        # (N,) vector with weights[name] (1 if missing) on the rows of each segment
+        return jnp.concatenate([jnp.full((stop - start,), weights.get(name, 1.), dtype=self.jac.dtype)
+                                for name, start, stop in self.segments])
+
+    def scale(self, weights):
+        """rows of each segment multiplied by weights[name], e.g. the loss weights, without recomputing them"""
+        return JacobianBlock(self.jac * self.row_weights(weights)[:, None], segments=self.segments, layout=self.layout)
+
+    def tree_flatten(self):
+        return (self.jac,), (self.segments, self.layout)
+
+    @classmethod
+    def tree_unflatten(cls, aux, children):
+        return cls(children[0], segments=aux[0], layout=aux[1])
+
+
+def _jac_array(jac, layout=None):
+    # (N, P) array from any of the jacobian layouts. the per-layer dict needs the layout for the column order
+    if isinstance(jac, JacobianBlock):
+        return jac.jac
+    if isinstance(jac, dict):
+        assert layout is not None
+        return jnp.concatenate([jac[name] for name, _ in layout], axis=1)
+    return jac
+
+
+def _jac_rows(jac):
+    if isinstance(jac, dict):
+        return jac[list(jac.keys())[0]].shape[0]
+    return jac.shape[0]
+
+
+def segment_weights(d, loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0):
+    # loss weights of a points dictionary by segment name, as used by JacobianBlock.scale
+    loss_w_bcs = loss_w_bcs if hasattr(loss_w_bcs, "__len__") else [loss_w_bcs for _ in d['bcs']]
+    weights = {'res': loss_w_pde, **{f'bcs_{i}': w for i, w in enumerate(loss_w_bcs)}}
+    if 'anc' in d.keys():
+        weights['anc'] = loss_w_anc
+    return weights
+
+
+class NTKPlan:
+    """unweighted jacobian, per-segment spectral statistics and NTK of a points dictionary, computed once and
+    shared by everything in an AL round that needs them under some loss weights
+
+    The loss weights only scale the jacobian rows of each segment, so the weighted jacobian is a row scaling of
+    the unweighted one, the NTK block (i, j) is scaled by w_i * w_j, and the trace and largest eigenvalue of the
+    NTK of segment i by w_i ** 2. Changing the weights never recomputes a jacobian.
+    """
+
+    def __init__(self, ntk_fn, d, sketch=None, power_iters=50):
+        self.ntk_fn = ntk_fn
+        self.d = d
+        self.power_iters = power_iters
+        self.jac = ntk_fn.get_jac_block(d, sketch=sketch)
+        self._stats = None
+        self._ntk = None
+
+    def weights(self, loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0):
+        return segment_weights(self.d, loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde, loss_w_anc=loss_w_anc)
+
+    def stats(self, weights=None):
+        """{segment: {'trace', 'lambda_max'}} of the per-segment NTKs, under the given weights (by default 1)"""
+        if self._stats is None:
+            self._stats = {name: self.ntk_fn.spectral_stats(jac=self.jac.rows(name), power_iters=self.power_iters)
+                           for name in self.jac.names()}
+        weights = dict() if weights is None else weights
+        return {name: {k: v * weights.get(name, 1.) ** 2 for k, v in st.items()} for name, st in self._stats.items()}
+
+    def get_jac(self, weights):
+        return self.jac.scale(weights)
+
+    def get_ntk(self, weights):
+        """weighted NTK, the unweighted one (computed on first use) with the blocks scaled by w_i * w_j"""
+        if self._ntk is None:
+            self._ntk = self.ntk_fn.get_ntk(jac1=self.jac, jac2=self.jac)
+        w = self.jac.row_weights(weights)
+        return self._ntk * w[:, None] * w[None, :]
+
+
+def _stacked_residue(params, xss, ws, fns):
+    # residues of all blocks as one vector, i.e. the function whose parameter Jacobian is the (stacked) jac
+    outs = []
+    for fn, xs, w in zip(fns, xss, ws):
+        fn2 = lambda x_: fn(params, x_.reshape(1, -1))[0]  # version for single dims
+        outs.append(w * jax.vmap(fn2)(xs).reshape(-1))
+    return jnp.concatenate(outs, axis=0)
+
+
+@partial(jax.jit, static_argnames=['fns1', 'fns2'])
+def _ntk_matvec(params, xss1, ws1, xss2, ws2, v, fns1, fns2):
+    # K @ v = J1 @ (J2.T @ v), with one VJP for J2.T and one JVP for J1. only the 'params' collection
+    # is differentiated, matching _jac_params_cleanup
+    f1 = lambda p: _stacked_residue({**params, 'params': p}, xss1, ws1, fns1)
+    f2 = lambda p: _stacked_residue({**params, 'params': p}, xss2, ws2, fns2)
+    y2, vjp_fn = jax.vjp(f2, params['params'])
+    u, = vjp_fn(v.astype(y2.dtype))
+    return jax.jvp(f1, (params['params'],), (u,))[1]
+
+
+@partial(jax.jit, static_argnames=['fns'])
+def _hutchinson_trace(params, xss, ws, Z, fns):
+    # tr(J J^T) = E ||J^T z||^2 for Rademacher z, with one VJP (and no JVP) per probe
+    f = lambda p: _stacked_residue({**params, 'params': p}, xss, ws, fns)
+    y, vjp_fn = jax.vjp(f, params['params'])
+    sq_norm = lambda z: sum(jnp.sum(l ** 2) for l in jax.tree_util.tree_leaves(vjp_fn(z.astype(y.dtype))[0]))
+    return jnp.mean(jax.vmap(sq_norm)(Z))
+
+
+class NTKLinearOperator:
+    """Matrix-free empirical NTK ``K = J1 @ J2.T``, where J1 and J2 are never materialised.
+
+    Each product ``K @ v`` costs one VJP and one JVP through the residue functions, so memory stays
+    O(N + P) instead of O(N * P). Built with ``NTKHelper.get_ntk_operator``.
+    """
+
+    def __init__(self, params, blocks1, blocks2):
+        # blocks are lists of (fn, xs, w) as produced by NTKHelper._get_blocks
+        self.params = params
+        self._fns1, self._xss1, self._ws1 = (tuple(b) for b in zip(*blocks1))
+        self._fns2, self._xss2, self._ws2 = (tuple(b) for b in zip(*blocks2))
+        self.shape = (sum(xs.shape[0] for xs in self._xss1), sum(xs.shape[0] for xs in self._xss2))
+        self.dtype = self._xss1[0].dtype
+
+    def matvec(self, v):
+        return _ntk_matvec(self.params, self._xss1, self._ws1, self._xss2, self._ws2, v,
+                           fns1=self._fns1, fns2=self._fns2)
+
+    def rmatvec(self, v):
+        # K.T @ v = J2 @ (J1.T @ v)
+        return _ntk_matvec(self.params, self._xss2, self._ws2, self._xss1, self._ws1, v,
+                           fns1=self._fns2, fns2=self._fns1)
+
+    def matmat(self, V):
+        return jax.vmap(self.matvec, in_axes=1, out_axes=1)(V)
+
+    def __matmul__(self, v):
+        return self.matvec(v) if v.ndim == 1 else self.matmat(v)
+
+    @property
+    def T(self):
+        return NTKLinearOperator(self.params, list(zip(self._fns2, self._xss2, self._ws2)),
+                                 list(zip(self._fns1, self._xss1, self._ws1)))
+
+    def solve(self, b, eps=1e-8, tol=1e-6, maxiter=None):
+        # kernel regression (K + eps I)^{-1} b with conjugate gradient, only valid for square operators
+        assert self.shape[0] == self.shape[1]
+        x, _ = jax.scipy.sparse.linalg.cg(lambda v: self.matvec(v) + eps * v, b, tol=tol, maxiter=maxiter)
+        return x
+
+    def to_dense(self):
+        # mostly for debugging, defeats the purpose of the operator
+        return self.matmat(jnp.eye(self.shape[1], dtype=self.dtype))
 
 
 def get_ntk_from_jac(jac1, jac2):
+    if not (isinstance(jac1, dict) and isinstance(jac2, dict)):
+        # flat layout, a single matmul
+        return _jac_array(jac1) @ _jac_array(jac2).T
     # prods = [jnp.einsum('ijk,ljk->jil', jac1[k], jac2[k]) for k in jac1.keys()]
     # return sum(prods)
     prods = None
@@ -73,7 +430,14 @@ def get_ntk_from_jac(jac1, jac2):
 
 class NTKHelper:
     
-    def __init__(self, model: dde.Model, inverse_problem: bool = False):
+    def __init__(self, model: dde.Model, inverse_problem: bool = False, chunk_size: int = None, mem_budget: int = None,
+                 cache_jacs: bool = True, jac_mode: str = 'rev', devices: int = None, cache_max_bytes: int = None):
+        # chunk_size: number of points per jacobian chunk. mem_budget: alternatively, a budget in bytes for the
+        # jacobian rows of one chunk, from which the chunk size is derived. None for both means no chunking
+        # cache_jacs: keep the (unweighted) flat jacobian rows of every point until the parameters change
+        # cache_max_bytes: no more rows are cached beyond this size, by default mem_budget (unbounded if None)
+        # jac_mode: 'rev', 'fwd', 'jvp', or 'auto' to benchmark the modes once per (architecture, residue)
+        # devices: split the jacobian rows (and NTK blocks) across this many devices, None for a single device
         self.model = model
         self.inverse_problem = inverse_problem
         self.net = model.net
@@ -81,30 +445,305 @@ class NTKHelper:
         self.bcs = model.data.bcs
         self.bc_fns = [generate_residue(bc, self.net.apply, return_output_for_pointset=True) for bc in self.bcs]
         self._output_fn = lambda params, xs: self.net.apply(params, xs, training=True)
+        self._res_fns = dict()
+        self.mem_budget = mem_budget
+        self.chunk_size = chunk_size if (chunk_size is not None) else self._chunk_size_from_budget(mem_budget)
+        self.cache_jacs = cache_jacs
+        self.cache_max_bytes = cache_max_bytes if (cache_max_bytes is not None) else mem_budget
+        self.cache_stats = {'hits': 0, 'misses': 0}
+        assert (jac_mode == 'auto') or (jac_mode in JAC_MODES), f'Invalid jac_mode {jac_mode}'
+        self.jac_mode = jac_mode
+        self._fn_codes = dict()
+        self.mesh = make_mesh(devices)
+        self.clear_cache()
+
+    def clear_cache(self):
+        # drops the cached rows (the hit / miss counts are kept)
+        self._jac_cache = dict()
+        self._cache_params = None
+        self._cache_bytes = 0
+
+    def _check_cache_version(self, params):
+        # the parameter version is the identity of the parameter arrays, which are replaced (never modified) by
+        # every optimiser step. for inverse problems the pde residue also depends on the external parameters
+        leaves = jax.tree_util.tree_leaves(params)
+        if self.inverse_problem:
+            leaves += jax.tree_util.tree_leaves(self.model.params[1])
+        if (self._cache_params is None) or (len(leaves) != len(self._cache_params)) or \
+                any(a is not b for a, b in zip(leaves, self._cache_params)):
+            self._jac_cache = dict()
+            self._cache_params = leaves
+            self._cache_bytes = 0
+
+    def _cached_jac(self, xs, code, params, sketch, compute, store=True):
+        # rows of the unweighted flat (or sketched) jacobian, looked up by point and computed only if missing.
+        # the computed rows are only added to the cache with store and while it is below cache_max_bytes
+        if (not self.cache_jacs) or (xs.shape[0] == 0):
+            return compute(xs)
+        self._check_cache_version(params)
+        entry = self._jac_cache.get((code, id(sketch)))
+        if (entry is None) or (entry['sketch'] is not sketch):
+            entry = {'sketch': sketch, 'index': dict(), 'rows': None}
+            self._jac_cache[(code, id(sketch))] = entry
+        index = entry['index']
+        keys = [r.tobytes() for r in np.asarray(xs, dtype=np.float64).reshape(xs.shape[0], -1)]
+        new_idx, new_keys = [], dict()
+        for i, k in enumerate(keys):
+            if (k not in index) and (k not in new_keys):
+                new_keys[k] = len(new_keys)
+                new_idx.append(i)
+        self.cache_stats['hits'] += len(keys) - len(new_idx)
+        self.cache_stats['misses'] += len(new_idx)
+        if len(new_idx) > 0:
+            new_rows = compute(_pad_pow2(xs[np.array(new_idx)]))[:len(new_idx)]
+            new_bytes = new_rows.size * new_rows.dtype.itemsize
+            if (not store) or ((self.cache_max_bytes is not None) and (self._cache_bytes + new_bytes > self.cache_max_bytes)):
+                # not kept: the cached rows of the hits, the new rows for the rest
+                out = new_rows[np.array([new_keys.get(k, 0) for k in keys])]
+                hits = np.array([index.get(k, -1) for k in keys])
+                if np.any(hits >= 0):
+                    out = out.at[np.flatnonzero(hits >= 0)].set(entry['rows'][hits[hits >= 0]])
+                return out
+            self._cache_bytes += new_bytes
+            offset = 0 if entry['rows'] is None else entry['rows'].shape[0]
+            index.update({k: offset + j for k, j in new_keys.items()})
+            entry['rows'] = new_rows if entry['rows'] is None else jnp.concatenate([entry['rows'], new_rows], axis=0)
+        idx = np.array([index[k] for k in keys])
+        if (idx.shape[0] == entry['rows'].shape[0]) and np.all(idx == np.arange(idx.shape[0])):
+            return entry['rows']
+        return entry['rows'][idx]
+
+    def _row_bytes(self):
+        # size of one jacobian row, i.e. the number of (differentiated) parameters times the item size
+        leaves = jax.tree_util.tree_leaves(self.net.params['params'])
+        return sum(l.size for l in leaves) * leaves[0].dtype.itemsize
+
+    def _chunk_size_from_budget(self, mem_budget):
+        if mem_budget is None:
+            return None
+        return max(1, int(mem_budget // self._row_bytes()))
+
+    def _jac_params(self, params, xs, fn):
+        mode = self._get_jac_mode(params, xs, fn)
+        if self.mesh is not None:
+            return _jac_params_sharded(params, xs, fn, self.mesh, chunk_size=self.chunk_size, mode=mode)
+        return _jac_params(params=params, x=xs, fn=fn, chunk_size=self.chunk_size, mode=mode)
+
+    def _jac_sketched(self, params, xs, sketch, fn):
+        if self.mesh is not None:
+            return _jac_sketched_sharded(params, xs, sketch, fn, self.mesh, chunk_size=self.chunk_size)
+        return _jac_sketched(params, xs, sketch, fn, chunk_size=self.chunk_size)
+
+    def gram_operator(self, jac):
+        """matrix-free NTK of a flat jacobian, sharded over the helper's devices"""
+        return GramOperator(_jac_array(jac), mesh=self.mesh)
+
+    def _get_jac_mode(self, params, xs, fn, max_fwd_params=200000, bench_size=32):
+        # the fastest of jacrev / jacfwd / batched jvp depends on the parameter count, the output dimension and
+        # the derivative order of the residue (reverse-over-reverse is slow for hessians), so in 'auto' mode each is
+        # timed once on a small batch and the winner cached for the (architecture, residue) pair
+        if self.jac_mode != 'auto':
+            return self.jac_mode
+        if xs.shape[0] == 0:
+            # nothing to time on, and nothing to compute either
+            return 'rev'
+        code = self._fn_codes.get(fn, None)
+        target = {-2: 'output', -1: self.pde, None: fn}.get(code, self.bcs[code] if code is not None and code >= 0 else fn)
+        leaves = jax.tree_util.tree_leaves(params['params'])
+        arch = (type(self.net).__name__, tuple((l.shape, str(l.dtype)) for l in leaves))
+        key = (arch, target, code)
+        if key not in _JAC_MODE_CACHE:
+            n_params = sum(l.size for l in leaves)
+            # forward modes need one pass per parameter, so are not even tried for large nets
+            modes = JAC_MODES if n_params <= max_fwd_params else ['rev']
+            xb = _pad_chunks(xs[:bench_size], bench_size)[0]
+            times = dict()
+            for mode in modes:
+                jax.block_until_ready(_jac_params_helper(params, xb, fn, mode=mode))  # compile
+                t = time.time()
+                jax.block_until_ready(_jac_params_helper(params, xb, fn, mode=mode))
+                times[mode] = time.time() - t
+            _JAC_MODE_CACHE[key] = min(times, key=times.get)
+            print(f"Jacobian mode for residue code {code}: {_JAC_MODE_CACHE[key]} "
+                  f"({', '.join(f'{m}={1e3 * t:.2f}ms' for m, t in times.items())} for {bench_size} points)")
+        return _JAC_MODE_CACHE[key]
     
-    def get_jac_clean(self,d,loss_w_bcs=1.0, loss_w_pde=1.0):
-        jac_pde = self.get_jac(d['res'], code=-1, loss_w_pde=loss_w_pde)
-        jac_bcs = [self.get_jac(d['bcs'][i], code=i, loss_w_bcs = loss_w_bcs) for i in range(len(d['bcs']))]
-        jacs_sep = [jac_pde] + jac_bcs
-        jacs = {k: jnp.concatenate([jc[k] for jc in jacs_sep], axis=0) for k in jac_pde.keys()}
+    def param_layout(self, params=None):
+        return _param_layout(self.net.params if params is None else params)
+
+    def _cleanup(self, dd, w=1.0, flat=False):
+        return _jac_params_flatten(dd, w=w) if flat else _jac_params_cleanup(dd, w=w)
+
+    def get_jac_clean(self,d,loss_w_bcs=1.0, loss_w_pde=1.0, sketch=None):
+        return self.get_jac_block({'res': d['res'], 'bcs': d['bcs']}, loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde, sketch=sketch)
+
+    def get_jac_block(self, d, params=None, loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0, sketch=None, cache=True):
+        """flat jacobian of a points dictionary, stacked as res, bcs[i] (and anc if present). with cache=False,
+        cached rows are used but the new ones are not kept (e.g. for candidate sets)
+
+        Returns
+        -------
+        JacobianBlock
+            (N, P) jacobian with segments 'res', 'bcs_0', ..., 'anc', or (N, s) if a sketch is given
+        """
+        loss_w_bcs = loss_w_bcs if hasattr(loss_w_bcs, "__len__") else [loss_w_bcs for _ in d['bcs']]
+        blocks = [self.get_jac(d['res'], code=-1, params=params, loss_w_pde=loss_w_pde, flat=True, sketch=sketch, cache=cache)]
+        blocks += [self.get_jac(d['bcs'][i], code=i, params=params, loss_w_bcs=loss_w_bcs[i], flat=True, sketch=sketch, cache=cache) for i in range(len(d['bcs']))]
+        names = ['res'] + [f'bcs_{i}' for i in range(len(d['bcs']))]
+        if 'anc' in d.keys():
+            blocks += [self.get_jac(d['anc'], code=-2, params=params, loss_w_anc=loss_w_anc, flat=True, sketch=sketch, cache=cache)]
+            names += ['anc']
+        jacs = JacobianBlock.concatenate(blocks, names=names)
+        # the per-layer view does not exist for sketched columns
+        jacs.layout = self.param_layout(params) if sketch is None else None
         return jacs
 
-    def _get_output_jac(self, xs, params, loss_w_anc=1.0):
-        fun=lambda params, x: loss_w_anc * self._output_fn(params, x)[:, 0]
-        d = _jac_params_helper(params=params, x=xs, fn=fun)
-        return _jac_params_cleanup(d)
-        
-    def _get_pde_jac(self, xs, params, loss_w_pde = 1.0):
-        
-        def f2_(params, x):
-            f_ = lambda x: self.net.apply(params, x)
-            if self.inverse_problem:
-                return loss_w_pde * self.pde(x, (f_(x), f_), self.model.params[1])[0]
+    def get_jac_store(self, d, path, params=None, loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0, sketch=None,
+                      block_rows=None):
+        """flat jacobian of a points dictionary, as in get_jac_block, written to an on-disk JacobianStore
+
+        The rows are computed and written block_rows at a time (by default the chunk size, or 1024), and are
+        not kept in the jacobian cache, so the store can be larger than the memory.
+
+        Parameters
+        ----------
+        path : str
+            file of the store, or a directory in which a new file is created
+        block_rows : int, optional
+            number of rows computed at once, by default None
+        """
+        params = self.net.params if params is None else params
+        block_rows = block_rows or self.chunk_size or 1024
+        loss_w_bcs = loss_w_bcs if hasattr(loss_w_bcs, "__len__") else [loss_w_bcs for _ in d['bcs']]
+        segs = [('res', d['res'], -1, loss_w_pde)]
+        segs += [(f'bcs_{i}', d['bcs'][i], i, loss_w_bcs[i]) for i in range(len(d['bcs']))]
+        if 'anc' in d.keys():
+            segs += [('anc', d['anc'], -2, loss_w_anc)]
+
+        leaves = jax.tree_util.tree_leaves(params['params'])
+        n_cols = sum(l.size for l in leaves) if sketch is None else sketch.shape[1]
+        store = JacobianStore.create(path, n_cols, [(name, xs.shape[0]) for name, xs, _, _ in segs], dtype=leaves[0].dtype)
+        for name, xs, code, w in segs:
+            fn = self._get_res_fn(code)
+            for i in range(0, xs.shape[0], block_rows):
+                xc = xs[i:i + block_rows]
+                # fixed-size blocks, so that the jacobian functions are compiled once
+                xp = _pad_chunks(xc, block_rows)[0]
+                if sketch is None:
+                    rows = _jac_params_flatten(self._jac_params(params, xp, fn), w=w)
+                else:
+                    rows = w * self._jac_sketched(params, xp, sketch, fn)
+                store.write(name, i, rows[:xc.shape[0]])
+        store.flush()
+        return store
+
+    def get_ntk_store(self, jac1, store, block_rows=None):
+        """NTK between an in-memory flat jacobian (rows) and a JacobianStore (columns), reading the store block by block"""
+        block_rows = block_rows or self.chunk_size or 1024
+        J1 = _jac_array(jac1, self.param_layout())
+        cols = [self.get_ntk(jac1=J1, jac2=block) for _, block in store.blocks(block_rows)]
+        return jnp.concatenate(cols, axis=1)
+
+    def make_sketch(self, sketch_size, sketch_type='gaussian', key=None, params=None):
+        """random (P, s) projection of the parameter dimension, to be passed as ``sketch`` to get_jac / get_jac_block
+
+        Parameters
+        ----------
+        sketch_size : int
+            number of sketch columns s, should be much smaller than the number of parameters P
+        sketch_type : str, optional
+            'gaussian' or 'srht' (subsampled randomised Hadamard transform), by default 'gaussian'
+        key : jax PRNGKey, optional
+            by default PRNGKey(0)
+        """
+        leaves = jax.tree_util.tree_leaves((self.net.params if params is None else params)['params'])
+        key = jax.random.PRNGKey(0) if key is None else key
+        return _sketch_matrix(key, sum(l.size for l in leaves), sketch_size, sketch_type=sketch_type, dtype=leaves[0].dtype)
+
+    def sketch_error_report(self, xs, code=-2, sketch_sizes=(32, 64, 128, 256), sketch_types=('gaussian', 'srht'),
+                            k=10, key=None, params=None, verbose=True):
+        """compare sketched NTKs against the exact one, to pick the sketch size for an equation on a small problem
+
+        xs may be an array (with code) or a points dictionary. Reported are the relative Frobenius error of K, the
+        maximum relative error of the top-k eigenvalues and the time for the sketched jacobian.
+        """
+        params = self.net.params if params is None else params
+        key = jax.random.PRNGKey(0) if key is None else key
+        if isinstance(xs, dict):
+            get = lambda sketch: self.get_jac_block(xs, params=params, sketch=sketch).jac
+        else:
+            get = lambda sketch: self.get_jac(xs, code=code, params=params, flat=True, sketch=sketch)
+        K = get_ntk_from_jac(get(None), get(None))
+        eigvals = jnp.linalg.eigvalsh(K)[::-1][:k]
+        report = []
+        for sketch_type in sketch_types:
+            for sketch_size in sketch_sizes:
+                S = self.make_sketch(sketch_size, sketch_type, key=key, params=params)
+                jax.block_until_ready(get(S))  # compile first so that only the evaluation is timed
+                t = time.time()
+                js = jax.block_until_ready(get(S))
+                t = time.time() - t
+                K_s = get_ntk_from_jac(js, js)
+                eigvals_s = jnp.linalg.eigvalsh(K_s)[::-1][:k]
+                report.append({
+                    'sketch_type': sketch_type,
+                    'sketch_size': sketch_size,
+                    'rel_fro_err': float(jnp.linalg.norm(K_s - K) / jnp.linalg.norm(K)),
+                    'rel_eig_err': float(jnp.max(jnp.abs(eigvals_s - eigvals) / jnp.abs(eigvals))),
+                    'time': t,
+                })
+                if verbose:
+                    r = report[-1]
+                    print(f"{sketch_type:>8s} s={sketch_size:5d}: rel_fro_err = {r['rel_fro_err']:.4f}, "
+                          f"rel_eig_err (top {k}) = {r['rel_eig_err']:.4f}, time = {r['time']:.3f}s")
+        return report
+
+    def _make_res_fn(self, code):
+        if code == -2:
+            return lambda params, x: self._output_fn(params, x)[:, 0]
+        elif code == -1:
+            def f2_(params, x):
+                f_ = lambda x: self.net.apply(params, x)
+                if self.inverse_problem:
+                    return self.pde(x, (f_(x), f_), self.model.params[1])[0]
+                else:
+                    return self.pde(x, (f_(x), f_))[0]
+            return f2_
+        else:
+            assert 0 <= code < len(self.bcs)
+            return lambda params, x: self.bc_fns[code](params, x)
+
+    def _get_res_fn(self, code):
+        # unweighted residue function fn(params, xs) for a derivative code. these are cached so that the
+        # jitted helpers (which take fn as a static argument) are not retraced on every call
+        if (code == -1) and self.inverse_problem:
+            # closes over the current external parameters, so cannot be reused
+            fn = self._make_res_fn(code)
+            self._fn_codes = {f: c for f, c in self._fn_codes.items() if c != -1}
+            self._fn_codes[fn] = code
+            return fn
+        if code not in self._res_fns:
+            self._res_fns[code] = self._make_res_fn(code)
+            self._fn_codes[self._res_fns[code]] = code
+        return self._res_fns[code]
+
+    def get_error_fn(self, code):
+        # residue as seen by the training loss, i.e. unlike _get_res_fn the error (not the output) for PointSetBCs
+        key = ('err', code)
+        if key not in self._res_fns:
+            if code >= 0:
+                self._res_fns[key] = generate_residue(self.bcs[code], self.net.apply)
             else:
-                return loss_w_pde * self.pde(x, (f_(x), f_))[0]
+                self._res_fns[key] = self._get_res_fn(code)
+        return self._res_fns[key]
+
+    def _get_output_jac(self, xs, params, loss_w_anc=1.0, flat=False):
+        d = self._jac_params(params, xs, self._get_res_fn(-2))
+        return self._cleanup(d, w=loss_w_anc, flat=flat)
         
-        d = _jac_params_helper(params=params, x=xs, fn=f2_)
-        return _jac_params_cleanup(d)
+    def _get_pde_jac(self, xs, params, loss_w_pde = 1.0, flat=False):
+        d = self._jac_params(params, xs, self._get_res_fn(-1))
+        return self._cleanup(d, w=loss_w_pde, flat=flat)
     
     def get_pde_jac_inv(self, xs, params):
         
@@ -124,17 +763,14 @@ class NTKHelper:
     
     
     # Adding loss_w_bcs to introduce loss weights
-    def _get_bc_jac(self, bc_idx, xs, params, loss_w_bcs = 1.0):
+    def _get_bc_jac(self, bc_idx, xs, params, loss_w_bcs = 1.0, flat=False):
         # bc = self.bcs[bc_idx]         
         # # bc_fn = lambda xs, ys: (loss_w_bcs* bc.error(xs, xs, ys[0], 0, xs.shape[0]),)
         # bc_fn = lambda xs, ys: (loss_w_bcs* bc.error(xs, xs, ys[0], 0, xs.shape[0]),)
-        d = _jac_params_helper(
-            params=params, x=xs, 
-            fn=lambda param, x_: loss_w_bcs * self.bc_fns[bc_idx](param, x_)
-        )
-        return _jac_params_cleanup(d)
+        d = self._jac_params(params, xs, self._get_res_fn(bc_idx))
+        return self._cleanup(d, w=loss_w_bcs, flat=flat)
     
-    def _get_jac_fn(self, code, params=None, loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0):
+    def _get_jac_fn(self, code, params=None, loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0, flat=False):
         if params is None:
             # use param as stored in self.net
             # this disregards the effect that comes from ext_params tho
@@ -142,17 +778,29 @@ class NTKHelper:
             
         if code == -2:
             # derivative wrt output only
-            return partial(self._get_output_jac, params=params, loss_w_anc=loss_w_anc)
+            return partial(self._get_output_jac, params=params, loss_w_anc=loss_w_anc, flat=flat)
         elif code == -1:
             # derivative wrt PDE residue
-            return partial(self._get_pde_jac, params=params, loss_w_pde=loss_w_pde)
+            return partial(self._get_pde_jac, params=params, loss_w_pde=loss_w_pde, flat=flat)
         else:
             # derivative wrt BC error term
             assert 0 <= code < len(self.bcs)
-            return partial(self._get_bc_jac, bc_idx=code, params=params, loss_w_bcs=loss_w_bcs)
+            return partial(self._get_bc_jac, bc_idx=code, params=params, loss_w_bcs=loss_w_bcs, flat=flat)
         
-    def get_jac(self, xs, code=-2, params=None, loss_w_bcs = 1.0, loss_w_pde = 1.0, loss_w_anc = 1.0):
-        return self._get_jac_fn(code=code, params=params, loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde,loss_w_anc=loss_w_anc)(xs=xs)
+    def get_jac(self, xs, code=-2, params=None, loss_w_bcs = 1.0, loss_w_pde = 1.0, loss_w_anc = 1.0, flat=False, sketch=None, cache=True):
+        # flat=True returns the contiguous (N, P) array instead of the dict of per-layer jacobians
+        # with a (P, s) sketch from make_sketch, the (N, s) product J @ S is returned instead (J is never formed)
+        if flat or (sketch is not None):
+            params = self.net.params if params is None else params
+            w = {-2: loss_w_anc, -1: loss_w_pde}.get(code, loss_w_bcs)
+            fn = self._get_res_fn(code)
+            if sketch is None:
+                compute = lambda x: _jac_params_flatten(self._jac_params(params, x, fn))
+            else:
+                compute = lambda x: self._jac_sketched(params, x, sketch, fn)
+            jac = self._cached_jac(xs, code, params, sketch, compute, store=cache)
+            return jac if w == 1.0 else w * jac
+        return self._get_jac_fn(code=code, params=params, loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde,loss_w_anc=loss_w_anc, flat=flat)(xs=xs)
     
     def get_ntk(self, xs1=None, code1=-2, jac1=None, xs2=None, code2=None, jac2=None, params=None):
         """compute the (empirical) NTK between two inputs under some transformation
@@ -179,7 +827,7 @@ class NTKHelper:
         """
         if jac1 is None:
             assert xs1 is not None
-            jac1 = self.get_jac(xs=xs1, code=code1, params=params)
+            jac1 = self.get_jac(xs=xs1, code=code1, params=params, flat=True)
             print(f"Warning: jac1 not provided so computing jac without custom loss parameters")
         
         if jac2 is not None:
@@ -193,6 +841,187 @@ class NTKHelper:
             # otherwise compute the jacobian for xs2
             code2 = code1 if code2 is None else code2
             print(f"Warning: jac2 not provided so computing jac without custom loss parameters")
-            jac2 = self._get_jac_fn(code=code2, params=params)(xs=xs2)
+            jac2 = self._get_jac_fn(code=code2, params=params, flat=True)(xs=xs2)
         
+        if isinstance(jac1, dict) != isinstance(jac2, dict):
+            # mixed layouts, bring both to the flat one
+            layout = self.param_layout(params)
+            jac1, jac2 = _jac_array(jac1, layout), _jac_array(jac2, layout)
+        if (self.mesh is not None) and not isinstance(jac1, dict):
+            return gram_sharded(_jac_array(jac1), _jac_array(jac2), self.mesh)
         return get_ntk_from_jac(jac1=jac1, jac2=jac2)
+
+    def _get_blocks(self, xs, code=-2, loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0):
+        # list of (fn, xs, w) in the same row order as the stacked jacs used elsewhere: res, bcs[i], anc
+        if isinstance(xs, dict):
+            loss_w_bcs = loss_w_bcs if hasattr(loss_w_bcs, "__len__") else [loss_w_bcs for _ in xs['bcs']]
+            blocks = [(self._get_res_fn(-1), xs['res'], loss_w_pde)]
+            blocks += [(self._get_res_fn(i), xs['bcs'][i], loss_w_bcs[i]) for i in range(len(xs['bcs']))]
+            if 'anc' in xs.keys():
+                blocks += [(self._get_res_fn(-2), xs['anc'], loss_w_anc)]
+            # empty blocks contribute nothing but would still be traced
+            return [b for b in blocks if b[1].shape[0] > 0]
+        w = {-2: loss_w_anc, -1: loss_w_pde}.get(code, loss_w_bcs)
+        return [(self._get_res_fn(code), xs, w)]
+
+    def get_ntk_operator(self, xs1, code1=-2, xs2=None, code2=None, params=None,
+                         loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0):
+        """matrix-free (empirical) NTK between two inputs, exposed as a linear operator
+
+        Parameters
+        ----------
+        xs1 : jax Array or dict
+            array 1, or a points dictionary with keys 'res', 'bcs' (and optionally 'anc'), in which case the
+            rows are stacked in the same order as the concatenated jacs
+        code1 : int, optional
+            derivative wrt function output (-2), PDE residual (-1) or BC error (non-neg int), by default -2.
+            ignored if xs1 is a dictionary
+        xs2 : jax Array or dict, optional
+            array 2, by default None (use xs1)
+        code2 : int, optional
+            by default None (use same as code1)
+        params : FrozenDict, optional
+            parameter of net, by default None
+
+        Returns
+        -------
+        NTKLinearOperator
+            operator with shape (xs1 rows, xs2 rows) supporting ``K @ v`` without forming any Jacobian
+        """
+        params = self.net.params if params is None else params
+        loss_ws = dict(loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde, loss_w_anc=loss_w_anc)
+        blocks1 = self._get_blocks(xs1, code=code1, **loss_ws)
+        if xs2 is None:
+            blocks2 = blocks1
+        else:
+            blocks2 = self._get_blocks(xs2, code=(code1 if code2 is None else code2), **loss_ws)
+        return NTKLinearOperator(params, blocks1, blocks2)
+
+    def spectral_stats(self, xs=None, code=-2, jac=None, params=None, loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0,
+                       matrix_free=False, num_probes=32, power_iters=0, key=None):
+        """trace and largest eigenvalue of an NTK, without forming (or diagonalising) the kernel
+
+        Parameters
+        ----------
+        xs : jax Array or dict, optional
+            points (with code), or a points dictionary as in get_ntk_operator. not needed if jac is given
+        jac : jax Array or JacobianBlock, optional
+            precomputed flat jacobian
+        matrix_free : bool, optional
+            if True, the trace is a Hutchinson estimate with num_probes VJPs and lambda_max uses the matrix-free
+            operator, so no jacobian is formed. otherwise the trace is exact, the sum of squared jacobian rows
+        power_iters : int, optional
+            number of power iterations for lambda_max, by default 0 (not computed)
+
+        Returns
+        -------
+        dict
+            'trace' and, if power_iters > 0, 'lambda_max'
+        """
+        key = jax.random.PRNGKey(0) if key is None else key
+        loss_ws = dict(loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde, loss_w_anc=loss_w_anc)
+        if matrix_free and (jac is None):
+            params = self.net.params if params is None else params
+            blocks = self._get_blocks(xs, code=code, **loss_ws)
+            fns, xss, ws = (tuple(b) for b in zip(*blocks))
+            n = sum(x.shape[0] for x in xss)
+            Z = jax.random.rademacher(key, (num_probes, n), dtype=xss[0].dtype)
+            stats = {'trace': _hutchinson_trace(params, xss, ws, Z, fns=fns)}
+            K = NTKLinearOperator(params, blocks, blocks)
+        else:
+            if jac is None:
+                if isinstance(xs, dict):
+                    jac = self.get_jac_block(xs, params=params, **loss_ws)
+                else:
+                    jac = self.get_jac(xs, code=code, params=params, flat=True, **loss_ws)
+            jac = _jac_array(jac)
+            stats = {'trace': jnp.sum(jac ** 2)}
+            K = self.gram_operator(jac)
+        if power_iters > 0:
+            stats['lambda_max'] = power_iteration(K, num_iters=power_iters, key=key)[0]
+        return stats
+
+    def get_ntk_chunked(self, xs1=None, code1=-2, jac1=None, xs2=None, code2=None, params=None,
+                        loss_w_bcs=1.0, loss_w_pde=1.0, loss_w_anc=1.0):
+        """compute the (empirical) NTK block by block, so that at most one chunk of jacobian rows is held
+        per input (plus jac1 if given)
+
+        xs1 and xs2 may be arrays with the corresponding codes, or points dictionaries (see get_ntk_operator).
+        if xs2 is None, the NTK of xs1 with itself is computed from one set of chunks, block by block above the
+        diagonal. if the jacobian rows of xs2 fit within mem_budget they are kept and reused across row chunks of
+        xs1, otherwise they are recomputed.
+        """
+        params = self.net.params if params is None else params
+        chunk_size = self.chunk_size
+        loss_ws = dict(loss_w_bcs=loss_w_bcs, loss_w_pde=loss_w_pde, loss_w_anc=loss_w_anc)
+
+        def _chunk_specs(blocks):
+            # (row offset, fn, points, weight) of the fixed-size row chunks of the stacked blocks
+            specs, offset = [], 0
+            for fn, xs, w in blocks:
+                step = xs.shape[0] if chunk_size is None else chunk_size
+                for i in range(0, xs.shape[0], step):
+                    specs.append((offset + i, fn, xs[i:i + step], w))
+                offset += xs.shape[0]
+            return specs
+
+        def _chunk_jac(spec):
+            _, fn, xc, w = spec
+            step = xc.shape[0] if chunk_size is None else chunk_size
+            dd = _jac_params_helper(params, _pad_chunks(xc, step)[0], fn, mode=self._get_jac_mode(params, xc, fn))
+            dd = jax.tree_util.tree_map(lambda a: a[:xc.shape[0]], dd)
+            return _jac_params_flatten(dd, w=w)
+
+        if self.mesh is not None:
+            gram = lambda j1, j2: gram_sharded(j1, j2, self.mesh)
+        else:
+            gram = lambda j1, j2: get_ntk_from_jac(jac1=j1, jac2=j2)
+
+        blocks2 = self._get_blocks(xs1 if xs2 is None else xs2, code=(code1 if code2 is None else code2), **loss_ws)
+        specs2 = _chunk_specs(blocks2)
+        n2 = sum(b[1].shape[0] for b in blocks2)
+
+        if self.mem_budget is not None:
+            keep2 = (n2 * self._row_bytes() <= self.mem_budget)
+        else:
+            keep2 = (chunk_size is None) or (n2 <= chunk_size)
+
+        if (xs2 is None) and (jac1 is None):
+            # symmetric: the row chunks are also the column chunks, only the blocks on and above the diagonal are
+            # computed. the jacobians of later chunks are kept if they fit, otherwise recomputed for every row chunk
+            cached = [None] * len(specs2)
+            blocks = [[None] * len(specs2) for _ in specs2]
+            for i in range(len(specs2)):
+                j_i = cached[i] if cached[i] is not None else _chunk_jac(specs2[i])
+                blocks[i][i] = gram(j_i, j_i)
+                for j in range(i + 1, len(specs2)):
+                    if cached[j] is None:
+                        j_j = _chunk_jac(specs2[j])
+                        if keep2:
+                            cached[j] = j_j
+                    else:
+                        j_j = cached[j]
+                    blocks[i][j] = gram(j_i, j_j)
+                    blocks[j][i] = blocks[i][j].T
+                cached[i] = None
+            K = jnp.block(blocks) if len(specs2) > 0 else jnp.zeros((0, 0))
+            assert K.shape == (n2, n2)
+            return K
+
+        if jac1 is not None:
+            n1 = _jac_rows(jac1)
+            chunks1 = [(0, _jac_array(jac1, self.param_layout(params)))]
+        else:
+            blocks1 = self._get_blocks(xs1, code=code1, **loss_ws)
+            n1 = sum(b[1].shape[0] for b in blocks1)
+            chunks1 = ((spec[0], _chunk_jac(spec)) for spec in _chunk_specs(blocks1))
+
+        cached2 = [_chunk_jac(spec) for spec in specs2] if keep2 else None
+
+        rows = []
+        for _, j1 in chunks1:
+            row = [gram(j1, j2) for j2 in (cached2 if keep2 else (_chunk_jac(spec) for spec in specs2))]
+            rows.append(jnp.concatenate(row, axis=1))
+        K = jnp.concatenate(rows, axis=0)
+        assert K.shape == (n1, n2)
+        return K
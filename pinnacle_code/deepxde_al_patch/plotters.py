@@ -224,7 +224,8 @@ def plot_eigvals(train_loop,step_idx):
 
 def func_kernel_pred(train_loop,x_test,step_idx,idx=-1,code = -2, use_const_res=True):
     ntk_fn = NTKHelper(train_loop.model)
-    jacs_x_test = ntk_fn.get_jac(x_test, code=code)
+    sketch = train_loop.snapshot_data[step_idx]['al_intermediate'].get('sketch')
+    jacs_x_test = ntk_fn.get_jac(x_test, code=code, flat=(sketch is not None), sketch=sketch)
     jacs_train = train_loop.snapshot_data[step_idx]['al_intermediate']['jac_train']
     K_train_x_test = ntk_fn.get_ntk(jac1=jacs_train, jac2=jacs_x_test)
 
@@ -0,0 +1,102 @@
+import numpy as np
+import jax.numpy as jnp
+
+
+class PointSet:
+    """training / candidate points as one contiguous (N, d) coordinate buffer with an integer segment id per row
+
+    Segment ids are 0 for the residue points, 1 + i for the points of bcs[i] and n_bcs + 1 for the anchors, and
+    the rows are always ordered by segment, so that row indices coincide with the indices of the flattened points
+    dictionary ({'res': ..., 'bcs': [...], 'anc': ...}) used throughout the selectors.
+    """
+
+    def __init__(self, coords, seg_ids, n_bcs, has_anc=False):
+        self.coords = coords
+        self.seg_ids = np.asarray(seg_ids, dtype=np.int32)
+        self.n_bcs = n_bcs
+        self.has_anc = has_anc
+
+    @property
+    def anc_id(self):
+        return self.n_bcs + 1
+
+    @staticmethod
+    def from_dict(d, n_bcs=None, dim=None):
+        n_bcs = len(d['bcs']) if n_bcs is None else n_bcs
+        has_anc = ('anc' in d.keys()) and (d['anc'] is not None)
+        parts = [d['res']] + list(d['bcs']) + ([d['anc']] if has_anc else [])
+        dim = dim if dim is not None else max(np.shape(p)[-1] for p in parts if np.ndim(p) == 2)
+        parts = [jnp.asarray(p).reshape(-1, dim) for p in parts]
+        ids = list(range(n_bcs + 1)) + ([n_bcs + 1] if has_anc else [])
+        seg_ids = np.concatenate([np.full(p.shape[0], i, dtype=np.int32) for p, i in zip(parts, ids)])
+        return PointSet(jnp.concatenate(parts, axis=0), seg_ids, n_bcs, has_anc=has_anc)
+
+    def to_dict(self):
+        d = {'res': self.segment(0), 'bcs': [self.segment(1 + i) for i in range(self.n_bcs)]}
+        if self.has_anc:
+            d['anc'] = self.segment(self.anc_id)
+        return d
+
+    def __len__(self):
+        return self.coords.shape[0]
+
+    def _seg_id(self, seg):
+        # 'res', 'bcs_<i>', 'anc' or the integer id
+        if seg == 'res':
+            return 0
+        elif seg == 'anc':
+            return self.anc_id
+        elif isinstance(seg, str):
+            return 1 + int(seg.split('_')[1])
+        return seg
+
+    def offsets(self):
+        # row offsets of the segments, offsets[s]:offsets[s + 1] are the rows of segment s
+        return np.searchsorted(self.seg_ids, np.arange(self.n_bcs + 3))
+
+    def counts(self):
+        return np.bincount(self.seg_ids, minlength=self.n_bcs + 2)
+
+    def segment(self, seg):
+        s = self._seg_id(seg)
+        off = self.offsets()
+        return self.coords[off[s]:off[s + 1]]
+
+    def gather(self, idx):
+        """points at the given (flattened) indices, kept in segment order"""
+        idx = np.asarray(idx, dtype=np.int64).reshape(-1)
+        idx = idx[np.argsort(self.seg_ids[idx], kind='stable')]
+        return PointSet(self.coords[idx], self.seg_ids[idx], self.n_bcs, has_anc=self.has_anc)
+
+    def mask(self, m):
+        return self.gather(np.flatnonzero(np.asarray(m)))
+
+    def select(self, segments):
+        """only the points of the given segments"""
+        return self.mask(np.isin(self.seg_ids, [self._seg_id(s) for s in segments]))
+
+    def random_subset(self, fraction, segments=None, rng=np.random):
+        """floor(fraction * n) points of each segment (in segments, by default all) drawn without replacement"""
+        segments = range(self.n_bcs + 2) if segments is None else [self._seg_id(s) for s in segments]
+        off = self.offsets()
+        idx = [off[s] + rng.choice(off[s + 1] - off[s], int(np.floor((off[s + 1] - off[s]) * fraction)), replace=False)
+               for s in segments]
+        return self.gather(np.concatenate(idx) if len(idx) > 0 else [])
+
+    @staticmethod
+    def concat(point_sets):
+        """union of point sets (with the same bcs), segment by segment"""
+        point_sets = [p for p in point_sets if p is not None]
+        seg_ids = np.concatenate([p.seg_ids for p in point_sets])
+        order = np.argsort(seg_ids, kind='stable')
+        coords = jnp.concatenate([p.coords for p in point_sets], axis=0)[order]
+        return PointSet(coords, seg_ids[order], point_sets[0].n_bcs, has_anc=any(p.has_anc for p in point_sets))
+
+    def dedupe(self):
+        """drop repeated points within each segment, keeping the first occurrence"""
+        rows = np.concatenate([self.seg_ids[:, None].astype(np.float64), np.asarray(self.coords, dtype=np.float64)], axis=1)
+        _, first = np.unique(rows, axis=0, return_index=True)
+        return self.gather(np.sort(first))
+
+    def __repr__(self):
+        return f'PointSet(n={len(self)}, counts={self.counts().tolist()})'
@@ -0,0 +1,69 @@
+from functools import partial
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jax.sharding import Mesh, NamedSharding, PartitionSpec as P
+from jax.experimental.shard_map import shard_map
+
+
+# NTK rows (points) are split across the devices of a 1-d mesh along this axis. on CPU, several host devices
+# are exposed with XLA_FLAGS=--xla_force_host_platform_device_count=n, which has to be set before jax is imported
+ROWS = 'rows'
+
+
+def make_mesh(n_devices=None):
+    """1-d mesh over the first n_devices devices, or None (no sharding) for a single device"""
+    if (n_devices is None) or (n_devices <= 1):
+        return None
+    devices = jax.devices()
+    if n_devices > len(devices):
+        print(f'Warning: {n_devices} devices requested but only {len(devices)} available, '
+              f'set XLA_FLAGS=--xla_force_host_platform_device_count={n_devices} before importing jax')
+        n_devices = len(devices)
+    if n_devices <= 1:
+        return None
+    return Mesh(np.array(devices[:n_devices]), (ROWS,))
+
+
+def pad_rows(x, mesh, repeat=False):
+    # pad the leading axis to a multiple of the mesh size, with zeros or (repeat=True, for points) copies of the
+    # last row, and split it across the mesh. the explicit placement also moves arrays that were committed to a
+    # single device (e.g. stored intermediates) onto the mesh
+    pad = (-x.shape[0]) % mesh.size
+    if pad > 0:
+        fill = jnp.repeat(x[-1:], pad, axis=0) if repeat else jnp.zeros((pad, *x.shape[1:]), dtype=x.dtype)
+        x = jnp.concatenate([x, fill], axis=0)
+    return jax.device_put(x, NamedSharding(mesh, P(ROWS)))
+
+
+def gather_rows(x, n):
+    # first n rows, gathered back onto the default device so that they mix with the (unsharded) rest of the code
+    return jax.tree_util.tree_map(lambda a: jax.device_put(a[:n], jax.devices()[0]), x)
+
+
+@partial(jax.jit, static_argnames=['mesh'])
+def _gram_sharded(J1, J2, mesh):
+    # every device holds a block of rows of both jacobians. J2 is all-gathered, so that each device computes
+    # its row block of K against all columns
+    f = lambda j1, j2: j1 @ jax.lax.all_gather(j2, ROWS, tiled=True).T
+    return shard_map(f, mesh=mesh, in_specs=(P(ROWS), P(ROWS)), out_specs=P(ROWS))(J1, J2)
+
+
+def gram_sharded(J1, J2, mesh):
+    """``J1 @ J2.T`` of flat jacobians with the rows split across the mesh"""
+    n1, n2 = J1.shape[0], J2.shape[0]
+    return gather_rows(_gram_sharded(pad_rows(J1, mesh), pad_rows(J2, mesh), mesh)[:, :n2], n1)
+
+
+@partial(jax.jit, static_argnames=['mesh'])
+def _gram_matmat_sharded(J, V, mesh):
+    # J.T @ V is a sum over rows, so the per-device partial products are reduced with psum
+    f = lambda j, v: j @ jax.lax.psum(j.T @ v, ROWS)
+    return shard_map(f, mesh=mesh, in_specs=(P(ROWS), P(ROWS)), out_specs=P(ROWS))(J, V)
+
+
+def gram_matmat_sharded(J, V, mesh):
+    """``J @ (J.T @ V)`` with the rows of J and V split across the mesh"""
+    n = J.shape[0]
+    return gather_rows(_gram_matmat_sharded(pad_rows(J, mesh), pad_rows(V, mesh), mesh), n)
@@ -0,0 +1,177 @@
+import jax
+import jax.numpy as jnp
+from jax.experimental.sparse.linalg import lobpcg_standard
+
+from .sharding import gram_matmat_sharded
+
+
+EIG_SOLVERS = ['eigh', 'lanczos', 'lobpcg', 'randomized']
+
+
+@jax.tree_util.register_pytree_node_class
+class GramOperator:
+    """NTK ``K = J @ J.T`` of a flat (N, P) jacobian, applied without forming the N x N matrix.
+
+    Each product costs O(NP) rather than the O(N^2 P) needed to form K. With a mesh (see sharding.make_mesh)
+    the rows are split across its devices and ``J.T @ V`` is reduced between them.
+    """
+
+    def __init__(self, jac, mesh=None):
+        self.jac = jac
+        self.mesh = mesh
+
+    @property
+    def shape(self):
+        return (self.jac.shape[0], self.jac.shape[0])
+
+    @property
+    def dtype(self):
+        return self.jac.dtype
+
+    def matmat(self, V):
+        if self.mesh is not None:
+            return gram_matmat_sharded(self.jac, V, self.mesh)
+        return self.jac @ (self.jac.T @ V)
+
+    def matvec(self, v):
+        return self.matmat(v)
+
+    def __matmul__(self, v):
+        return self.matmat(v)
+
+    def to_dense(self):
+        return self.jac @ self.jac.T
+
+    def tree_flatten(self):
+        return (self.jac,), self.mesh
+
+    @classmethod
+    def tree_unflatten(cls, aux, children):
+        return cls(children[0], mesh=aux)
+
+
+def _to_dense(K):
+    return K.to_dense() if hasattr(K, 'to_dense') else K
+
+
+def _matmat_fn(K):
+    # works for dense arrays, GramOperator and ntk.NTKLinearOperator
+    if hasattr(K, 'matmat'):
+        return K.matmat
+    return lambda V: K @ V
+
+
+def _top_k_ascending(eigvals, eigvects, k):
+    # keep the k largest, returned in ascending order to match jnp.linalg.eigh
+    order = jnp.argsort(eigvals)[-k:]
+    return eigvals[order], eigvects[:, order]
+
+
+@jax.jit
+def _reorthogonalise(Q, w):
+    # Q holds the Lanczos vectors found so far as rows (unused rows are zero), applied twice for stability
+    w = w - Q.T @ (Q @ w)
+    return w - Q.T @ (Q @ w)
+
+
+def _lanczos(matmat, n, k, num_iters, key, dtype):
+    # Lanczos with full reorthogonalisation. the Ritz pairs of the tridiagonal matrix approximate the extremal
+    # eigenpairs of K, and the top ones converge first. shapes are fixed so the eager ops are only compiled once
+    q = jax.random.normal(key, (n,), dtype=dtype)
+    Q = jnp.zeros((num_iters, n), dtype=dtype).at[0].set(q / jnp.linalg.norm(q))
+    alphas, betas = [], []
+    for j in range(num_iters):
+        w = matmat(Q[j][:, None])[:, 0]
+        alphas.append(Q[j] @ w)
+        w = _reorthogonalise(Q, w)
+        beta = jnp.linalg.norm(w)
+        if (j == num_iters - 1) or (float(beta) < 1e-6 * float(jnp.abs(alphas[0]) + 1e-30)):
+            # invariant subspace found (or out of iterations)
+            break
+        betas.append(beta)
+        Q = Q.at[j + 1].set(w / beta)
+    m = len(alphas)
+    T = jnp.diag(jnp.stack(alphas))
+    if m > 1:
+        off = jnp.stack(betas[:m - 1])
+        T = T + jnp.diag(off, 1) + jnp.diag(off, -1)
+    theta, S = jnp.linalg.eigh(T)
+    return _top_k_ascending(theta, Q[:m].T @ S, min(k, m))
+
+
+def _randomized(matmat, n, k, num_iters, oversample, key, dtype):
+    # randomized range finder with subspace (power) iterations, followed by Rayleigh-Ritz on the range.
+    # for a PSD kernel this coincides with a randomized SVD
+    Y = matmat(jax.random.normal(key, (n, min(n, k + oversample)), dtype=dtype))
+    for _ in range(num_iters):
+        Y = matmat(jnp.linalg.qr(Y)[0])
+    Q = jnp.linalg.qr(Y)[0]
+    B = Q.T @ matmat(Q)
+    theta, S = jnp.linalg.eigh(0.5 * (B + B.T))
+    return _top_k_ascending(theta, Q @ S, k)
+
+
+def power_iteration(K, num_iters=20, key=None):
+    """largest eigenvalue (and eigenvector) of a symmetric PSD kernel by power iteration
+
+    K can be dense or matrix-free as in eigh_top_k. The Rayleigh quotient of the last iterate is returned, which
+    is a lower bound on lambda_max.
+    """
+    key = jax.random.PRNGKey(0) if key is None else key
+    matmat = _matmat_fn(K)
+    v = jax.random.normal(key, (K.shape[0], 1), dtype=K.dtype)
+    v = v / jnp.linalg.norm(v)
+    for _ in range(num_iters):
+        w = matmat(v)
+        v = w / jnp.linalg.norm(w)
+    lam = (v[:, 0] @ matmat(v)[:, 0])
+    return lam, v[:, 0]
+
+
+def eigh_top_k(K, k=None, method='eigh', key=None, num_iters=None, oversample=10, tol=None):
+    """top-k eigenpairs of a symmetric PSD kernel
+
+    Parameters
+    ----------
+    K : jax Array, GramOperator or NTKLinearOperator
+        kernel, either dense or matrix-free (anything with ``shape`` and ``matmat``)
+    k : int, optional
+        number of leading eigenpairs, by default None (all, which needs the dense kernel)
+    method : str, optional
+        one of 'eigh' (dense), 'lanczos', 'lobpcg' or 'randomized', by default 'eigh'
+    key : jax PRNGKey, optional
+        for the random starting vectors, by default PRNGKey(0)
+    num_iters : int, optional
+        Lanczos steps (default 2k + 20), LOBPCG iterations (default 100) or power iterations of the randomized
+        method (default 2)
+    oversample : int, optional
+        extra columns of the randomized sketch, by default 10
+    tol : float, optional
+        LOBPCG convergence tolerance, by default None
+
+    Returns
+    -------
+    tuple of jax Array
+        eigenvalues (k,) and eigenvectors (N, k), in ascending order like jnp.linalg.eigh
+    """
+    assert method in EIG_SOLVERS, f'Invalid eig solver {method}'
+    n = K.shape[0]
+    if (k is None) or (k >= n) or (method == 'eigh'):
+        eigvals, eigvects = jnp.linalg.eigh(_to_dense(K))
+        return (eigvals, eigvects) if (k is None) or (k >= n) else (eigvals[-k:], eigvects[:, -k:])
+
+    key = jax.random.PRNGKey(0) if key is None else key
+    dtype = K.dtype
+    matmat = _matmat_fn(K)
+    if method == 'lanczos':
+        return _lanczos(matmat, n, k, min(n, 2 * k + 20) if num_iters is None else num_iters, key, dtype)
+    elif method == 'randomized':
+        return _randomized(matmat, n, k, 2 if num_iters is None else num_iters, oversample, key, dtype)
+    else:
+        if 5 * k >= n:
+            # lobpcg only supports k * 5 < n, and at that size the dense solve is cheap anyway
+            eigvals, eigvects = jnp.linalg.eigh(_to_dense(K))
+            return eigvals[-k:], eigvects[:, -k:]
+        X = jax.random.normal(key, (n, k), dtype=dtype)
+        theta, U, _ = lobpcg_standard(matmat, X, m=100 if num_iters is None else num_iters, tol=tol)
+        return _top_k_ascending(theta, U, k)
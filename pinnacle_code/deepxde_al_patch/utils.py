@@ -9,6 +9,23 @@ import jax
 def to_cpu(x):
     return x
 
+@partial(jax.jit, static_argnames=['k'])
+def gumbel_top_k(key, weights, k):
+    """k indices drawn without replacement with probabilities proportional to weights (Gumbel-top-k trick)
+
+    Perturbing the log weights with iid Gumbel noise and keeping the top k is equivalent to k sequential weighted
+    draws without replacement, and the indices are returned in the order of those draws. Zero weights are never
+    drawn. k must not exceed the number of weights.
+    """
+    g = jax.random.gumbel(key, weights.shape, dtype=jnp.float32)
+    return jax.lax.top_k(jnp.log(weights) + g, k)[1]
+
+
+def sampling_key():
+    # jax PRNG key drawn from numpy's global state, so that seeding numpy keeps the sampling reproducible
+    return jax.random.PRNGKey(np.random.randint(2**31))
+
+
 def pairwise_dist(A, B):
     C = A[:, jnp.newaxis, :] - B[jnp.newaxis, :, :]
     C = jnp.linalg.norm(C, axis=-1)